@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""AttrCache Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import time
+import logging
+import threading
+import collections
+
+
+class AttrCache(object):
+    """
+    least recently used cache of entries (digest, st) by path,
+    limited by number of entries, every entry expires after ttl seconds
+
+    MetaStorage puts every entry it writes, and invalidates
+    entries it deletes, ttl only limits the age of entries
+    changed outside of this process
+    """
+
+    def __init__(self, maxentries, ttl):
+        logging.debug("AttrCache.__init__(%s, %s)", maxentries, ttl)
+        self.maxentries = maxentries
+        self.ttl = ttl
+        # path -> (expire time, entry), least recently used first
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # counters for report
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path):
+        """returns entry of path, or None if not cached or expired"""
+        with self.lock:
+            item = self.entries.pop(path, None)
+            if (item is None) or (item[0] < time.time()):
+                self.misses += 1
+                return(None)
+            self.entries[path] = item
+            self.hits += 1
+            return(item[1])
+
+    def put(self, path, entry, check=None):
+        """
+        cache entry of path, if check is given
+        only if check() is true while lock is held
+        """
+        if self.maxentries <= 0:
+            return
+        with self.lock:
+            if (check is not None) and (not check()):
+                return
+            self.entries.pop(path, None)
+            self.entries[path] = (time.time() + self.ttl, entry)
+            while len(self.entries) > self.maxentries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, path):
+        """forget entry of path"""
+        with self.lock:
+            self.entries.pop(path, None)
+
+    def clear(self):
+        """forget all entries"""
+        with self.lock:
+            self.entries.clear()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        with self.lock:
+            outfunc("Entries in attr_cache   : %s of %s" % (len(self.entries), self.maxentries))
+            outfunc("Attr hits / misses      : %s / %s" % (self.hits, self.misses))
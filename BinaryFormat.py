@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""
+on disk format of entries and sequences
+
+entry    : ENTRY_MAGIC, ENTRY_HEADER with stat fields and length
+           of digest, raw digest, empty for 0-byte files
+sequence : SEQUENCE_MAGIC2, SEQUENCE_HEADER with flags, nref, number
+           of blocks and length of digests, then one record of raw
+           digest and end offset of block for every block,
+           so block index is found with a seek, without reading all
+           version 1 with SEQUENCE_MAGIC has all raw digests and
+           then all end offsets, and is still read
+
+files written with cPickle before are still read
+"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import struct
+import cPickle
+import binascii
+
+from StatDefaultFile import StatDefaultFile as StatDefaultFile
+
+# magic string and format version
+ENTRY_MAGIC = "PZE\x01"
+SEQUENCE_MAGIC = "PZS\x01"
+SEQUENCE_MAGIC2 = "PZS\x02"
+# mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime, digest length
+ENTRY_HEADER = struct.Struct(">IQQIIIQdddB")
+# flags, nref, number of blocks, digest length
+SEQUENCE_HEADER = struct.Struct(">BQIB")
+# end offset of block
+END_OFFSET = struct.Struct(">Q")
+# sequence has block lengths, stored as end offsets,
+# without, blocks have fixed blocksize
+FLAG_LENGTHS = 1
+# sequence holds one block reference for every block in it,
+# without, only one for every distinct block
+FLAG_OCCURRENCE = 2
+
+
+def __time(value):
+    """times are stored as double, give back int if there was one"""
+    if value == int(value):
+        return(int(value))
+    return(value)
+
+def dumps_entry(digest, st):
+    """returns string of entry (digest, st), digest is hexdigest or 0"""
+    raw = ""
+    if digest != 0:
+        raw = binascii.unhexlify(digest)
+    return(ENTRY_MAGIC + ENTRY_HEADER.pack(st.st_mode, st.st_ino, st.st_dev,
+        st.st_nlink, st.st_uid, st.st_gid, st.st_size,
+        st.st_atime, st.st_mtime, st.st_ctime, len(raw)) + raw)
+
+def loads_entry(data):
+    """returns (digest, st) of string, binary or cPickle"""
+    if not data.startswith(ENTRY_MAGIC):
+        return(cPickle.loads(data))
+    start = len(ENTRY_MAGIC)
+    fields = ENTRY_HEADER.unpack_from(data, start)
+    st = StatDefaultFile()
+    (st.st_mode, st.st_ino, st.st_dev, st.st_nlink, st.st_uid, st.st_gid, st.st_size) = fields[:7]
+    st.st_atime = __time(fields[7])
+    st.st_mtime = __time(fields[8])
+    st.st_ctime = __time(fields[9])
+    start += ENTRY_HEADER.size
+    digest = 0
+    if fields[10] > 0:
+        digest = binascii.hexlify(data[start:start + fields[10]])
+    return((digest, st))
+
+def sequence_layout(header):
+    """
+    returns (flags, nref, count, digest_len, digest_start, ends_start, stride)
+    of the first bytes of a binary sequence, or None if it is not binary,
+    digest of block index starts at digest_start + index * stride,
+    end offset of block index at ends_start + index * stride
+    """
+    if header.startswith(SEQUENCE_MAGIC2):
+        start = len(SEQUENCE_MAGIC2)
+        (flags, nref, count, digest_len) = SEQUENCE_HEADER.unpack_from(header, start)
+        start += SEQUENCE_HEADER.size
+        return((flags, nref, count, digest_len, start, start + digest_len, digest_len + END_OFFSET.size))
+    if header.startswith(SEQUENCE_MAGIC):
+        start = len(SEQUENCE_MAGIC)
+        (flags, nref, count, digest_len) = SEQUENCE_HEADER.unpack_from(header, start)
+        start += SEQUENCE_HEADER.size
+        # version 1 has separate arrays
+        return((flags, nref, count, digest_len, start, start + count * digest_len, None))
+    return(None)
+
+def sequence_header(flags, nref, count, digest_len):
+    """returns header of binary sequence, records follow"""
+    return(SEQUENCE_MAGIC2 + SEQUENCE_HEADER.pack(flags, nref, count, digest_len))
+
+def sequence_record(digest, end):
+    """returns record of block with hexdigest, ending at file offset end"""
+    return(binascii.unhexlify(digest) + END_OFFSET.pack(end))
+
+def dumps_sequence(nref, sequence, lengths, flags=0):
+    """
+    returns string of sequence, a list of hexdigests,
+    lengths is list of block lengths or None for fixed blocksize
+    """
+    digest_len = 0
+    if len(sequence) > 0:
+        digest_len = len(sequence[0]) / 2
+    records = []
+    end = 0
+    for index in xrange(len(sequence)):
+        if lengths is not None:
+            end += lengths[index]
+        records.append(sequence_record(sequence[index], end))
+    if lengths is not None:
+        flags |= FLAG_LENGTHS
+    return(sequence_header(flags, nref, len(sequence), digest_len) + "".join(records))
+
+def loads_sequence(data):
+    """returns (nref, sequence, lengths) of string, binary or cPickle"""
+    layout = sequence_layout(data)
+    if layout is None:
+        record = cPickle.loads(data)
+        if len(record) == 2:
+            (nref, sequence) = record
+            return((nref, sequence, None))
+        return(record)
+    (flags, nref, count, digest_len, digest_start, ends_start, stride) = layout
+    if stride is None:
+        (digest_stride, ends_stride) = (digest_len, END_OFFSET.size)
+    else:
+        (digest_stride, ends_stride) = (stride, stride)
+    sequence = []
+    lengths = None
+    if flags & FLAG_LENGTHS:
+        lengths = []
+    end = 0
+    for index in xrange(count):
+        start = digest_start + index * digest_stride
+        sequence.append(binascii.hexlify(data[start:start + digest_len]))
+        if lengths is not None:
+            offset = END_OFFSET.unpack_from(data, ends_start + index * ends_stride)[0]
+            lengths.append(offset - end)
+            end = offset
+    return((nref, sequence, lengths))
+
+def update_sequence_nref(filename, nref):
+    """
+    change reference counter of binary sequence file in place,
+    returns False if file is not binary
+    """
+    rwfile = open(filename, "r+b")
+    header = rwfile.read(len(SEQUENCE_MAGIC2) + SEQUENCE_HEADER.size)
+    if sequence_layout(header) is None:
+        rwfile.close()
+        return(False)
+    (flags, old_nref, count, digest_len) = SEQUENCE_HEADER.unpack_from(header, len(SEQUENCE_MAGIC2))
+    rwfile.seek(len(SEQUENCE_MAGIC2))
+    rwfile.write(SEQUENCE_HEADER.pack(flags, nref, count, digest_len))
+    rwfile.close()
+    return(True)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockCache Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import logging
+import threading
+import collections
+
+
+class BlockCache(object):
+    """
+    least recently used cache of blocks, limited by sum of block lengths
+
+    blocks are named by their digest, so they never change
+    and cached data never gets stale
+    """
+
+    def __init__(self, maxbytes):
+        logging.debug("BlockCache.__init__(%s)", maxbytes)
+        self.maxbytes = maxbytes
+        # sum of length of cached blocks
+        self.size = 0
+        # digest -> data, least recently used first
+        self.blocks = collections.OrderedDict()
+        # digest -> threading.Event, for blocks being loaded right now
+        self.loading = {}
+        self.lock = threading.Lock()
+        # counters for report
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetches = 0
+
+    def get(self, digest, loader, prefetch=False):
+        """
+        return data of block digest, call loader(digest) if not cached
+
+        if another thread is loading the same block,
+        wait for it instead of loading the block twice,
+        loads for prefetch are not counted as miss
+        """
+        with self.lock:
+            if digest in self.blocks:
+                self.hits += 1
+                data = self.blocks.pop(digest)
+                self.blocks[digest] = data
+                return(data)
+            event = self.loading.get(digest)
+            if event is None:
+                if prefetch:
+                    self.prefetches += 1
+                else:
+                    self.misses += 1
+                event = threading.Event()
+                self.loading[digest] = event
+                owner = True
+            else:
+                if not prefetch:
+                    self.hits += 1
+                owner = False
+        if not owner:
+            event.wait()
+            with self.lock:
+                data = self.blocks.get(digest)
+            if data is None:
+                # loader failed or block is already evicted
+                data = loader(digest)
+            return(data)
+        data = None
+        try:
+            data = loader(digest)
+        finally:
+            with self.lock:
+                del self.loading[digest]
+                if data is not None:
+                    self.__put(digest, data)
+            event.set()
+        return(data)
+
+    def put(self, digest, data):
+        """add block to cache"""
+        with self.lock:
+            self.__put(digest, data)
+
+    def discard(self, digest):
+        """remove block from cache, if cached"""
+        with self.lock:
+            if digest in self.blocks:
+                self.size -= len(self.blocks.pop(digest))
+
+    def __put(self, digest, data):
+        """add block to cache, evict least recently used blocks, lock is held"""
+        if len(data) > self.maxbytes:
+            return
+        if digest in self.blocks:
+            self.size -= len(self.blocks.pop(digest))
+        self.blocks[digest] = data
+        self.size += len(data)
+        while self.size > self.maxbytes:
+            (old_digest, old_data) = self.blocks.popitem(last=False)
+            self.size -= len(old_data)
+            self.evictions += 1
+
+    def __contains__(self, digest):
+        """true if block is cached, does not count as hit"""
+        return(digest in self.blocks)
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        with self.lock:
+            outfunc("Blocks in block_cache   : %s" % len(self.blocks))
+            outfunc("Bytes in block_cache    : %s of %s" % (self.size, self.maxbytes))
+            outfunc("Cache hits / misses     : %s / %s" % (self.hits, self.misses))
+            outfunc("Cache evictions         : %s" % self.evictions)
+            outfunc("Blocks prefetched       : %s" % self.prefetches)
+            if self.hits + self.misses > 0:
+                outfunc("Cache hit ratio         : %0.3f" % (float(self.hits) / float(self.hits + self.misses)))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockStorage Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import logging
+import threading
+
+from BloomFilter import BloomFilter as BloomFilter
+
+# name of saved filter in db_path
+BLOOM_FILENAME = "blockfilter.bloom"
+
+
+class BlockStorageBloom(object):
+    """
+    answers exists() for new blocks from a BloomFilter in memory,
+    without asking any other BlockStorage, and put() of a new block
+    tells the BlockStorage below it is new, so it is not looked up there
+
+    the filter is saved at close, and loaded at next start,
+    if it was not saved, it is built again from all digests,
+    bits of deleted blocks are not cleared, they only cost a lookup
+    """
+
+    def __init__(self, block_storage, db_path, nbytes):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("BlockStorageBloom.__init__(%s, %s, %s)", block_storage, db_path, nbytes)
+        self.block_storage = block_storage
+        self.filename = os.path.join(db_path, BLOOM_FILENAME)
+        self.lock = threading.Lock()
+        # digest -> threading.Event, for new blocks being put right now
+        self.storing = {}
+        self.bloom_filter = BloomFilter.load(self.filename, nbytes)
+        if self.bloom_filter is None:
+            self.logger.info("building bloom filter of %s bytes", nbytes)
+            self.bloom_filter = build(block_storage, nbytes)
+            # not clean until close
+            self.bloom_filter.save(self.filename, False)
+        # counters for report
+        self.num_new = 0
+        self.num_probed = 0
+
+    def put(self, buf, digest):
+        """store block, without lookup if digest was never stored"""
+        with self.lock:
+            event = self.storing.get(digest)
+            new = (event is None) and (digest not in self.bloom_filter)
+            if new:
+                self.bloom_filter.add(digest)
+                event = threading.Event()
+                self.storing[digest] = event
+                self.num_new += 1
+        if new:
+            try:
+                self.block_storage.put(buf, digest, True)
+            finally:
+                with self.lock:
+                    del self.storing[digest]
+                event.set()
+            return
+        if event is not None:
+            # same new block is put by another thread, count it afterwards
+            event.wait()
+        self.block_storage.put(buf, digest)
+
+    def store(self, buf, digest):
+        """store block, without reference counter"""
+        with self.lock:
+            self.bloom_filter.add(digest)
+        self.block_storage.store(buf, digest)
+
+    def get(self, digest):
+        """get block"""
+        return(self.block_storage.get(digest))
+
+    def exists(self, digest):
+        """true if block exists, without lookup if digest was never stored"""
+        with self.lock:
+            if digest not in self.bloom_filter:
+                self.num_new += 1
+                return(False)
+            self.num_probed += 1
+        return(self.block_storage.exists(digest))
+
+    def delete(self, digest):
+        """delete reference to block"""
+        self.block_storage.delete(digest)
+
+    def nref(self, digest):
+        """returns reference counter of block"""
+        return(self.block_storage.nref(digest))
+
+    def update(self, counters):
+        """set reference counters of sorted list of (digest, nref)"""
+        self.block_storage.update(counters)
+
+    def digests(self):
+        """iterates over digests of all blocks"""
+        return(self.block_storage.digests())
+
+    def close(self):
+        """save filter, and close block_storage"""
+        with self.lock:
+            self.bloom_filter.save(self.filename)
+        self.block_storage.close()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        self.block_storage.report(outfunc)
+        with self.lock:
+            outfunc("Bloom filter            : %s bytes, %s digests added" % (len(self.bloom_filter.bits), self.bloom_filter.count))
+            outfunc("Lookups saved / done    : %s / %s" % (self.num_new, self.num_probed))
+
+
+def build(block_storage, nbytes):
+    """returns new BloomFilter of nbytes with all digests of block_storage"""
+    bloom_filter = BloomFilter(nbytes)
+    for digest in block_storage.digests():
+        bloom_filter.add(digest)
+    return(bloom_filter)
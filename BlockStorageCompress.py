@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockStorage Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import bz2
+import zlib
+import logging
+import threading
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# compressed blocks start with MAGIC and one byte codec
+MAGIC = "\x89PZ"
+# codec byte -> (name, compress(data, level), decompress(data))
+CODECS = {
+    "n" : ("none", lambda data, level: data, lambda data: data),
+    "z" : ("zlib", zlib.compress, zlib.decompress),
+    "b" : ("bz2", bz2.compress, bz2.decompress),
+}
+if lzma is not None:
+    CODECS["x"] = ("lzma", lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+# codec name -> codec byte
+CODEC_NAMES = dict((value[0], key) for (key, value) in CODECS.items())
+
+# length of every sample to test if block is compressible
+SAMPLE_SIZE = 4096
+# store block uncompressed, if sample does not shrink below this ratio
+MAX_RATIO = 0.9
+
+
+class BlockStorageCompress(object):
+    """
+    compresses blocks of any other BlockStorage
+
+    the codec is stored in front of every block, so codec and level
+    may change at any time, blocks without header are stored
+    uncompressed, as every BlockStorage without this wrapper does,
+    with codec none nothing is compressed, but blocks are still
+    uncompressed when read
+    """
+
+    def __init__(self, block_storage, codec="zlib", level=6):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("BlockStorageCompress.__init__(%s, %s, %s)" , block_storage, codec, level)
+        if codec not in CODEC_NAMES:
+            raise ValueError("compression %s is not available" % codec)
+        self.block_storage = block_storage
+        self.codec = CODEC_NAMES[codec]
+        self.level = level
+        self.lock = threading.Lock()
+        # counters for report
+        self.num_compressed = 0
+        self.num_skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def __compressible(self, buf):
+        """compress samples of start, middle and end of buf with fast zlib"""
+        if len(buf) <= 3 * SAMPLE_SIZE:
+            sample = buf
+        else:
+            middle = (len(buf) - SAMPLE_SIZE) / 2
+            sample = buf[:SAMPLE_SIZE] + buf[middle:middle + SAMPLE_SIZE] + buf[-SAMPLE_SIZE:]
+        return(len(zlib.compress(sample, 1)) < MAX_RATIO * len(sample))
+
+    def encode(self, buf):
+        """returns buf compressed with header, or uncompressed"""
+        if (self.codec != "n") and (len(buf) > 0) and self.__compressible(buf):
+            data = CODECS[self.codec][1](buf, self.level)
+            if len(data) + len(MAGIC) + 1 < len(buf):
+                with self.lock:
+                    self.num_compressed += 1
+                    self.bytes_in += len(buf)
+                    self.bytes_out += len(data) + len(MAGIC) + 1
+                return(MAGIC + self.codec + data)
+        with self.lock:
+            self.num_skipped += 1
+        if buf.startswith(MAGIC):
+            # uncompressed data looking like a header
+            return(MAGIC + "n" + buf)
+        return(buf)
+
+    def decode(self, data):
+        """returns uncompressed data"""
+        if data.startswith(MAGIC):
+            return(CODECS[data[len(MAGIC)]][2](data[len(MAGIC) + 1:]))
+        return(data)
+
+    def put(self, buf, digest):
+        """compress and store buf"""
+        self.logger.debug("BlockStorageCompress.put(<buf>, digest=%s)", digest)
+        if self.block_storage.exists(digest):
+            # only the reference counter is needed
+            self.block_storage.put(buf, digest)
+        else:
+            self.block_storage.put(self.encode(buf), digest)
+
+    def store(self, buf, digest):
+        """compress and store buf, without reference counter"""
+        self.logger.debug("BlockStorageCompress.store(<buf>, digest=%s)", digest)
+        self.block_storage.store(self.encode(buf), digest)
+
+    def get(self, digest):
+        """get and uncompress block"""
+        self.logger.debug("BlockStorageCompress.get(digest=%s)" , digest)
+        return(self.decode(self.block_storage.get(digest)))
+
+    def exists(self, digest):
+        """true if block exists"""
+        return(self.block_storage.exists(digest))
+
+    def delete(self, digest):
+        """delete reference to block"""
+        self.block_storage.delete(digest)
+
+    def nref(self, digest):
+        """returns reference counter of block"""
+        return(self.block_storage.nref(digest))
+
+    def update(self, counters):
+        """set reference counters of sorted list of (digest, nref)"""
+        self.block_storage.update(counters)
+
+    def digests(self):
+        """iterates over digests of all blocks"""
+        return(self.block_storage.digests())
+
+    def close(self):
+        """close block_storage"""
+        self.block_storage.close()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        self.block_storage.report(outfunc)
+        with self.lock:
+            outfunc("Compression             : %s level %s" % (CODECS[self.codec][0], self.level))
+            outfunc("Blocks compressed       : %s" % self.num_compressed)
+            outfunc("Blocks not compressible : %s" % self.num_skipped)
+            if self.bytes_in > 0:
+                outfunc("Compression Ratio       : %0.3f" % (float(self.bytes_out) / float(self.bytes_in)))
@@ -24,35 +24,46 @@ __date__ = "$Date$"
 # $Id
 
 import os
+import errno
 import logging
+import threading
 
 
 class BlockStorageFile(object):
     """Object to handle blocks of data"""
 
-    def __init__(self, db_path, block_path):
+    def __init__(self, db_path, block_path, readonly=False):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.ERROR)
-        self.logger.debug("BlockStorage.__init__(%s, %s)" , db_path, block_path)
+        self.logger.debug("BlockStorage.__init__(%s, %s, %s)" , db_path, block_path, readonly)
+        # nothing is opened, so readonly makes no difference
         self.block_path = block_path
+        # fuse runs multithreaded, reference counters are read-modify-write
+        self.lock = threading.Lock()
 
-    def put(self, buf, digest):
-        """writes buf to filename <hexdigest>"""
+    def put(self, buf, digest, new=False):
+        """
+        writes buf to filename <hexdigest>, returns True if block is new,
+        with new the caller knows the block is not stored, so it is not looked up
+        """
         self.logger.debug("BlockStorage.put(<buf>, digest=%s)", digest)
-        filename = os.path.join(self.block_path, "%s.dmp" % digest)
-        ifo_filename = os.path.join(self.block_path, "%s.ifo" % digest)
-        if os.path.isfile(filename):
-            # blockref counter up
-            self.logger.debug("BlockStorage.put: duplicate found")
-            # reference counter up by one
-            nref = int(open(ifo_filename).read()) + 1
-            # write it back
-            open(ifo_filename, "wb").write(str(nref))
-        else:
-            # block is written the first time
-            self.logger.debug("BlockStorage.put: new block")
-            open(filename, "wb").write(buf)
-            open(ifo_filename, "wb").write("1")    
+        with self.lock:
+            filename = os.path.join(self.block_path, "%s.dmp" % digest)
+            ifo_filename = os.path.join(self.block_path, "%s.ifo" % digest)
+            if (not new) and os.path.isfile(filename):
+                # blockref counter up
+                self.logger.debug("BlockStorage.put: duplicate found")
+                # reference counter up by one
+                nref = int(open(ifo_filename).read()) + 1
+                # write it back
+                open(ifo_filename, "wb").write(str(nref))
+                return(False)
+            else:
+                # block is written the first time
+                self.logger.debug("BlockStorage.put: new block")
+                open(filename, "wb").write(buf)
+                open(ifo_filename, "wb").write("1")
+                return(True)
 
     def get(self, digest):
         """reads data from filename <hexdigest>"""
@@ -69,28 +80,105 @@ class BlockStorageFile(object):
         return(os.path.isfile(filename))
 
     def delete(self, digest):
-        """if last reference delete block, else delete only reference"""
+        """
+        if last reference delete block, else delete only reference,
+        returns stored bytes of deleted block, None if it is kept
+        """
         self.logger.debug("BlockStorage.delete(digest=%s)" , digest)
+        with self.lock:
+            filename = os.path.join(self.block_path, "%s.dmp" % digest)
+            ifo_filename = os.path.join(self.block_path, "%s.ifo" % digest)
+            if os.path.isfile(filename):
+                nref = int(open(ifo_filename).read())
+                if nref == 1:
+                    size = os.path.getsize(filename)
+                    os.unlink(filename)
+                    os.unlink(ifo_filename)
+                    return(size)
+                else:
+                    # reference counter down by one
+                    open(ifo_filename, "wb").write(str(nref -1))
+        return(None)
+
+    def store(self, buf, digest):
+        """
+        writes buf to filename <hexdigest>.dmp, without reference counter,
+        returns stored bytes of replaced data, None if block is new
+        """
+        self.logger.debug("BlockStorage.store(<buf>, digest=%s)", digest)
         filename = os.path.join(self.block_path, "%s.dmp" % digest)
+        old_size = None
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            # data of an existing block is replaced
+            old_size = os.path.getsize(filename)
+            fd = os.open(filename, os.O_WRONLY | os.O_TRUNC)
+        wfile = os.fdopen(fd, "wb")
+        wfile.write(buf)
+        wfile.close()
+        return(old_size)
+
+    def size(self, digest):
+        """returns length of stored data of block"""
+        return(os.path.getsize(os.path.join(self.block_path, "%s.dmp" % digest)))
+
+    def nref(self, digest):
+        """returns reference counter of block, 0 if unknown"""
         ifo_filename = os.path.join(self.block_path, "%s.ifo" % digest)
-        if os.path.isfile(filename):
-            nref = int(open(ifo_filename).read())
-            if nref == 1:
-                os.unlink(filename)
-                os.unlink(ifo_filename)
-            else:
-                # reference counter down by one
-                open(ifo_filename).write(str(nref -1))
+        if os.path.isfile(ifo_filename):
+            return(int(open(ifo_filename).read()))
+        return(0)
+
+    def update(self, counters):
+        """
+        set reference counters of sorted list of (digest, nref),
+        blocks with nref 0 are deleted,
+        returns (number, stored bytes) of deleted blocks
+        """
+        self.logger.debug("BlockStorage.update(<%d counters>)", len(counters))
+        (nblocks, nbytes) = (0, 0)
+        with self.lock:
+            for (digest, nref) in counters:
+                ifo_filename = os.path.join(self.block_path, "%s.ifo" % digest)
+                if nref > 0:
+                    open(ifo_filename, "wb").write(str(nref))
+                else:
+                    filename = os.path.join(self.block_path, "%s.dmp" % digest)
+                    if os.path.isfile(filename):
+                        nblocks += 1
+                        nbytes += os.path.getsize(filename)
+                        os.unlink(filename)
+                    if os.path.isfile(ifo_filename):
+                        os.unlink(ifo_filename)
+        return((nblocks, nbytes))
+
+    def digests(self):
+        """
+        iterates over digests of all blocks,
+        with reference counter or only stored
+        """
+        keys = set()
+        for filename in os.listdir(self.block_path):
+            if filename.endswith(".dmp") or filename.endswith(".ifo"):
+                keys.add(filename[:-4])
+        return(iter(keys))
+
+    def close(self):
+        """nothing to close"""
+        pass
 
     def report(self, outfunc):
         """prints report with outfunc"""
         num_stored = 0
         num_blocks = 0
-        for filename in os.path.listdir(self.block_path):
-            if filename.name[-3:] == "dmp":
+        for filename in os.listdir(self.block_path):
+            if filename[-3:] == "dmp":
                 num_blocks += 1
-            if filename.name[-3:] == "ifo":
-                num_stored += int(open(os.path.join(self.block_path, filename).read()))
+            if filename[-3:] == "ifo":
+                num_stored += int(open(os.path.join(self.block_path, filename)).read())
         outfunc("Blocks in block_storage : %s" % num_blocks)
         outfunc("de-dedupped blocks      : %s" % num_stored)
         if num_blocks > 0:
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockStorage Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import logging
+import threading
+
+
+class BlockStorageJournal(object):
+    """
+    collects changes of reference counters of any other BlockStorage
+
+    put and delete only change a counter in memory, and append
+    the change to an intent log, new blocks are stored at once,
+    but without counter, every interval seconds or every maxdeltas
+    digests the counters are written in one sorted batch
+
+    a batch is written as file with absolute counters before it is
+    applied, so applying it again after a crash gives the same result,
+    logs of batches not yet written are replayed at startup
+
+    with readonly the logs and batches left are only read, nref
+    returns the counters they would give, and nothing is written
+    """
+
+    def __init__(self, block_storage, journal_path, interval=5, maxdeltas=65536, readonly=False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("BlockStorageJournal.__init__(%s, %s, %s, %s, %s)", block_storage, journal_path, interval, maxdeltas, readonly)
+        self.block_storage = block_storage
+        self.journal_path = journal_path
+        self.interval = interval
+        self.maxdeltas = maxdeltas
+        self.readonly = readonly
+        # digest -> counter of logs and batches left, only if readonly
+        self.recovered = {}
+        self.lock = threading.Lock()
+        # digest -> sum of changes of reference counter not yet written
+        self.deltas = {}
+        # digest -> threading.Event, for new blocks being stored right now
+        self.storing = {}
+        # counters for report
+        self.num_changes = 0
+        self.num_commits = 0
+        # apply what is left from last run
+        self.serial = self.__recover()
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.log = None
+        self.thread = None
+        if readonly:
+            return
+        self.log = open(self.__filename(self.serial, "log"), "ab")
+        # background commit
+        self.thread = threading.Thread(target=self.__do_commit)
+        # set to daemon thread, so main thread can exit
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __filename(self, serial, kind):
+        """filename of log or batch with serial"""
+        return(os.path.join(self.journal_path, "refjournal-%08d.%s" % (serial, kind)))
+
+    def __serials(self, kind):
+        """sorted list of serials of existing logs or batches"""
+        serials = []
+        for filename in os.listdir(self.journal_path):
+            if filename.startswith("refjournal-") and filename.endswith("." + kind):
+                serials.append(int(filename[11:-len(kind) - 1]))
+        serials.sort()
+        return(serials)
+
+    def __recover(self):
+        """
+        turn logs into batches, apply all batches,
+        returns serial for next log,
+        with readonly only self.recovered is filled
+        """
+        logs = self.__serials("log")
+        # serial -> counters of logs, which are not written as batch
+        unwritten = {}
+        for serial in logs:
+            if not os.path.isfile(self.__filename(serial, "batch")):
+                deltas = {}
+                for line in open(self.__filename(serial, "log"), "rb"):
+                    if not line.endswith("\n"):
+                        # incomplete last line, written while crashing
+                        break
+                    (digest, delta) = line.split()
+                    deltas[digest] = deltas.get(digest, 0) + int(delta)
+                self.logger.info("replaying %d changes of log %d", len(deltas), serial)
+                if self.readonly:
+                    unwritten[serial] = self.__counters(deltas)
+                else:
+                    self.__write_batch(serial, deltas)
+            if not self.readonly:
+                os.unlink(self.__filename(serial, "log"))
+        batches = self.__serials("batch")
+        for serial in sorted(set(batches + unwritten.keys())):
+            counters = unwritten.pop(serial, None)
+            if counters is None:
+                counters = []
+                for line in open(self.__filename(serial, "batch"), "rb"):
+                    (digest, nref) = line.split()
+                    counters.append((digest, int(nref)))
+            if self.readonly:
+                self.recovered.update(counters)
+            else:
+                self.block_storage.update(counters)
+                os.unlink(self.__filename(serial, "batch"))
+        return(max([0] + logs + batches) + 1)
+
+    def __counters(self, deltas):
+        """returns sorted list of (digest, nref), absolute counters of deltas"""
+        counters = []
+        for digest in sorted(deltas.keys()):
+            # a block stored and deleted in the same batch has nref 0,
+            # and is deleted too
+            nref = self.block_storage.nref(digest) + deltas[digest]
+            if nref < 0:
+                self.logger.error("reference counter of %s below zero", digest)
+                nref = 0
+            counters.append((digest, nref))
+        return(counters)
+
+    def __write_batch(self, serial, deltas):
+        """
+        compute absolute counters of deltas and write them to batch file,
+        returns sorted list of (digest, nref)
+        """
+        counters = self.__counters(deltas)
+        filename = self.__filename(serial, "batch")
+        wfile = open(filename + ".tmp", "wb")
+        for (digest, nref) in counters:
+            wfile.write("%s %d\n" % (digest, nref))
+        wfile.flush()
+        os.fsync(wfile.fileno())
+        wfile.close()
+        os.rename(filename + ".tmp", filename)
+        return(counters)
+
+    def __record(self, digest, delta):
+        """remember change of reference counter, lock is held"""
+        self.deltas[digest] = self.deltas.get(digest, 0) + delta
+        self.log.write("%s %d\n" % (digest, delta))
+        # hand over to os, so a crash of this process loses nothing
+        self.log.flush()
+        self.num_changes += 1
+        if len(self.deltas) >= self.maxdeltas:
+            self.__commit()
+
+    def __commit(self):
+        """write collected changes in one batch, lock is held"""
+        if len(self.deltas) == 0:
+            return
+        self.logger.debug("BlockStorageJournal.__commit() %d digests", len(self.deltas))
+        self.log.close()
+        counters = self.__write_batch(self.serial, self.deltas)
+        # batch holds all changes of log now
+        os.unlink(self.__filename(self.serial, "log"))
+        self.block_storage.update(counters)
+        os.unlink(self.__filename(self.serial, "batch"))
+        self.deltas = {}
+        self.num_commits += 1
+        self.serial += 1
+        self.log = open(self.__filename(self.serial, "log"), "ab")
+
+    def __do_commit(self):
+        """commit thread, writes changes every interval seconds"""
+        while not self.stopped:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                with self.lock:
+                    if not self.stopped:
+                        self.__commit()
+            except StandardError, exc:
+                self.logger.exception(exc)
+
+    def commit(self):
+        """write collected changes now"""
+        with self.lock:
+            self.__commit()
+
+    def put(self, buf, digest):
+        """store buf if digest is new, and count reference"""
+        self.logger.debug("BlockStorageJournal.put(<buf>, digest=%s)", digest)
+        while True:
+            with self.lock:
+                event = self.storing.get(digest)
+                if event is None:
+                    if (digest in self.deltas) or self.block_storage.exists(digest):
+                        self.__record(digest, 1)
+                        return
+                    event = threading.Event()
+                    self.storing[digest] = event
+                    owner = True
+                else:
+                    owner = False
+            if not owner:
+                # same block is stored by another thread, look again afterwards
+                event.wait()
+                continue
+            try:
+                self.block_storage.store(buf, digest)
+                with self.lock:
+                    self.__record(digest, 1)
+            finally:
+                with self.lock:
+                    del self.storing[digest]
+                event.set()
+            return
+
+    def store(self, buf, digest):
+        """store block again, reference counter is not changed"""
+        self.block_storage.store(buf, digest)
+
+    def get(self, digest):
+        """get block"""
+        return(self.block_storage.get(digest))
+
+    def exists(self, digest):
+        """true if block exists, or will exist with next commit"""
+        with self.lock:
+            return((digest in self.deltas) or (digest in self.storing) or self.block_storage.exists(digest))
+
+    def delete(self, digest):
+        """delete reference to block, with the last one the block is deleted"""
+        self.logger.debug("BlockStorageJournal.delete(digest=%s)", digest)
+        with self.lock:
+            self.__record(digest, -1)
+
+    def size(self, digest):
+        """returns length of stored data of block"""
+        return(self.block_storage.size(digest))
+
+    def nref(self, digest):
+        """returns reference counter of block, including changes not written"""
+        with self.lock:
+            if digest in self.recovered:
+                return(self.recovered[digest])
+            return(self.block_storage.nref(digest) + self.deltas.get(digest, 0))
+
+    def update(self, counters):
+        """set reference counters of sorted list of (digest, nref)"""
+        with self.lock:
+            self.__commit()
+            self.block_storage.update(counters)
+
+    def digests(self):
+        """iterates over digests of all blocks"""
+        if self.readonly:
+            # counters of the journal not yet in block_storage
+            keys = set(self.block_storage.digests())
+            keys.update(self.recovered.keys())
+            return(iter(keys))
+        return(self.block_storage.digests())
+
+    def close(self):
+        """write collected changes, and close block_storage"""
+        if self.readonly:
+            self.block_storage.close()
+            return
+        # commit thread is stopped first, so it never commits into a closed log
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        with self.lock:
+            self.__commit()
+            self.log.close()
+            # nothing was logged, so leave no empty log behind
+            os.unlink(self.__filename(self.serial, "log"))
+            self.block_storage.close()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        self.block_storage.report(outfunc)
+        with self.lock:
+            outfunc("Counter changes         : %s" % self.num_changes)
+            outfunc("Counter batches written : %s" % self.num_commits)
+            outfunc("Digests not yet written : %s" % len(self.deltas))
@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockStorage Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import gdbm
+import struct
+import logging
+import threading
+
+# every block in a pack file starts with this header,
+# followed by digest and data
+RECORD_HEADER = struct.Struct(">HI")
+
+
+class BlockStoragePack(object):
+    """
+    Object to handle blocks of data
+    this version appends blocks to big pack files,
+    and stores pack, offset, length and reference counter in gdbm database
+
+    space of deleted blocks is counted per pack file, packs with
+    more than repack_ratio dead bytes are rewritten in background
+    """
+
+    def __init__(self, db_path, block_path, maxpacksize=128 * 1024 * 1024, repack_ratio=0.5, readonly=False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("BlockStorage.__init__(%s, %s, %s)" , db_path, block_path, readonly)
+        self.block_path = block_path
+        # fuse runs multithreaded, reference counters are read-modify-write
+        self.lock = threading.Lock()
+        # only one repack at a time, thread or caller of repack
+        self.repack_lock = threading.Lock()
+        self.maxpacksize = maxpacksize
+        self.repack_ratio = repack_ratio
+        # holds mapping digest to "pack offset length nref",
+        # readonly may be opened by several processes at once
+        mode = "c"
+        if readonly:
+            mode = "r"
+        self.db = gdbm.open(os.path.join(db_path, "blockpack.gdbm"), mode)
+        # holds mapping pack number to number of dead bytes
+        self.deaddb = gdbm.open(os.path.join(db_path, "blockpackdead.gdbm"), mode)
+        # append to the pack with highest number
+        packs = self.__packs()
+        self.pack = 0
+        if len(packs) > 0:
+            self.pack = packs[-1]
+        self.wfile = None
+        self.readonly = readonly
+        if readonly:
+            # nothing is appended or repacked
+            return
+        self.__open_pack(self.pack)
+        # background repacking, started by dead bytes over repack_ratio
+        self.stopped = False
+        self.repack_event = threading.Event()
+        self.thread = threading.Thread(target=self.__do_repack)
+        # set to daemon thread, so main thread can exit
+        self.thread.setDaemon(True)
+        self.thread.start()
+        # packs left over repack_ratio by the last run
+        if len(self.__candidates(self.repack_ratio)) > 0:
+            self.repack_event.set()
+
+    def __packs(self):
+        """sorted list of existing pack numbers"""
+        packs = []
+        for filename in os.listdir(self.block_path):
+            if filename.startswith("pack-") and filename.endswith(".pack"):
+                packs.append(int(filename[5:-5]))
+        packs.sort()
+        return(packs)
+
+    def __pack_filename(self, pack):
+        """filename of pack number pack"""
+        return(os.path.join(self.block_path, "pack-%08d.pack" % pack))
+
+    def __open_pack(self, pack):
+        """open pack for appending, lock is held or in __init__"""
+        if self.wfile is not None:
+            self.wfile.close()
+        self.pack = pack
+        filename = self.__pack_filename(pack)
+        created = not os.path.isfile(filename)
+        self.wfile = open(filename, "ab")
+        self.wfile.seek(0, os.SEEK_END)
+        if created:
+            # the index may point into the new pack at once
+            self.__fsync_dir()
+
+    def __fsync_pack(self):
+        """write appended blocks to disk, lock is held"""
+        self.wfile.flush()
+        os.fsync(self.wfile.fileno())
+
+    def __fsync_dir(self):
+        """write directory of packs to disk, so new packs are found after a crash"""
+        fd = os.open(self.block_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def __append(self, buf, digest):
+        """append block to pack, returns (pack, offset), lock is held"""
+        if self.wfile.tell() >= self.maxpacksize:
+            self.__open_pack(self.pack + 1)
+        offset = self.wfile.tell()
+        self.wfile.write(RECORD_HEADER.pack(len(digest), len(buf)))
+        self.wfile.write(digest)
+        self.wfile.write(buf)
+        # readers use their own file objects, and the index
+        # written next must not point to data lost by a crash
+        self.__fsync_pack()
+        return((self.pack, offset))
+
+    def __get_location(self, digest):
+        """returns (pack, offset, length, nref) of block, lock is held"""
+        return([int(value) for value in self.db[digest].split()])
+
+    def __set_location(self, digest, pack, offset, length, nref):
+        """store location and reference counter, lock is held"""
+        self.db[digest] = "%d %d %d %d" % (pack, offset, length, nref)
+
+    def put(self, buf, digest, new=False):
+        """
+        appends buf to pack file, if digest is new, returns True if block is new,
+        with new the caller knows the block is not stored, so it is not looked up
+        """
+        self.logger.debug("BlockStorage.put(<buf>, digest=%s)", digest)
+        with self.lock:
+            if (not new) and self.db.has_key(digest):
+                # blockref counter up
+                self.logger.debug("BlockStorage.put: duplicate found")
+                (pack, offset, length, nref) = self.__get_location(digest)
+                self.__set_location(digest, pack, offset, length, nref + 1)
+                return(False)
+            else:
+                # write if this is the first block
+                self.logger.debug("BlockStorage.put: new block")
+                (pack, offset) = self.__append(buf, digest)
+                self.__set_location(digest, pack, offset, len(buf), 1)
+                return(True)
+
+    def get(self, digest):
+        """reads data of digest from pack file"""
+        self.logger.debug("BlockStorage.get(digest=%s)" , digest)
+        # repacking may move the block between lookup and read, so try twice
+        for retry in (True, False):
+            with self.lock:
+                (pack, offset, length, nref) = self.__get_location(digest)
+            try:
+                rfile = open(self.__pack_filename(pack), "rb")
+            except IOError:
+                if retry:
+                    continue
+                raise
+            rfile.seek(offset + RECORD_HEADER.size + len(digest))
+            data = rfile.read(length)
+            rfile.close()
+            return(data)
+
+    def exists(self, digest):
+        """true if block exists"""
+        self.logger.debug("BlockStorage.exists(digest=%s)" , digest)
+        with self.lock:
+            return(self.db.has_key(digest))
+
+    def delete(self, digest):
+        """
+        if last reference count space as dead, else delete only reference,
+        returns stored bytes of deleted block, None if it is kept
+        """
+        self.logger.debug("BlockStorage.delete(digest=%s)" , digest)
+        with self.lock:
+            if self.db.has_key(digest):
+                (pack, offset, length, nref) = self.__get_location(digest)
+                if nref == 1:
+                    del self.db[digest]
+                    self.__add_dead(pack, RECORD_HEADER.size + len(digest) + length)
+                    return(length)
+                else:
+                    # reference counter down by one
+                    self.__set_location(digest, pack, offset, length, nref - 1)
+        return(None)
+
+    def store(self, buf, digest):
+        """
+        appends buf to pack file, without reference counter,
+        data of an existing block is replaced, its counter is kept,
+        returns stored bytes of replaced data, None if block is new
+        """
+        self.logger.debug("BlockStorage.store(<buf>, digest=%s)", digest)
+        with self.lock:
+            nref = 0
+            old_size = None
+            if self.db.has_key(digest):
+                (pack, offset, old_size, nref) = self.__get_location(digest)
+                self.__add_dead(pack, RECORD_HEADER.size + len(digest) + old_size)
+            (pack, offset) = self.__append(buf, digest)
+            self.__set_location(digest, pack, offset, len(buf), nref)
+            return(old_size)
+
+    def size(self, digest):
+        """returns length of stored data of block"""
+        with self.lock:
+            return(self.__get_location(digest)[2])
+
+    def nref(self, digest):
+        """returns reference counter of block, 0 if unknown"""
+        with self.lock:
+            if self.db.has_key(digest):
+                return(self.__get_location(digest)[3])
+            return(0)
+
+    def update(self, counters):
+        """
+        set reference counters of sorted list of (digest, nref),
+        space of blocks with nref 0 is counted as dead, index is synced once,
+        returns (number, stored bytes) of deleted blocks
+        """
+        self.logger.debug("BlockStorage.update(<%d counters>)", len(counters))
+        (nblocks, nbytes) = (0, 0)
+        with self.lock:
+            for (digest, nref) in counters:
+                if self.db.has_key(digest):
+                    (pack, offset, length, old_nref) = self.__get_location(digest)
+                    if nref > 0:
+                        self.__set_location(digest, pack, offset, length, nref)
+                    else:
+                        del self.db[digest]
+                        self.__add_dead(pack, RECORD_HEADER.size + len(digest) + length)
+                        nblocks += 1
+                        nbytes += length
+            self.db.sync()
+            self.deaddb.sync()
+        return((nblocks, nbytes))
+
+    def digests(self):
+        """iterates over digests of all blocks"""
+        with self.lock:
+            keys = self.db.keys()
+        return(iter(keys))
+
+    def close(self):
+        """stop repack thread, close pack and databases"""
+        if not self.readonly:
+            self.stopped = True
+            self.repack_event.set()
+            self.thread.join()
+        with self.lock:
+            if self.wfile is not None:
+                self.wfile.close()
+            self.db.close()
+            self.deaddb.close()
+
+    def __add_dead(self, pack, nbytes):
+        """count dead bytes of pack, lock is held"""
+        key = str(pack)
+        dead = nbytes
+        if self.deaddb.has_key(key):
+            dead += int(self.deaddb[key])
+        self.deaddb[key] = str(dead)
+        if (not self.readonly) and (pack != self.pack) and \
+                (dead > self.repack_ratio * os.path.getsize(self.__pack_filename(pack))):
+            self.repack_event.set()
+
+    def __do_repack(self):
+        """repack thread, waits for packs with too many dead bytes"""
+        while True:
+            self.repack_event.wait()
+            self.repack_event.clear()
+            if self.stopped:
+                break
+            try:
+                self.repack()
+            except StandardError, exc:
+                self.logger.exception(exc)
+
+    def repack(self, ratio=None):
+        """
+        rewrite every pack with more than ratio dead bytes,
+        live blocks are appended to the actual pack,
+        then the old pack is deleted
+        """
+        if ratio is None:
+            ratio = self.repack_ratio
+        with self.repack_lock:
+            with self.lock:
+                candidates = self.__candidates(ratio)
+            for pack in candidates:
+                if (not self.readonly) and self.stopped:
+                    # close waits, the rest is repacked after next open
+                    break
+                self.__repack(pack)
+
+    def __candidates(self, ratio):
+        """list of packs with more than ratio dead bytes, lock is held or in __init__"""
+        candidates = []
+        for key in self.deaddb.keys():
+            pack = int(key)
+            filename = self.__pack_filename(pack)
+            if (pack != self.pack) and os.path.isfile(filename) and \
+                    (int(self.deaddb[key]) > ratio * os.path.getsize(filename)):
+                candidates.append(pack)
+        return(candidates)
+
+    def __repack(self, pack):
+        """move live blocks of pack to the actual pack, and delete it"""
+        self.logger.info("repacking pack %d", pack)
+        filename = self.__pack_filename(pack)
+        rfile = open(filename, "rb")
+        offset = 0
+        while True:
+            header = rfile.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            (digest_len, length) = RECORD_HEADER.unpack(header)
+            digest = rfile.read(digest_len)
+            buf = rfile.read(length)
+            # lock every block, so fuse has not to wait for the whole pack
+            with self.lock:
+                if self.db.has_key(digest):
+                    (old_pack, old_offset, old_length, nref) = self.__get_location(digest)
+                    if (old_pack == pack) and (old_offset == offset):
+                        # block is alive, move it
+                        (new_pack, new_offset) = self.__append(buf, digest)
+                        self.__set_location(digest, new_pack, new_offset, length, nref)
+            offset += RECORD_HEADER.size + digest_len + length
+        rfile.close()
+        with self.lock:
+            # moved blocks are synced by __append, the index pointing
+            # to them and new packs must be on disk, before old pack is gone
+            self.db.sync()
+            self.__fsync_dir()
+            os.unlink(filename)
+            key = str(pack)
+            if self.deaddb.has_key(key):
+                del self.deaddb[key]
+            self.deaddb.sync()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        with self.lock:
+            num_stored = 0
+            num_blocks = len(self.db)
+            for key in self.db.keys():
+                num_stored += self.__get_location(key)[3]
+            num_packs = 0
+            pack_bytes = 0
+            for pack in self.__packs():
+                num_packs += 1
+                pack_bytes += os.path.getsize(self.__pack_filename(pack))
+            dead_bytes = 0
+            for key in self.deaddb.keys():
+                dead_bytes += int(self.deaddb[key])
+            outfunc("Blocks in block_storage : %s" % num_blocks)
+            outfunc("de-dedupped blocks      : %s" % num_stored)
+            if num_blocks > 0:
+                    outfunc("Dedup Value         : %0.3f" % (float(num_stored) / float(num_blocks)))
+            outfunc("Pack files              : %s" % num_packs)
+            outfunc("Bytes in pack files     : %s" % pack_bytes)
+            outfunc("Dead bytes to repack    : %s" % dead_bytes)
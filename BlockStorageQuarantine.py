@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockStorage Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import errno
+import logging
+import tempfile
+import threading
+
+# list of quarantined digests in db_path
+QUARANTINE_FILENAME = "quarantine.list"
+
+
+class BlockStorageQuarantine(object):
+    """
+    refuses to return blocks found corrupted, until they are healed
+
+    get() raises IOError EIO for quarantined blocks, instead of
+    returning wrong data, when a quarantined block is written again,
+    its data is stored again and it leaves quarantine,
+    quarantined digests are kept in db_path, evict(digest) is called
+    for every quarantined block, to drop it from caches above
+    """
+
+    def __init__(self, block_storage, db_path, evict=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("BlockStorageQuarantine.__init__(%s, %s, %s)", block_storage, db_path, evict)
+        self.block_storage = block_storage
+        self.db_path = db_path
+        self.evict = evict
+        self.filename = os.path.join(db_path, QUARANTINE_FILENAME)
+        self.lock = threading.Lock()
+        self.quarantined = set()
+        if os.path.isfile(self.filename):
+            self.quarantined.update(open(self.filename, "rb").read().split())
+        # counters for report
+        self.num_healed = 0
+
+    def __save(self):
+        """write list of quarantined digests, lock is held"""
+        (fd, tmpname) = tempfile.mkstemp(dir=self.db_path)
+        wfile = os.fdopen(fd, "wb")
+        for digest in sorted(self.quarantined):
+            wfile.write(digest + "\n")
+        wfile.close()
+        os.rename(tmpname, self.filename)
+
+    def quarantine(self, digest):
+        """block data does not match digest, do not return it any more"""
+        self.logger.error("block %s is corrupted, quarantined", digest)
+        with self.lock:
+            self.quarantined.add(digest)
+            self.__save()
+        # after it is quarantined, so it is not loaded again
+        if self.evict is not None:
+            self.evict(digest)
+
+    def is_quarantined(self, digest):
+        """true if block is in quarantine"""
+        return(digest in self.quarantined)
+
+    def put(self, buf, digest):
+        """store block, data of a quarantined block is stored again"""
+        with self.lock:
+            if digest in self.quarantined:
+                self.logger.error("block %s is written again, healed", digest)
+                self.block_storage.store(buf, digest)
+                self.quarantined.discard(digest)
+                self.__save()
+                self.num_healed += 1
+        self.block_storage.put(buf, digest)
+
+    def get(self, digest):
+        """get block, if not quarantined"""
+        if digest in self.quarantined:
+            raise IOError(errno.EIO, "block %s is corrupted" % digest)
+        return(self.block_storage.get(digest))
+
+    def exists(self, digest):
+        """true if block exists"""
+        return(self.block_storage.exists(digest))
+
+    def delete(self, digest):
+        """delete reference to block"""
+        self.block_storage.delete(digest)
+
+    def nref(self, digest):
+        """returns reference counter of block"""
+        return(self.block_storage.nref(digest))
+
+    def update(self, counters):
+        """set reference counters of sorted list of (digest, nref)"""
+        self.block_storage.update(counters)
+
+    def digests(self):
+        """iterates over digests of all blocks"""
+        return(self.block_storage.digests())
+
+    def close(self):
+        """close block_storage"""
+        self.block_storage.close()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        self.block_storage.report(outfunc)
+        with self.lock:
+            outfunc("Blocks in quarantine    : %s" % len(self.quarantined))
+            outfunc("Blocks healed           : %s" % self.num_healed)
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockStorage Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import time
+import logging
+
+
+class BlockStorageStats(object):
+    """
+    records latency of every call of another BlockStorage in Stats,
+    as operations block_get, block_put, block_store, block_delete
+    and block_update
+    """
+
+    def __init__(self, block_storage, stats):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("BlockStorageStats.__init__(%s, %s)", block_storage, stats)
+        self.block_storage = block_storage
+        self.stats = stats
+
+    def __timed(self, name, method, *args):
+        """call method with args, and record it as operation name"""
+        start = time.time()
+        error = True
+        try:
+            result = method(*args)
+            error = False
+            return(result)
+        finally:
+            self.stats.record(name, time.time() - start, error)
+
+    def put(self, buf, digest, new=False):
+        """store block"""
+        return(self.__timed("block_put", self.block_storage.put, buf, digest, new))
+
+    def store(self, buf, digest):
+        """store block, without reference counter"""
+        return(self.__timed("block_store", self.block_storage.store, buf, digest))
+
+    def get(self, digest):
+        """get block"""
+        return(self.__timed("block_get", self.block_storage.get, digest))
+
+    def exists(self, digest):
+        """true if block exists"""
+        return(self.block_storage.exists(digest))
+
+    def delete(self, digest):
+        """delete reference to block"""
+        return(self.__timed("block_delete", self.block_storage.delete, digest))
+
+    def size(self, digest):
+        """returns length of stored data of block"""
+        return(self.block_storage.size(digest))
+
+    def nref(self, digest):
+        """returns reference counter of block"""
+        return(self.block_storage.nref(digest))
+
+    def update(self, counters):
+        """set reference counters of sorted list of (digest, nref)"""
+        return(self.__timed("block_update", self.block_storage.update, counters))
+
+    def digests(self):
+        """iterates over digests of all blocks"""
+        return(self.block_storage.digests())
+
+    def close(self):
+        """close block_storage"""
+        self.block_storage.close()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        self.block_storage.report(outfunc)
@@ -24,8 +24,10 @@ __date__ = "$Date$"
 # $Id
 
 import os
+import errno
 import pytc
 import logging
+import threading
 
 
 class BlockStorageTokyoCabinet(object):
@@ -35,31 +37,43 @@ class BlockStorageTokyoCabinet(object):
     and blocks in filesystem
     """
 
-    def __init__(self, db_path, block_path):
+    def __init__(self, db_path, block_path, readonly=False):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.ERROR)
-        self.logger.debug("BlockStorage.__init__(%s, %s)" , db_path, block_path)
+        self.logger.debug("BlockStorage.__init__(%s, %s, %s)" , db_path, block_path, readonly)
         self.block_path = block_path
+        # fuse runs multithreaded, reference counters are read-modify-write
+        self.lock = threading.Lock()
         # block reference, to check if block is used
-        # holds mapping digest to number of references
-        self.db = pytc.HDB(os.path.join(db_path, "blockstorage.hdb"), pytc.HDBOWRITER | pytc.HDBOCREAT)
+        # holds mapping digest to number of references,
+        # readonly may be opened by several processes at once
+        mode = pytc.HDBOWRITER | pytc.HDBOCREAT
+        if readonly:
+            mode = pytc.HDBOREADER
+        self.db = pytc.HDB(os.path.join(db_path, "blockstorage.hdb"), mode)
         # self.db = gdbm.open(os.path.join(db_path, "blockstorage.gdbm"), "c")
 
-    def put(self, buf, digest):
-        """writes buf to filename <hexdigest>"""
+    def put(self, buf, digest, new=False):
+        """
+        writes buf to filename <hexdigest>, returns True if block is new,
+        with new the caller knows the block is not stored, so it is not looked up
+        """
         self.logger.debug("BlockStorage.put(<buf>, digest=%s)", digest)
-        filename = os.path.join(self.block_path, digest)
-        if self.db.has_key(digest):
-            # blockref counter up
-            self.logger.debug("BlockStorage.put: duplicate found")
-            self.db.put(digest, str(int(self.db.get(digest)) + 1))
-        else:
-            # write if this is the first block
-            self.logger.debug("BlockStorage.put: new block")
-            wfile = open(filename, "wb")
-            wfile.write(buf)
-            wfile.close()
-            self.db.put(digest, "1")
+        with self.lock:
+            filename = os.path.join(self.block_path, digest)
+            if (not new) and self.db.has_key(digest):
+                # blockref counter up
+                self.logger.debug("BlockStorage.put: duplicate found")
+                self.db.put(digest, str(int(self.db.get(digest)) + 1))
+                return(False)
+            else:
+                # write if this is the first block
+                self.logger.debug("BlockStorage.put: new block")
+                wfile = open(filename, "wb")
+                wfile.write(buf)
+                wfile.close()
+                self.db.put(digest, "1")
+                return(True)
 
     def get(self, digest):
         """reads data from filename <hexdigest>"""
@@ -76,25 +90,104 @@ class BlockStorageTokyoCabinet(object):
         return(os.path.isfile(filename))
 
     def delete(self, digest):
-        """if last reference delete block, else delete only reference"""
+        """
+        if last reference delete block, else delete only reference,
+        returns stored bytes of deleted block, None if it is kept
+        """
         self.logger.debug("BlockStorage.delete(digest=%s)" , digest)
-        if self.db.has_key(digest):
-            if self.db.get(digest) == "1":
-                filename = os.path.join(self.block_path, digest)
-                os.unlink(filename)
-                self.db.out(digest)
-            else:
-                # reference counter down by one
-                self.db.put(digest, str(int(self.db.get(digest)) - 1))
+        with self.lock:
+            if self.db.has_key(digest):
+                if self.db.get(digest) == "1":
+                    filename = os.path.join(self.block_path, digest)
+                    size = os.path.getsize(filename)
+                    os.unlink(filename)
+                    self.db.out(digest)
+                    return(size)
+                else:
+                    # reference counter down by one
+                    self.db.put(digest, str(int(self.db.get(digest)) - 1))
+        return(None)
+
+    def store(self, buf, digest):
+        """
+        writes buf to filename <hexdigest>, without reference counter,
+        returns stored bytes of replaced data, None if block is new
+        """
+        self.logger.debug("BlockStorage.store(<buf>, digest=%s)", digest)
+        filename = os.path.join(self.block_path, digest)
+        old_size = None
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError, exc:
+            if exc.errno != errno.EEXIST:
+                raise
+            # data of an existing block is replaced
+            old_size = os.path.getsize(filename)
+            fd = os.open(filename, os.O_WRONLY | os.O_TRUNC)
+        wfile = os.fdopen(fd, "wb")
+        wfile.write(buf)
+        wfile.close()
+        return(old_size)
+
+    def size(self, digest):
+        """returns length of stored data of block"""
+        return(os.path.getsize(os.path.join(self.block_path, digest)))
+
+    def nref(self, digest):
+        """returns reference counter of block, 0 if unknown"""
+        with self.lock:
+            if self.db.has_key(digest):
+                return(int(self.db.get(digest)))
+            return(0)
+
+    def update(self, counters):
+        """
+        set reference counters of sorted list of (digest, nref),
+        blocks with nref 0 are deleted, all in one transaction,
+        returns (number, stored bytes) of deleted blocks
+        """
+        self.logger.debug("BlockStorage.update(<%d counters>)", len(counters))
+        (nblocks, nbytes) = (0, 0)
+        with self.lock:
+            self.db.tranbegin()
+            for (digest, nref) in counters:
+                if nref > 0:
+                    self.db.put(digest, str(nref))
+                else:
+                    if self.db.has_key(digest):
+                        self.db.out(digest)
+                    filename = os.path.join(self.block_path, digest)
+                    if os.path.isfile(filename):
+                        nblocks += 1
+                        nbytes += os.path.getsize(filename)
+                        os.unlink(filename)
+            self.db.trancommit()
+        return((nblocks, nbytes))
+
+    def digests(self):
+        """
+        iterates over digests of all blocks,
+        with reference counter or only stored
+        """
+        with self.lock:
+            keys = set(self.db.keys())
+            keys.update(os.listdir(self.block_path))
+        return(iter(keys))
+
+    def close(self):
+        """close database"""
+        with self.lock:
+            self.db.close()
 
     def report(self, outfunc):
         """prints report with outfunc"""
-        num_stored = 0
-        num_blocks = len(self.db)
-        for key in self.db.keys():
-            num_stored += int(self.db.get(key))
-        string = ""
-        outfunc("Blocks in block_storage : %s" % num_blocks)
-        outfunc("de-dedupped blocks      : %s" % num_stored)
-        if num_blocks > 0:
-                outfunc("Dedup Value         : %0.3f" % (float(num_stored) / float(num_blocks)))
+        with self.lock:
+            num_stored = 0
+            num_blocks = len(self.db)
+            for key in self.db.keys():
+                num_stored += int(self.db.get(key))
+            string = ""
+            outfunc("Blocks in block_storage : %s" % num_blocks)
+            outfunc("de-dedupped blocks      : %s" % num_stored)
+            if num_blocks > 0:
+                    outfunc("Dedup Value         : %0.3f" % (float(num_stored) / float(num_blocks)))
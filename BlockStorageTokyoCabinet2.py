@@ -26,6 +26,7 @@ __date__ = "$Date$"
 import os
 import pytc
 import logging
+import threading
 
 
 class BlockStorageTokyoCabinet2(object):
@@ -35,59 +36,152 @@ class BlockStorageTokyoCabinet2(object):
     and blocks also stored in TokyoCabinet but in different database
     """
 
-    def __init__(self, db_path, block_path):
-        logging.debug("BlockStorage.__init__(%s, %s)" , db_path, block_path)
+    def __init__(self, db_path, block_path, readonly=False):
+        logging.debug("BlockStorage.__init__(%s, %s, %s)" , db_path, block_path, readonly)
         self.block_path = block_path
+        # fuse runs multithreaded, reference counters are read-modify-write
+        self.lock = threading.Lock()
         # block reference, to check if block is used
-        # holds mapping digest to number of references
-        self.db = pytc.HDB(os.path.join(db_path, "blockref.hdb"), pytc.HDBOWRITER | pytc.HDBOCREAT)
+        # holds mapping digest to number of references,
+        # readonly may be opened by several processes at once
+        mode = pytc.HDBOWRITER | pytc.HDBOCREAT
+        if readonly:
+            mode = pytc.HDBOREADER
+        self.db = pytc.HDB(os.path.join(db_path, "blockref.hdb"), mode)
         # hold block data
-        self.blockdb = pytc.HDB(os.path.join(db_path, "blockstorage.hdb"), pytc.HDBOWRITER | pytc.HDBOCREAT)
+        self.blockdb = pytc.HDB(os.path.join(db_path, "blockstorage.hdb"), mode)
 
-    def put(self, buf, digest):
-        """writes buf to filename <hexdigest>"""
+    def put(self, buf, digest, new=False):
+        """
+        writes buf to block database, returns True if block is new,
+        with new the caller knows the block is not stored, so it is not looked up
+        """
         logging.debug("BlockStorage.put(<buf>, digest=%s)", digest)
-        filename = os.path.join(self.block_path, digest)
-        if self.db.has_key(digest):
-            # blockref counter up
-            logging.debug("BlockStorage.put: duplicate found")
-            self.db.put(digest, str(int(self.db.get(digest)) + 1))
-        else:
-            # write if this is the first block
-            logging.debug("BlockStorage.put: new block")
-            self.blockdb.put(digest, buf)
-            self.db.put(digest, "1")
+        with self.lock:
+            filename = os.path.join(self.block_path, digest)
+            if (not new) and self.db.has_key(digest):
+                # blockref counter up
+                logging.debug("BlockStorage.put: duplicate found")
+                self.db.put(digest, str(int(self.db.get(digest)) + 1))
+                return(False)
+            else:
+                # write if this is the first block
+                logging.debug("BlockStorage.put: new block")
+                self.blockdb.put(digest, buf)
+                self.db.put(digest, "1")
+                return(True)
 
     def get(self, digest):
         """reads data from filename <hexdigest>"""
         logging.debug("BlockStorage.get(digest=%s)" , digest)
-        return(self.blockdb.get(digest))
+        with self.lock:
+            return(self.blockdb.get(digest))
 
     def exists(self, digest):
         """true if entry exists"""
         logging.debug("BlockStorage.exists(digest=%s)" , digest)
-        return(self.db.hash_key(digest))
+        with self.lock:
+            return(self.db.has_key(digest))
 
     def delete(self, digest):
-        """if last reference delete block, else delete only reference"""
+        """
+        if last reference delete block, else delete only reference,
+        returns stored bytes of deleted block, None if it is kept
+        """
         logging.debug("BlockStorage.delete(digest=%s)" , digest)
-        if self.db.has_key(digest):
-            if self.db.get(digest) == "1":
-                filename = os.path.join(self.block_path, digest)
-                self.db.out(digest)
-                self.blockdb.out(digest)
-            else:
-                # reference counter down by one
-                self.db.put(digest, str(int(self.db.get(digest)) - 1))
+        with self.lock:
+            if self.db.has_key(digest):
+                if self.db.get(digest) == "1":
+                    size = self.blockdb.vsiz(digest)
+                    self.db.out(digest)
+                    self.blockdb.out(digest)
+                    return(size)
+                else:
+                    # reference counter down by one
+                    self.db.put(digest, str(int(self.db.get(digest)) - 1))
+        return(None)
+
+    def store(self, buf, digest):
+        """
+        writes buf to block database, without reference counter,
+        returns stored bytes of replaced data, None if block is new
+        """
+        logging.debug("BlockStorage.store(<buf>, digest=%s)", digest)
+        with self.lock:
+            try:
+                # fails if the key exists, without a lookup before
+                self.blockdb.putkeep(digest, buf)
+                return(None)
+            except StandardError:
+                if not self.blockdb.has_key(digest):
+                    raise
+            # data of an existing block is replaced
+            old_size = self.blockdb.vsiz(digest)
+            self.blockdb.put(digest, buf)
+            return(old_size)
+
+    def size(self, digest):
+        """returns length of stored data of block"""
+        with self.lock:
+            return(len(self.blockdb.get(digest)))
+
+    def nref(self, digest):
+        """returns reference counter of block, 0 if unknown"""
+        with self.lock:
+            if self.db.has_key(digest):
+                return(int(self.db.get(digest)))
+            return(0)
+
+    def update(self, counters):
+        """
+        set reference counters of sorted list of (digest, nref),
+        blocks with nref 0 are deleted, one transaction per database,
+        returns (number, stored bytes) of deleted blocks
+        """
+        logging.debug("BlockStorage.update(<%d counters>)", len(counters))
+        (nblocks, nbytes) = (0, 0)
+        with self.lock:
+            self.db.tranbegin()
+            self.blockdb.tranbegin()
+            for (digest, nref) in counters:
+                if nref > 0:
+                    self.db.put(digest, str(nref))
+                else:
+                    if self.db.has_key(digest):
+                        self.db.out(digest)
+                    if self.blockdb.has_key(digest):
+                        nblocks += 1
+                        nbytes += self.blockdb.vsiz(digest)
+                        self.blockdb.out(digest)
+            self.blockdb.trancommit()
+            self.db.trancommit()
+        return((nblocks, nbytes))
+
+    def digests(self):
+        """
+        iterates over digests of all blocks,
+        with reference counter or only stored
+        """
+        with self.lock:
+            keys = set(self.db.keys())
+            keys.update(self.blockdb.keys())
+        return(iter(keys))
+
+    def close(self):
+        """close databases"""
+        with self.lock:
+            self.db.close()
+            self.blockdb.close()
 
     def report(self, outfunc):
         """prints report with outfunc"""
-        num_stored = 0
-        num_blocks = len(self.db)
-        for key in self.db.keys():
-            num_stored += int(self.db.get(key))
-        string = ""
-        outfunc("Blocks in block_storage : %s" % num_blocks)
-        outfunc("de-dedupped blocks      : %s" % num_stored)
-        if num_blocks > 0:
-                outfunc("Dedup Value         : %0.3f" % (float(num_stored) / float(num_blocks)))
+        with self.lock:
+            num_stored = 0
+            num_blocks = len(self.db)
+            for key in self.db.keys():
+                num_stored += int(self.db.get(key))
+            string = ""
+            outfunc("Blocks in block_storage : %s" % num_blocks)
+            outfunc("de-dedupped blocks      : %s" % num_stored)
+            if num_blocks > 0:
+                    outfunc("Dedup Value         : %0.3f" % (float(num_stored) / float(num_blocks)))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockStorage Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import logging
+
+
+class BlockStorageUsage(object):
+    """
+    counts blocks and their stored bytes in Usage,
+    when blocks are stored and when they are deleted,
+    must be the wrapper next to the BlockStorage holding the data,
+    so compressed lengths are counted
+
+    put, store, delete and update of the BlockStorage return
+    what they created or deleted, so no block is looked up here
+    """
+
+    def __init__(self, block_storage, usage):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("BlockStorageUsage.__init__(%s, %s)", block_storage, usage)
+        self.block_storage = block_storage
+        self.usage = usage
+
+    def __added(self, nbytes):
+        """a new block was stored"""
+        self.usage.add("blocks", 1)
+        self.usage.add("physical_bytes", nbytes)
+
+    def __removed(self, nbytes):
+        """a block was deleted"""
+        self.usage.add("blocks", -1)
+        self.usage.add("physical_bytes", -nbytes)
+
+    def put(self, buf, digest, new=False):
+        """store block, count it if it is new"""
+        if self.block_storage.put(buf, digest, new):
+            self.__added(len(buf))
+
+    def store(self, buf, digest):
+        """store block, without reference counter, data of an existing block is replaced"""
+        old_size = self.block_storage.store(buf, digest)
+        if old_size is None:
+            self.__added(len(buf))
+        else:
+            self.usage.add("physical_bytes", len(buf) - old_size)
+
+    def get(self, digest):
+        """get block"""
+        return(self.block_storage.get(digest))
+
+    def exists(self, digest):
+        """true if block exists"""
+        return(self.block_storage.exists(digest))
+
+    def delete(self, digest):
+        """delete reference to block, count block if it is deleted"""
+        size = self.block_storage.delete(digest)
+        if size is not None:
+            self.__removed(size)
+
+    def size(self, digest):
+        """returns length of stored data of block"""
+        return(self.block_storage.size(digest))
+
+    def nref(self, digest):
+        """returns reference counter of block"""
+        return(self.block_storage.nref(digest))
+
+    def update(self, counters):
+        """set reference counters of sorted list of (digest, nref), count deleted blocks"""
+        (nblocks, nbytes) = self.block_storage.update(counters)
+        self.usage.add("blocks", -nblocks)
+        self.usage.add("physical_bytes", -nbytes)
+
+    def digests(self):
+        """iterates over digests of all blocks"""
+        return(self.block_storage.digests())
+
+    def close(self):
+        """close block_storage"""
+        self.block_storage.close()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        self.block_storage.report(outfunc)
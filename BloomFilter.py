@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BloomFilter Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import struct
+import logging
+
+# file starts with magic, clean flag, number of bits and number of hashes
+HEADER = struct.Struct(">4sBQB")
+MAGIC = "PZBF"
+
+
+class BloomFilter(object):
+    """
+    set of hexdigests, which may answer true for digests not in it,
+    but never false for digests in it
+
+    digests are already random, so the positions of the bits are
+    taken from the digest itself, no more hashing needed
+    """
+
+    def __init__(self, nbytes, nhashes=7):
+        logging.debug("BloomFilter.__init__(%s, %s)", nbytes, nhashes)
+        self.nbits = nbytes * 8
+        self.nhashes = nhashes
+        self.bits = bytearray(nbytes)
+        # number of digests added, for report
+        self.count = 0
+
+    def __positions(self, digest):
+        """bit positions of hexdigest, with double hashing"""
+        hash1 = int(digest[:16], 16)
+        hash2 = int(digest[16:32], 16) | 1
+        return([(hash1 + index * hash2) % self.nbits for index in xrange(self.nhashes)])
+
+    def add(self, digest):
+        """add hexdigest"""
+        for position in self.__positions(digest):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, digest):
+        """false if digest was never added"""
+        for position in self.__positions(digest):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return(False)
+        return(True)
+
+    def save(self, filename, clean=True):
+        """write to filename, load accepts only files saved clean"""
+        logging.debug("BloomFilter.save(%s, %s)", filename, clean)
+        wfile = open(filename + ".tmp", "wb")
+        wfile.write(HEADER.pack(MAGIC, int(clean), self.nbits, self.nhashes))
+        wfile.write(self.bits)
+        wfile.close()
+        os.rename(filename + ".tmp", filename)
+
+    @staticmethod
+    def load(filename, nbytes, nhashes=7):
+        """
+        returns BloomFilter read from filename, or None
+        if there is none, it has another size or was not saved clean,
+        the file is marked unclean until next save
+        """
+        logging.debug("BloomFilter.load(%s, %s, %s)", filename, nbytes, nhashes)
+        if not os.path.isfile(filename):
+            return(None)
+        rfile = open(filename, "r+b")
+        header = rfile.read(HEADER.size)
+        if len(header) < HEADER.size:
+            rfile.close()
+            return(None)
+        (magic, clean, nbits, file_nhashes) = HEADER.unpack(header)
+        if (magic != MAGIC) or (clean != 1) or (nbits != nbytes * 8) or (file_nhashes != nhashes):
+            rfile.close()
+            return(None)
+        bloom_filter = BloomFilter(nbytes, nhashes)
+        bloom_filter.bits = bytearray(rfile.read(nbytes))
+        if len(bloom_filter.bits) != nbytes:
+            rfile.close()
+            return(None)
+        # until save, bits in file are older than bits in memory
+        rfile.seek(0)
+        rfile.write(HEADER.pack(MAGIC, 0, nbits, nhashes))
+        rfile.close()
+        return(bloom_filter)
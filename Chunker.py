@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""Chunker Objects, decide where data is cut into blocks"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import math
+import random
+import logging
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class FixedChunker(object):
+    """cut data at fixed blocksize boundaries, the classic behaviour"""
+
+    def __init__(self, blocksize):
+        logging.debug("FixedChunker.__init__(%s)", blocksize)
+        self.blocksize = blocksize
+
+    def cut(self, buf, scanned=0):
+        """
+        return length of the first block in buf,
+        or 0 if buf holds not enough data to decide
+        """
+        if len(buf) >= self.blocksize:
+            return(self.blocksize)
+        return(0)
+
+
+class ContentChunker(object):
+    """
+    content defined chunking with a gear rolling hash
+
+    the hash value at some position depends only on the last
+    32 bytes, so the same data is always cut at the same boundaries,
+    regardless at which offset it is found in a file,
+    inserting some bytes only changes the blocks around the insert
+
+    the hash runs byte by byte in python, some MB/s only, if module
+    numpy exists, up to MAX_STEP bytes are searched at once with numpy,
+    both find the same boundaries
+    """
+
+    # the rolling hash only sees the last WINDOW bytes
+    WINDOW = 32
+    # fixed seed, boundaries must be the same on every mount
+    SEED = 0x50794465
+    # bytes searched at once with numpy, at first about the distance
+    # of boundaries, doubled up to MAX_STEP
+    MIN_STEP = 1024
+    MAX_STEP = 65536
+
+    def __init__(self, min_size, avg_size, max_size):
+        logging.debug("ContentChunker.__init__(%s, %s, %s)", min_size, avg_size, max_size)
+        assert 0 < min_size <= avg_size <= max_size
+        self.min_size = min_size
+        self.max_size = max_size
+        # nominal blocksize, used for statistics
+        self.blocksize = avg_size
+        # after min_size a boundary is found every 2^bits bytes on average
+        bits = max(1, int(round(math.log(max(2, avg_size - min_size), 2))))
+        self.mask = (1 << bits) - 1
+        # only the last bits bytes change the bits of hash in mask
+        self.bits = min(bits, self.WINDOW)
+        rand = random.Random(self.SEED)
+        self.gear = [rand.getrandbits(32) for _ in range(256)]
+        self.np_gear = None
+        if numpy is not None:
+            self.np_gear = numpy.array(self.gear, dtype=numpy.uint32)
+
+    def cut(self, buf, scanned=0):
+        """
+        return length of the first block in buf,
+        or 0 if there is no boundary in buf yet
+
+        scanned is the number of bytes of buf already searched
+        without success in an earlier call, so appending small pieces
+        of data to buf does not rescan it from the beginning
+        """
+        end = min(len(buf), self.max_size)
+        start = max(self.min_size, scanned)
+        if start >= end:
+            if len(buf) >= self.max_size:
+                return(self.max_size)
+            return(0)
+        # warm up the hash with the window before start
+        warmup = max(0, start - self.WINDOW)
+        if self.np_gear is not None:
+            pos = self.__search(buf, warmup, start, end)
+        else:
+            pos = self.__search_bytes(buf, warmup, start, end)
+        if pos > 0:
+            return(pos)
+        if end == self.max_size:
+            # no natural boundary found, force cut
+            return(self.max_size)
+        return(0)
+
+    def __search_bytes(self, buf, warmup, start, end):
+        """
+        returns position behind the first boundary between start and end,
+        0 if there is none, the hash runs byte by byte from warmup
+        """
+        data = bytearray(buffer(buf, warmup, end - warmup))
+        gear = self.gear
+        mask = self.mask
+        hashval = 0
+        for byte in data[:start - warmup]:
+            hashval = ((hashval << 1) + gear[byte]) & 0xffffffff
+        pos = start
+        for byte in data[start - warmup:]:
+            hashval = ((hashval << 1) + gear[byte]) & 0xffffffff
+            pos += 1
+            if (hashval & mask) == 0:
+                return(pos)
+        return(0)
+
+    def __search(self, buf, warmup, start, end):
+        """
+        returns position behind the first boundary between start and end,
+        0 if there is none, numpy version of __search_bytes
+
+        the hash behind byte i, masked, is the sum of gear[byte i - k] << k
+        for k below bits, bytes before warmup do not count
+        """
+        pos = start
+        step = max(self.MIN_STEP, min(self.mask + 1, self.MAX_STEP))
+        while pos < end:
+            stop = min(end, pos + step)
+            step = min(step * 2, self.MAX_STEP)
+            first = max(warmup, pos - self.bits + 1)
+            gears = self.np_gear[numpy.frombuffer(buffer(buf, first, stop - first), dtype=numpy.uint8)]
+            hashes = gears.copy()
+            for shift in range(1, self.bits):
+                hashes[shift:] += gears[:len(gears) - shift] << shift
+            found = numpy.flatnonzero((hashes[pos - first:] & self.mask) == 0)
+            if len(found) > 0:
+                return(pos + int(found[0]) + 1)
+            pos = stop
+        return(0)
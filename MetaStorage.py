@@ -24,31 +24,93 @@ __date__ = "$Date$"
 # $Id
 
 import os
-import cPickle
+import copy
+import stat
 import time
 import logging
 import errno
+import tempfile
+import array
+import shutil
+import collections
 # for statistics and housekeeping threads
-# import threading
+# and to lock entries and sequences
+import threading
+# batched listing with file types, without a stat per entry, if available
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 # own modules
 from WriteBuffer import WriteBuffer as WriteBuffer
-# from BlockStorageGdbm import BlockStorageGdbm as BlockStorage
-# from BlockStorageFile import BlockStorageFile as BlockStorage
-# Tokyo Cabinet Reference Counter Version
-from BlockStorageTokyoCabinet import BlockStorageTokyoCabinet as BlockStorage
-# Tokyo Cabinet Reference Counter and blockstorage version
-# from BlockStorageTokyoCabinet2 import BlockStorageTokyoCabinet2 as BlockStorage
+from WritePipeline import WritePipeline as WritePipeline
+from Chunker import FixedChunker as FixedChunker
+from BlockCache import BlockCache as BlockCache
+from Prefetcher import Prefetcher as Prefetcher
+from Prefetcher import ReadAhead as ReadAhead
+from Sequence import Sequence as Sequence
+from Sequence import load_sequence as load_sequence
+from BlockStorageCompress import BlockStorageCompress as BlockStorageCompress
+from BlockStorageJournal import BlockStorageJournal as BlockStorageJournal
+from BlockStorageBloom import BlockStorageBloom as BlockStorageBloom
+from BlockStorageQuarantine import BlockStorageQuarantine as BlockStorageQuarantine
+from Scrubber import Scrubber as Scrubber
+from Reclaimer import Reclaimer as Reclaimer
+from AttrCache import AttrCache as AttrCache
+from Stats import Stats as Stats
+from BlockStorageStats import BlockStorageStats as BlockStorageStats
+from BlockStorageUsage import BlockStorageUsage as BlockStorageUsage
+from Usage import Usage as Usage
+import BinaryFormat
 from StatDefaultFile import StatDefaultFile as StatDefaultFile
 
+# available block storages, name -> module and class name,
+# modules are imported on use, so only the needed database module must exist
+BLOCK_STORAGES = {
+    # Reference Counter in .ifo files, blocks in filesystem
+    "file" : "BlockStorageFile",
+    # gdbm Reference Counter, blocks in filesystem
+    "gdbm" : "BlockStorageGdbm",
+    # Tokyo Cabinet Reference Counter, blocks in filesystem
+    "tc" : "BlockStorageTokyoCabinet",
+    # Tokyo Cabinet Reference Counter and blockstorage
+    "tc2" : "BlockStorageTokyoCabinet2",
+    # blocks appended to pack files, gdbm index
+    "pack" : "BlockStoragePack",
+}
+DEFAULT_STORAGE = "tc"
+# virtual read only directory and file with statistics, nothing is stored
+STATS_DIR = "/.pydedupfs"
+STATS_PATH = STATS_DIR + "/stats"
+# read only copies of directory trees, mkdir in it takes a snapshot of /
+SNAPSHOT_DIR = "/.snapshots"
+# entries of a directory parsed by one readdir call
+READDIR_BATCH = 128
+# listings of directories kept for readdir calls with offset
+READDIR_LISTINGS = 64
+
+
+def get_block_storage(name):
+    """returns BlockStorage class of name in BLOCK_STORAGES"""
+    modname = BLOCK_STORAGES[name]
+    return(getattr(__import__(modname), modname))
+
 
 class MetaStorage(object):
     """Holds information about directory structure"""
 
-    def __init__(self, root, blocksize, hashfunc):
+    def __init__(self, root, blocksize, hashfunc, chunker=None, cachesize=32 * 1024 * 1024, readahead=16, prefetchthreads=4, storage=DEFAULT_STORAGE, compress="none", compresslevel=6, hashthreads=0, journalinterval=5, bloomsize=16 * 1024 * 1024, attrcache=65536, attrttl=60, scrubrate=1024 * 1024):
         """just __init__"""
         self.blocksize = blocksize
         self.hashfunc = hashfunc
-        logging.debug("__init__(%s, %s, %s)", root, blocksize, hashfunc)
+        # chunker to cut data into blocks, fixed blocksize as default
+        if chunker is None:
+            chunker = FixedChunker(blocksize)
+        self.chunker = chunker
+        logging.debug("__init__(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", root, blocksize, hashfunc, chunker, cachesize, readahead, prefetchthreads, storage, compress, compresslevel, hashthreads, journalinterval, bloomsize, attrcache, attrttl, scrubrate)
 
         # create root if it doesnt exist
         self.root = root
@@ -60,14 +122,14 @@ class MetaStorage(object):
         if not os.path.isdir(db_path):
             os.mkdir(db_path)
         # there are files and directories,
-        # in files there is only cPickled file information
+        # in files there is only file information, see BinaryFormat
         # (digest, fuse.Stat)
         self.file_path = os.path.join(self.root, "files")
         if not os.path.isdir(self.file_path):
             os.mkdir(self.file_path)
         # filedigest
         # in this directory there are files with name digest of file
-        # these files hold cPickle list of blocks to assemble data
+        # these files hold list of blocks to assemble data, see BinaryFormat
         self.filedigest_path = os.path.join(self.root, "filedigest")
         if not os.path.isdir(self.filedigest_path):
             os.mkdir(self.filedigest_path)       
@@ -75,10 +137,74 @@ class MetaStorage(object):
         block_path = os.path.join(self.root, "blocks")
         if not os.path.isdir(block_path):
             os.mkdir(block_path)
+        # temporary files, renamed to entries and sequences when complete
+        self.tmp_path = os.path.join(self.root, "tmp")
+        if not os.path.isdir(self.tmp_path):
+            os.mkdir(self.tmp_path)
+        # sequences of deleted files, their blocks are given back in background
+        self.reclaim_path = os.path.join(self.root, "reclaim")
+        if not os.path.isdir(self.reclaim_path):
+            os.mkdir(self.reclaim_path)
+
+        # fuse runs multithreaded, every read-modify-write
+        # of entries and sequences must hold this lock
+        self.lock = threading.RLock()
+        # counters of changes of entries, indexed by hash of path,
+        # open files compare them to know if their Sequence is outdated
+        self.generations = array.array("L", [0] * 4096)
+        # (digest, st) of recently used entries, up to attrcache entries
+        self.attr_cache = AttrCache(attrcache, attrttl)
+        # realpath -> sorted listing, taken by readdir at offset 0,
+        # so later offsets of the same listing point to the same names
+        self.listings = collections.OrderedDict()
+        self.listings_lock = threading.Lock()
+
+        # counters and latency histograms, shown in STATS_PATH
+        self.stats = Stats()
+        # totals of files, directories, bytes and blocks, for statfs,
+        # zero is exact for a new filesystem
+        new = (len(os.listdir(self.file_path)) == 0) and (len(os.listdir(self.filedigest_path)) == 0)
+        self.usage = Usage(db_path, new)
 
         # additional classes 
-        self.block_storage = BlockStorage(db_path, block_path)
-        self.write_buffer = WriteBuffer(self, self.block_storage, blocksize, hashfunc)
+        self.block_storage = BlockStorageStats(get_block_storage(storage)(db_path, block_path), self.stats)
+        # stored blocks and bytes are counted, after compression
+        self.block_storage = BlockStorageUsage(self.block_storage, self.usage)
+        # bloomsize bytes of memory to know new blocks without lookup
+        if bloomsize > 0:
+            self.block_storage = BlockStorageBloom(self.block_storage, db_path, bloomsize)
+        # compress blocks before they are stored, and uncompress compressed
+        # blocks, even if compress is none now
+        self.block_storage = BlockStorageCompress(self.block_storage, compress, compresslevel)
+        # reference counters are changed in memory and written in batches,
+        # with journalinterval 0 every change is written at once
+        if journalinterval > 0:
+            self.block_storage = BlockStorageJournal(self.block_storage, db_path, journalinterval)
+        # blocks read recently, shared by all open files
+        self.block_cache = BlockCache(cachesize)
+        # blocks found corrupted are not returned, until written again,
+        # and are dropped from block_cache
+        self.block_storage = BlockStorageQuarantine(self.block_storage, db_path, self.block_cache.discard)
+        # sequential reads prefetch up to readahead blocks into block_cache,
+        # but never more than a quarter of the cache
+        self.readahead = min(readahead, cachesize / 4 / max(1, self.chunker.blocksize))
+        self.prefetcher = None
+        if (self.readahead > 0) and (prefetchthreads > 0):
+            self.prefetcher = Prefetcher(self.block_cache, self.block_storage.get, prefetchthreads)
+        # written blocks are hashed and stored by hashthreads workers,
+        # shared by all open files, with 0 in the writing thread
+        self.write_pipeline = None
+        if hashthreads > 0:
+            self.write_pipeline = WritePipeline(hashthreads)
+        # counter of fuse operations, the scrubber waits while it grows fast
+        self.activity = 0
+        # stored blocks are verified again in background,
+        # with scrubrate bytes per second
+        self.scrubber = None
+        if scrubrate > 0:
+            self.scrubber = Scrubber(self.block_storage, hashfunc, db_path, scrubrate, lambda: self.activity)
+        # unlink only queues the sequence, blocks are deleted by this thread
+        self.reclaimer = Reclaimer(self.block_storage, self.reclaim_path)
 
         # start statistics Thread
         #self.threads = []
@@ -95,8 +221,24 @@ class MetaStorage(object):
 #        while True:
 #            logging.warning("BlockStorage Statistics Report")
 #            self.block_storage.report(logging.warning)
+#            self.block_cache.report(logging.warning)
+#            self.attr_cache.report(logging.warning)
 #            time.sleep(interval)
       
+    def close(self, reclaim=False):
+        """
+        write everything still held in memory, called at unmount,
+        with reclaim all queued blocks are deleted first,
+        else this is done after the next mount
+        """
+        logging.debug("close(%s)", reclaim)
+        if self.scrubber is not None:
+            self.scrubber.close()
+        self.reclaimer.close(reclaim)
+        with self.lock:
+            self.block_storage.close()
+            self.usage.close()
+
     def __to_realpath(self, abspath):
         """from abspath with leading / to relative pathnames
         and join it with file_base path"""
@@ -105,222 +247,667 @@ class MetaStorage(object):
         logging.debug("__to_realpath return %s", realpath)
         return(realpath)
 
-    def write(self, abspath, data, offset):
-        """write data to file over write_buffer"""
-        # write_buffer returns len(writen_data)
-        #if offset > 0:
-        #    logging.error("Append not Implemented yet")
-        #    return(-errno.ENOTSUP)
-        return(self.write_buffer.add(data))
+    def new_write_buffer(self, abspath, truncate=False):
+        """
+        returns new WriteBuffer for one open file,
+        data not written is taken from the existing file,
+        unless it is truncated
+        """
+        logging.debug("new_write_buffer(%s, %s)", abspath, truncate)
+        self.__check_writable(abspath)
+        self.activity += 1
+        base = None
+        base_size = 0
+        if not truncate:
+            (digest, st) = self.__get_entry(abspath)
+            if (digest != 0) and (st.st_size > 0):
+                sequence = self.__open_digest(digest)
+                base = lambda length, offset: self.__read(sequence, length, offset)
+                base_size = st.st_size
+        return(WriteBuffer(self, self.block_storage, self.chunker, self.hashfunc, base, base_size, self.write_pipeline))
 
-    def release(self, abspath):
+    def release(self, abspath, write_buffer, st=None):
         """
         close file after writing, write remaining data in buffers
-        and finalize file information in meta_storage
+        and finalize file information in meta_storage,
+        st gives mode, owner and times, default ones if None
         """
         # get the latest informations about the written file
-        (digest, sequence, size) = self.write_buffer.release()
+        (digest, sequence, size) = write_buffer.release()
         # generate st struct
-        st = StatDefaultFile()
+        if st is None:
+            st = StatDefaultFile()
         st.st_size = size
         # TODO: what about not fully written data in either of these two methods
         # think about rollback function
-        self.__put_entry(abspath, digest, st)
-        self.__put_sequence(digest, sequence)
-            
-
-    def read(self, abspath, length, offset):
-        """get sequence type list of blocks for path if path exists"""
-        logging.info("read(%s)", abspath)
-        # from file
+        with self.lock:
+            old_digest = 0
+            if os.path.isfile(self.__to_realpath(abspath)):
+                (old_digest, old_st) = self.__get_entry(abspath)
+                self.usage.add("logical_bytes", size - old_st.st_size)
+            else:
+                self.usage.add("files", 1)
+                self.usage.add("logical_bytes", size)
+            self.__put_entry(abspath, digest, st)
+            self.__put_sequence(digest, sequence)
+            if old_digest != 0:
+                # file is overwritten, give back reference to old data
+                self.__delete_sequence(old_digest)
+
+    def truncate(self, abspath, length):
+        """
+        truncate file to length, only length 0 is implemented,
+        any other length than the size of the file fails with EOPNOTSUPP
+        """
+        logging.info("truncate(%s, %s)", abspath, length)
+        self.__check_writable(abspath)
+        with self.lock:
+            (digest, st) = self.__get_entry(abspath)
+            if length != 0:
+                if length == st.st_size:
+                    return
+                raise OSError(errno.EOPNOTSUPP, "truncate to length %s is not implemented" % length)
+            if digest != 0:
+                self.usage.add("logical_bytes", -st.st_size)
+                st = copy.copy(st)
+                st.st_size = 0
+                self.__put_entry(abspath, 0, st)
+                self.__delete_sequence(digest)
+
+    def new_readahead(self):
+        """returns read ahead state for one open file, None if disabled"""
+        if self.prefetcher is None:
+            return(None)
+        return(ReadAhead(min(2, self.readahead), self.readahead))
+
+    def __generation_index(self, abspath):
+        """index of change counter of abspath"""
+        return(hash(abspath) % len(self.generations))
+
+    def __touch(self, abspath):
+        """count change of entry abspath"""
+        index = self.__generation_index(abspath)
+        self.generations[index] = (self.generations[index] + 1) % (2 ** 32)
+
+    def open_sequence(self, abspath):
+        """
+        returns Sequence of file abspath, open files hold it
+        to read without loading entry and sequence again
+        """
+        logging.debug("open_sequence(%s)", abspath)
+        generation = self.generations[self.__generation_index(abspath)]
         (digest, st) = self.__get_entry(abspath)
-        nref, sequence = self.__get_sequence(digest)
+        sequence = self.__open_digest(digest)
+        sequence.generation = generation
+        return(sequence)
+
+    def is_current(self, abspath, sequence):
+        """false if entry abspath may have changed since sequence was opened"""
+        return(sequence.generation == self.generations[self.__generation_index(abspath)])
+
+    def __open_digest(self, digest):
+        """returns Sequence of file with digest"""
+        if digest == 0:
+            # 0-byte file
+            return(Sequence([], [], self.blocksize))
+        sequence = load_sequence(os.path.join(self.filedigest_path, digest), self.blocksize)
         logging.debug("Found sequence with length %s", len(sequence))
-        if len(sequence) > 0:
-            return(self.__read(sequence, length, offset))
-        else:
-            return("")
+        return(sequence)
 
-    def __read(self, sequence, length, offset):
-        """Low level Reading function, returns data"""
-        index = int(offset / self.blocksize)
-        start = offset % self.blocksize
-        buf = ""
-        while (len(buf) < length) and (index < len(sequence)):
-            logging.debug("index : %d, start %d", index, start)
-            if start > 0:
-                buf += self.block_storage.get(sequence[index])[start:]
-                start = 0
+    def read(self, abspath, length, offset, readahead=None, sequence=None):
+        """
+        read data of file abspath,
+        sequence from open_sequence() saves loading it again
+        """
+        logging.debug("read(%s)", abspath)
+        self.activity += 1
+        if sequence is None:
+            sequence = self.open_sequence(abspath)
+        return(self.__read(sequence, length, offset, readahead))
+
+    def __read(self, sequence, length, offset, readahead=None):
+        """
+        Low level Reading function, returns data
+
+        a read inside one block returns the block or one slice of it,
+        a read of several blocks copies every piece once into a
+        buffer of length, meanwhile the prefetcher loads the blocks
+        after the first one in parallel
+        """
+        sequential = (readahead is not None) and readahead.access(offset, length)
+        (index, start) = sequence.locate(offset)
+        if (length <= 0) or (index >= len(sequence)):
+            return("")
+        last = min(sequence.locate(offset + length - 1)[0], len(sequence) - 1)
+        digests = sequence[index:last + 1]
+        logging.debug("index : %d to %d, start %d", index, last, start)
+        if sequential:
+            for (number, digest) in enumerate(digests):
+                readahead.account(index + number, digest in self.block_cache)
+        if (len(digests) > 1) and (self.prefetcher is not None):
+            self.prefetcher.prefetch(digests[1:])
+        if len(digests) == 1:
+            block = self.__get_block(digests[0])
+            if (start == 0) and (len(block) <= length):
+                # whole block, nothing to copy
+                data = block
             else:
-                buf += self.block_storage.get(sequence[index])
-            index += 1
-        if len(buf) > length:
-            logging.debug("Buffer will be shortened to %d", length)
-            # append EOF
-            buf = buf[:length] + "0x00"
-        return(buf[:length])
+                data = block[start:start + length]
+        else:
+            buf = bytearray(length)
+            view = memoryview(buf)
+            filled = 0
+            for digest in digests:
+                block = self.__get_block(digest)
+                count = min(len(block) - start, length - filled)
+                if count <= 0:
+                    break
+                view[filled:filled + count] = memoryview(block)[start:start + count]
+                filled += count
+                start = 0
+            data = view[:filled].tobytes()
+        if sequential:
+            # last + 1 is the first block not read
+            self.prefetcher.prefetch(sequence[last + 1:last + 1 + readahead.window])
+        return(data)
+
+    def __get_block(self, digest):
+        """return data of block, from block_cache if possible"""
+        if self.block_storage.is_quarantined(digest):
+            # a load running while it was quarantined may have cached it
+            self.block_cache.discard(digest)
+            return(self.block_storage.get(digest))
+        return(self.block_cache.get(digest, self.block_storage.get))
 
     def getattr(self, abspath):
         """return stat of path if file exists"""
-        logging.info("getattr(%s)", abspath)
-        realpath = self.__to_realpath(abspath)
-        if os.path.isfile(realpath) or os.path.islink(realpath):
-            (digest, st) = self.__get_entry(abspath)
-            return(st)
-        else:
-            return(os.stat(realpath))
+        logging.debug("getattr(%s)", abspath)
+        self.activity += 1
+        if abspath in (STATS_DIR, STATS_PATH):
+            return(self.__virtual_stat(abspath))
+        if (abspath == SNAPSHOT_DIR) and (not os.path.isdir(self.__to_realpath(abspath))):
+            # shown before the first snapshot, so mkdir in it works
+            return(self.__virtual_stat(abspath))
+        entry = self.attr_cache.get(abspath)
+        if entry is None:
+            realpath = self.__to_realpath(abspath)
+            if not (os.path.isfile(realpath) or os.path.islink(realpath)):
+                return(os.stat(realpath))
+            entry = self.__load_entry(abspath)
+        return(entry[1])
 
     def utime(self, abspath, atime, mtime):
         """sets utimes in st structure"""
-        logging.info("utime(abspath=%s, atime=%s, mtime=%s)", abspath, atime, mtime)
+        logging.debug("utime(abspath=%s, atime=%s, mtime=%s)", abspath, atime, mtime)
+        self.__check_writable(abspath)
         realpath = self.__to_realpath(abspath)
         if os.path.isdir(realpath):
             os.utime(realpath, (atime, mtime))
         else:
-            (digest, st) = self.__get_entry(abspath)
-            st.st_mtime = mtime
-            st.st_atime = atime
-            self.__put_entry(abspath, digest, st)
+            with self.lock:
+                (digest, st) = self.__get_entry(abspath)
+                # st is cached, change a copy
+                st = copy.copy(st)
+                st.st_mtime = mtime
+                st.st_atime = atime
+                self.__put_entry(abspath, digest, st)
         
-    def readdir(self, abspath):
-        """return list of files of directory"""
-        logging.info("readdir(%s)", abspath)
-        return(os.listdir(self.__to_realpath(abspath)))
+    def readdir(self, abspath, offset=0):
+        """
+        returns list of (name, offset of next name, file type) of up to
+        READDIR_BATCH names of directory, starting at offset, empty at end,
+        entries of files are parsed in this pass and put into attr_cache,
+        so getattr of the listed names needs no read of their entries
+        """
+        logging.debug("readdir(%s, offset=%s)", abspath, offset)
+        if abspath == STATS_DIR:
+            if offset > 0:
+                return([])
+            return([(os.path.basename(STATS_PATH), 1, stat.S_IFREG)])
+        if (abspath == SNAPSHOT_DIR) and (not os.path.isdir(self.__to_realpath(abspath))):
+            return([])
+        result = []
+        listing = self.__listing(self.__to_realpath(abspath), offset)
+        for (index, (name, is_dir)) in enumerate(listing[offset:offset + READDIR_BATCH], offset + 1):
+            entry_path = os.path.join(abspath, name)
+            if is_dir is None:
+                is_dir = os.path.isdir(self.__to_realpath(entry_path))
+            filetype = stat.S_IFDIR
+            if not is_dir:
+                try:
+                    filetype = stat.S_IFMT(self.__get_entry(entry_path)[1].st_mode)
+                except StandardError, exc:
+                    # deleted meanwhile or unreadable, getattr will tell
+                    logging.debug("readdir: entry %s : %s", entry_path, exc)
+                    filetype = 0
+            result.append((name, index, filetype))
+        return(result)
+
+    def __listing(self, realpath, offset):
+        """
+        returns sorted list of (name, True if directory or None if unknown)
+        of realpath, new at offset 0, else as taken at offset 0
+        """
+        with self.listings_lock:
+            listing = self.listings.pop(realpath, None)
+            if (listing is not None) and (offset > 0):
+                self.listings[realpath] = listing
+                return(listing)
+        if scandir is not None:
+            listing = sorted((entry.name, entry.is_dir()) for entry in scandir(realpath))
+        else:
+            listing = [(name, None) for name in sorted(os.listdir(realpath))]
+        with self.listings_lock:
+            self.listings[realpath] = listing
+            while len(self.listings) > READDIR_LISTINGS:
+                self.listings.popitem(last=False)
+        return(listing)
+
+    def is_snapshot(self, abspath):
+        """true if abspath is the snapshot directory or in it"""
+        return((abspath == SNAPSHOT_DIR) or abspath.startswith(SNAPSHOT_DIR + "/"))
+
+    def __check_writable(self, abspath):
+        """raises OSError EROFS if abspath is in a snapshot"""
+        if self.is_snapshot(abspath):
+            raise OSError(errno.EROFS, "%s is read only" % abspath)
+
+    def __check_snapshot_name(self, name):
+        """raises OSError EINVAL if name is no valid name of a snapshot"""
+        if (name in ("", ".", "..")) or ("/" in name):
+            raise OSError(errno.EINVAL, "invalid snapshot name %s" % name)
+
+    def snapshot(self, abspath, name):
+        """
+        read only copy of directory abspath as SNAPSHOT_DIR/name,
+        only entries are copied, every sequence gets one more reference
+        per copied entry, no block is read or written
+
+        the copy is built in tmp_path without the lock, so the filesystem
+        is not blocked meanwhile, the lock is held only to take the
+        references and rename the copy into place, so it is complete or
+        does not exist, entries whose sequence was deleted meanwhile
+        are left out of the copy
+        """
+        logging.info("snapshot(%s, %s)", abspath, name)
+        self.__check_snapshot_name(name)
+        source = self.__to_realpath(abspath)
+        if not os.path.isdir(source):
+            raise OSError(errno.ENOTDIR, "%s is no directory" % abspath)
+        snapshot_path = self.__to_realpath(SNAPSHOT_DIR)
+        target = os.path.join(snapshot_path, name)
+        if os.path.exists(target):
+            raise OSError(errno.EEXIST, "snapshot %s exists" % name)
+        tmp_target = tempfile.mkdtemp(dir=self.tmp_path, prefix="snapshot-")
+        try:
+            # digest -> number of new references
+            nrefs = {}
+            (files, directories, nbytes) = (0, 0, 0)
+            for (dirpath, dirnames, filenames) in os.walk(source):
+                # never copy snapshots into a snapshot
+                dirnames[:] = [dirname for dirname in dirnames if os.path.join(dirpath, dirname) != snapshot_path]
+                tmp_dir = os.path.normpath(os.path.join(tmp_target, os.path.relpath(dirpath, source)))
+                if tmp_dir != tmp_target:
+                    os.mkdir(tmp_dir)
+                    directories += 1
+                for filename in filenames:
+                    realname = os.path.join(dirpath, filename)
+                    if os.path.islink(realname):
+                        continue
+                    try:
+                        data = open(realname, "rb").read()
+                    except IOError, exc:
+                        if exc.errno != errno.ENOENT:
+                            raise
+                        # deleted meanwhile
+                        continue
+                    (digest, st) = BinaryFormat.loads_entry(data)
+                    if digest != 0:
+                        nrefs[digest] = nrefs.get(digest, 0) + 1
+                    open(os.path.join(tmp_dir, filename), "wb").write(data)
+                    files += 1
+                    nbytes += st.st_size
+            # modes and times of directories, deepest first
+            for (dirpath, dirnames, filenames) in os.walk(tmp_target, topdown=False):
+                shutil.copystat(os.path.normpath(os.path.join(source, os.path.relpath(dirpath, tmp_target))), dirpath)
+        except StandardError:
+            shutil.rmtree(tmp_target, True)
+            raise
+        with self.lock:
+            if os.path.exists(target):
+                shutil.rmtree(tmp_target, True)
+                raise OSError(errno.EEXIST, "snapshot %s exists" % name)
+            # references are taken before the snapshot is visible,
+            # after a crash garbagecollect.py gives back too many ones
+            missing = set()
+            for (digest, count) in nrefs.iteritems():
+                filename = os.path.join(self.filedigest_path, digest)
+                if os.path.isfile(filename):
+                    self.__set_nref(filename, self.__open_digest(digest).nref + count)
+                else:
+                    missing.add(digest)
+            if len(missing) > 0:
+                # files changed or deleted after they were copied,
+                # their current entry is copied again, with the lock held
+                logging.info("snapshot: %d sequences deleted meanwhile", len(missing))
+                for (dirpath, dirnames, filenames) in os.walk(tmp_target):
+                    for filename in filenames:
+                        realname = os.path.join(dirpath, filename)
+                        (digest, st) = BinaryFormat.loads_entry(open(realname, "rb").read())
+                        if digest not in missing:
+                            continue
+                        os.unlink(realname)
+                        files -= 1
+                        nbytes -= st.st_size
+                        sourcename = os.path.join(source, os.path.relpath(realname, tmp_target))
+                        if not os.path.isfile(sourcename):
+                            continue
+                        data = open(sourcename, "rb").read()
+                        (digest, st) = BinaryFormat.loads_entry(data)
+                        if digest != 0:
+                            seqname = os.path.join(self.filedigest_path, digest)
+                            if not os.path.isfile(seqname):
+                                logging.error("file %s should exist", seqname)
+                                continue
+                            self.__set_nref(seqname, self.__open_digest(digest).nref + 1)
+                        open(realname, "wb").write(data)
+                        files += 1
+                        nbytes += st.st_size
+            if not os.path.isdir(snapshot_path):
+                os.mkdir(snapshot_path)
+                directories += 1
+            os.rename(tmp_target, target)
+            self.usage.add("files", files)
+            self.usage.add("directories", directories + 1)
+            self.usage.add("logical_bytes", nbytes)
+
+    def delete_snapshot(self, name):
+        """delete SNAPSHOT_DIR/name, give back references of its entries"""
+        logging.info("delete_snapshot(%s)", name)
+        self.__check_snapshot_name(name)
+        target = os.path.join(self.__to_realpath(SNAPSHOT_DIR), name)
+        with self.lock:
+            if not os.path.isdir(target):
+                raise OSError(errno.ENOENT, "snapshot %s does not exist" % name)
+            # snapshot is gone at once, then its entries are deleted
+            tmp_target = tempfile.mkdtemp(dir=self.tmp_path, prefix="snapshot-")
+            os.rename(target, tmp_target)
+            (files, directories, nbytes) = (0, 0, 0)
+            for (dirpath, dirnames, filenames) in os.walk(tmp_target, topdown=False):
+                for filename in filenames:
+                    realname = os.path.join(dirpath, filename)
+                    (digest, st) = BinaryFormat.loads_entry(open(realname, "rb").read())
+                    if digest != 0:
+                        self.__delete_sequence(digest)
+                    os.unlink(realname)
+                    files += 1
+                    nbytes += st.st_size
+                os.rmdir(dirpath)
+                directories += 1
+            # entries of deleted paths may be cached
+            self.attr_cache.clear()
+            self.usage.add("files", -files)
+            self.usage.add("directories", -directories)
+            self.usage.add("logical_bytes", -nbytes)
+
+    def snapshots(self):
+        """returns sorted names of snapshots"""
+        snapshot_path = self.__to_realpath(SNAPSHOT_DIR)
+        if not os.path.isdir(snapshot_path):
+            return([])
+        return(sorted(os.listdir(snapshot_path)))
+
+    def is_virtual(self, abspath):
+        """true if abspath is the virtual statistics file"""
+        return(abspath == STATS_PATH)
+
+    def report(self):
+        """
+        returns dict of files, directories, logical_bytes, blocks,
+        physical_bytes, dedup_ratio and reclaim_pending, sequences
+        whose blocks are not yet deleted, from counters without a scan
+        """
+        result = self.usage.report()
+        result["reclaim_pending"] = self.reclaimer.pending
+        return(result)
+
+    def stats_text(self):
+        """returns content of virtual statistics file"""
+        lines = ["# TYPE pydedupfs_usage gauge"]
+        for (name, value) in sorted(self.report().items()):
+            lines.append("pydedupfs_usage{counter=\"%s\"} %s" % (name, float(value)))
+        return(self.stats.text() + "\n".join(lines) + "\n")
+
+    def __virtual_stat(self, abspath):
+        """returns stat of virtual directory or statistics file"""
+        st = StatDefaultFile()
+        if abspath == STATS_DIR:
+            st.st_mode = stat.S_IFDIR | 0555
+            st.st_nlink = 2
+        elif abspath == SNAPSHOT_DIR:
+            # snapshot directory before the first snapshot
+            st.st_mode = stat.S_IFDIR | 0755
+            st.st_nlink = 2
+        else:
+            st.st_mode = stat.S_IFREG | 0444
+            st.st_size = len(self.stats_text())
+        return(st)
 
     def create(self, abspath, mode=None):
         """like touch, create 0-byte if not exists"""
         logging.info("create(%s, %s)", abspath, mode)
-        if os.path.exists(self.__to_realpath(abspath)):
-            # fail silently if file exists
-            return
-        else:
-            st = StatDefaultFile()
-            if mode is not None:
-                st.mode = mode
-            self.__put_entry(abspath, 0, st, [])
-            return(0)
+        with self.lock:
+            if os.path.exists(self.__to_realpath(abspath)):
+                # fail silently if file exists
+                return
+            else:
+                self.__check_writable(abspath)
+                st = StatDefaultFile()
+                if mode is not None:
+                    st.mode = mode
+                self.__put_entry(abspath, 0, st)
+                self.usage.add("files", 1)
+                return(0)
 
     def mkdir(self, abspath, mode=None):
         """add new directory to database"""
         logging.info("mkdir(%s, %s)", abspath, mode)
+        if os.path.dirname(abspath) == SNAPSHOT_DIR:
+            self.snapshot("/", os.path.basename(abspath))
+            return
+        self.__check_writable(abspath)
         os.mkdir(self.__to_realpath(abspath), mode)
-
-    def __get_sequence(self, digest):
-        """return list of blockdigests to build data"""
-        logging.info("__get_sequence(%s)", digest)
-        cp_file = open(os.path.join(self.filedigest_path, digest), "rb")
-        (nref, sequence) = cPickle.load(cp_file)
-        cp_file.close()
-        return((nref, sequence))
+        self.usage.add("directories", 1)
 
     def __get_entry(self, abspath):
         """returns (digest, fuse.Stat) tuple of file abspath"""
         logging.debug("__get_entry(%s)", abspath)
-        cp_file = file(self.__to_realpath(abspath),"rb")
-        (digest, st) = cPickle.load(cp_file)
-        cp_file.close()
+        entry = self.attr_cache.get(abspath)
+        if entry is None:
+            entry = self.__load_entry(abspath)
+        return(entry)
+
+    def __load_entry(self, abspath):
+        """
+        returns (digest, fuse.Stat) tuple read from file abspath,
+        and puts it into attr_cache, if it was not changed meanwhile
+        """
+        index = self.__generation_index(abspath)
+        generation = self.generations[index]
+        rfile = open(self.__to_realpath(abspath), "rb")
+        data = rfile.read()
+        rfile.close()
+        (digest, st) = BinaryFormat.loads_entry(data)
+        self.attr_cache.put(abspath, (digest, st), lambda: self.generations[index] == generation)
         return((digest, st))
 
-    def __put_sequence(self, digest, sequence):
-        """save list of blockdigests to build data into file"""
+    def __dump(self, filename, data):
+        """
+        write string data to filename, data is written to a temporary file
+        first and renamed, so readers without lock never see half written files
+        """
+        (fd, tmpname) = tempfile.mkstemp(dir=self.tmp_path)
+        wfile = os.fdopen(fd, "wb")
+        wfile.write(data)
+        wfile.close()
+        os.rename(tmpname, filename)
+
+    def __put_sequence(self, digest, sequence_file):
+        """
+        move SequenceFile of written file into place,
+        every block in it holds a reference,
+        the sequence itself counts how many entries use it
+        """
         logging.info("__put_sequence(%s)", digest)
         filename = os.path.join(self.filedigest_path, digest)
-        if os.path.isfile(filename):
-            # this sequence already exists, this is a duplicate file
-            (nref, sequence) = self.__get_sequence(digest)
-            nref += 1
-            cp_file = open(filename, "wb")
-            cPickle.dump((nref, sequence), cp_file)
-            cp_file.close()
-        else:
-            # this is a new file
-            cp_file = open(filename, "wb")
-            cPickle.dump((1, sequence), cp_file)
-            cp_file.close()
+        with self.lock:
+            if os.path.isfile(filename):
+                # this sequence already exists, this is a duplicate file
+                # the writer got new references to the blocks, give them back
+                self.reclaimer.enqueue(sequence_file.finish(1))
+                sequence = self.__open_digest(digest)
+                self.__set_nref(filename, sequence.nref + 1)
+            else:
+                # this is a new file
+                os.rename(sequence_file.finish(1), filename)
+
+    def __set_nref(self, filename, nref):
+        """change reference counter of sequence file"""
+        if not BinaryFormat.update_sequence_nref(filename, nref):
+            # old cPickle file, write it again
+            (old_nref, sequence, lengths) = BinaryFormat.loads_sequence(open(filename, "rb").read())
+            self.__dump(filename, BinaryFormat.dumps_sequence(nref, sequence, lengths))
 
     def __delete_sequence(self, digest):
         """
         deletes sequence information, if no more references
-        and calles block_storage.delete() for each block in 
-        sequence
+        it is queued and the reclaimer calls block_storage.delete()
+        for each block in sequence
         """
         logging.info("__delete_sequence(%s)", digest)
         filename = os.path.join(self.filedigest_path, digest)
-        if os.path.isfile(filename):
-            cp_file = open(filename, "wb")
-            # should exist
-            (nref, sequence) = self.__get_sequence(digest)
-            if nref == 1: 
-                logging.debug("last reference, unlink file %s", filename)
-                if (sequence is not None) and (len(sequence) > 0):
-                    # last reference, so also delete blocks
-                    map(self.block_storage.delete, sequence)
-                os.unlink(filename)
-        else:
-            logging.error("file %s should exist", filename)
-        
+        with self.lock:
+            if os.path.isfile(filename):
+                # should exist
+                sequence = self.__open_digest(digest)
+                if sequence.nref <= 1:
+                    logging.debug("last reference, queue file %s", filename)
+                    # last reference, blocks are deleted in background
+                    self.reclaimer.enqueue(filename)
+                else:
+                    self.__set_nref(filename, sequence.nref - 1)
+            else:
+                logging.error("file %s should exist", filename)
 
-    def __put_entry(self, abspath, digest, st, sequence=None):
+
+    def __put_entry(self, abspath, digest, st):
         """write data to file"""
-        logging.debug("__put_entry(%s, digest=%s, st=%s, <sequence>)", abspath, digest, st)
-        cp_file = open(self.__to_realpath(abspath), "wb")
-        cPickle.dump((digest, st), cp_file)
-        cp_file.close()
-        # TODO remove verify of digest and st
-        (digest1, st1) = self.__get_entry(abspath)
-        assert digest == digest1
-        # save sequence, if no zero byte file
-        # TODO there is something wrong
-        if (digest != 0) and (sequence is not None) and (len(sequence) > 0):
-            self.__put_sequence(digest, sequence)
-            # TODO remove verify of sequence
-            assert sequence == self.__get_sequence(digest)
+        logging.debug("__put_entry(%s, digest=%s, st=%s)", abspath, digest, st)
+        self.__dump(self.__to_realpath(abspath), BinaryFormat.dumps_entry(digest, st))
+        self.__touch(abspath)
+        self.attr_cache.put(abspath, (digest, st))
 
     def unlink(self, abspath):
         """delete file from database"""
         logging.info("delete(%s)", abspath)
         # TODO critical sequence, what to delete first, and what if something went wrong
-        (digest, st) = self.__get_entry(abspath)
-        if digest != 0:
-            # indirator of 0-byte file, nothing to delete
-            self.__delete_sequence(digest)
-        # finally delete file
-        os.unlink(self.__to_realpath(abspath))
+        self.__check_writable(abspath)
+        with self.lock:
+            (digest, st) = self.__get_entry(abspath)
+            if digest != 0:
+                # indirator of 0-byte file, nothing to delete
+                self.__delete_sequence(digest)
+            # finally delete file
+            os.unlink(self.__to_realpath(abspath))
+            self.__touch(abspath)
+            self.attr_cache.invalidate(abspath)
+            self.usage.add("files", -1)
+            self.usage.add("logical_bytes", -st.st_size)
 
     def rmdir(self, abspath):
         """delete directory entry"""
+        if os.path.dirname(abspath) == SNAPSHOT_DIR:
+            self.delete_snapshot(os.path.basename(abspath))
+            return
+        self.__check_writable(abspath)
         # we trust fuse that it dont delete parent directories before childs
         os.rmdir(self.__to_realpath(abspath))
+        self.usage.add("directories", -1)
 
     def rename(self, abspath, abspath1):
         """rename entry"""
         logging.info("rename(%s, %s)", abspath, abspath1)
-        os.rename(self.__to_realpath(abspath), self.__to_realpath(abspath1))
+        self.__check_writable(abspath)
+        self.__check_writable(abspath1)
+        with self.lock:
+            if (abspath != abspath1) and os.path.isfile(self.__to_realpath(abspath1)):
+                # target is replaced, give back its reference
+                (digest, st) = self.__get_entry(abspath1)
+                if digest != 0:
+                    self.__delete_sequence(digest)
+                self.usage.add("files", -1)
+                self.usage.add("logical_bytes", -st.st_size)
+            elif (abspath != abspath1) and os.path.isdir(self.__to_realpath(abspath1)):
+                # empty target directory is replaced
+                self.usage.add("directories", -1)
+            os.rename(self.__to_realpath(abspath), self.__to_realpath(abspath1))
+            self.__touch(abspath)
+            self.__touch(abspath1)
+            if os.path.isdir(self.__to_realpath(abspath1)):
+                # paths of all entries below have changed
+                self.attr_cache.clear()
+            else:
+                self.attr_cache.invalidate(abspath)
+                self.attr_cache.invalidate(abspath1)
 
     def copy(self, abspath, abspath1):
         """copy file, not blocks, imitates hardlink"""
         logging.info("copy(%s, %s)", abspath, abspath1)
-        shutil.copy(self.__to_realpath(abspath), self.__to_relapath(abspath1))
+        # a file of a snapshot may be copied out of it
+        self.__check_writable(abspath1)
+        with self.lock:
+            (digest, st) = self.__get_entry(abspath)
+            old_digest = 0
+            if os.path.isfile(self.__to_realpath(abspath1)):
+                (old_digest, old_st) = self.__get_entry(abspath1)
+                self.usage.add("logical_bytes", st.st_size - old_st.st_size)
+            else:
+                self.usage.add("files", 1)
+                self.usage.add("logical_bytes", st.st_size)
+            if digest != 0:
+                # one more entry uses this sequence
+                filename = os.path.join(self.filedigest_path, digest)
+                self.__set_nref(filename, self.__open_digest(digest).nref + 1)
+            self.__put_entry(abspath1, digest, copy.copy(st))
+            if old_digest != 0:
+                # target is replaced, give back its reference
+                self.__delete_sequence(old_digest)
 
     def chown(self, abspath, uid, gid):
         """change ownership information"""
         logging.info("chown(%s, %s, %s)", abspath, uid, gid)
+        self.__check_writable(abspath)
         realpath = self.__to_realpath(abspath)
         if os.path.isdir(realpath):
             os.chown(realpath, uid, gid)
         else:
-            (digest, st) = self.__get_entry(abspath)
-            st.st_uid = uid
-            st.st_gid = gid
-            self.__put_entry(abspath, digest, st)
+            with self.lock:
+                (digest, st) = self.__get_entry(abspath)
+                st = copy.copy(st)
+                st.st_uid = uid
+                st.st_gid = gid
+                self.__put_entry(abspath, digest, st)
 
     def chmod(self, abspath, mode):
         """change mode"""
         logging.info("chmod(%s, %s)", abspath, mode)
+        self.__check_writable(abspath)
         realpath = self.__to_realpath(abspath)
         if os.path.isdir(realpath):
             os.chmod(realpath, mode)
         else:
-            (digest, st) = self.__get_entry(abspath)
-            st.st_mode = mode
-            self.__put_entry(abspath, digest, st)
+            with self.lock:
+                (digest, st) = self.__get_entry(abspath)
+                st = copy.copy(st)
+                st.st_mode = mode
+                self.__put_entry(abspath, digest, st)
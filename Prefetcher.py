@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""Prefetcher and ReadAhead Objects"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import Queue
+import logging
+import threading
+
+
+class Prefetcher(object):
+    """background worker threads, which load blocks into block_cache"""
+
+    def __init__(self, block_cache, loader, threads=4, maxqueue=256):
+        logging.debug("Prefetcher.__init__(%s, %s)", threads, maxqueue)
+        self.block_cache = block_cache
+        # loader(digest) returns data of block
+        self.loader = loader
+        self.queue = Queue.Queue(maxqueue)
+        # digests in queue or being loaded
+        self.queued = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self.__worker)
+            # set to daemon thread, so main thread can exit
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def __worker(self):
+        """load blocks from queue into block_cache"""
+        while True:
+            digest = self.queue.get()
+            try:
+                if digest not in self.block_cache:
+                    self.block_cache.get(digest, self.loader, prefetch=True)
+            except StandardError, exc:
+                # the reader will get the error again, if the block is needed
+                logging.error("prefetching block %s failed: %s", digest, exc)
+            finally:
+                with self.lock:
+                    self.queued.discard(digest)
+                self.queue.task_done()
+
+    def join(self):
+        """wait until every queued block is loaded"""
+        self.queue.join()
+
+    def prefetch(self, digests):
+        """
+        queue blocks to load, stops at the first block which does not
+        fit in queue, returns number of blocks queued or already there
+        """
+        accepted = 0
+        for digest in digests:
+            with self.lock:
+                if (digest in self.queued) or (digest in self.block_cache):
+                    accepted += 1
+                    continue
+                self.queued.add(digest)
+            try:
+                self.queue.put_nowait(digest)
+            except Queue.Full:
+                with self.lock:
+                    self.queued.discard(digest)
+                break
+            accepted += 1
+        return(accepted)
+
+
+class ReadAhead(object):
+    """
+    read ahead state of one open file
+
+    detects sequential reads and counts cache hits of them,
+    if too many blocks have to be read synchronously the window
+    of blocks to prefetch grows, random reads reset it
+    """
+
+    # adapt window after this many blocks read sequentially
+    PERIOD = 16
+    # grow window if hit ratio is below
+    MIN_HIT_RATIO = 0.9
+
+    def __init__(self, min_window, max_window):
+        self.min_window = min_window
+        self.max_window = max_window
+        self.window = min_window
+        self.sequential = False
+        # where the last read ended
+        self.last_end = None
+        self.last_length = 0
+        # index of block last counted
+        self.last_index = None
+        self.hits = 0
+        self.misses = 0
+
+    def access(self, offset, length):
+        """called at every read, true if read is sequential"""
+        if self.last_end is None:
+            # first read of file is likely the start of a sequential read
+            self.sequential = (offset == 0)
+        else:
+            # multithreaded fuse may deliver reads a little out of order
+            distance = offset - self.last_end
+            self.sequential = (-self.last_length <= distance <= 2 * max(length, self.last_length))
+        self.last_end = offset + length
+        self.last_length = length
+        if not self.sequential:
+            self.window = self.min_window
+            self.hits = 0
+            self.misses = 0
+        return(self.sequential)
+
+    def account(self, index, hit):
+        """count block index of a sequential read once, and adapt window"""
+        if index == self.last_index:
+            # small reads in the same block
+            return
+        self.last_index = index
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        if self.hits + self.misses >= self.PERIOD:
+            if float(self.hits) / (self.hits + self.misses) < self.MIN_HIT_RATIO:
+                # prefetching is behind the reader
+                self.window = min(self.window * 2, self.max_window)
+            self.hits = 0
+            self.misses = 0
@@ -41,13 +41,37 @@ import logging.config
 logging.config.fileConfig("logging.conf")
 # hashing library
 import hashlib
+import multiprocessing
 # own modules
 from MetaStorage import MetaStorage as MetaStorage
+from MetaStorage import BLOCK_STORAGES as BLOCK_STORAGES
+from MetaStorage import DEFAULT_STORAGE as DEFAULT_STORAGE
+from BlockStorageCompress import CODEC_NAMES as CODEC_NAMES
 from PyDedupFile import PyDedupFile as PyDedupFile
+from Chunker import FixedChunker as FixedChunker
+from Chunker import ContentChunker as ContentChunker
+from Stats import timed as timed
 
 # DEFAULT values use, if no others are applied
 DEFAULT_BLOCKSIZE = 1024 * 128
 DEFAULT_HASHFUNC = "sha1"
+DEFAULT_CHUNKER = "fixed"
+DEFAULT_CACHESIZE = 1024 * 1024 * 32
+DEFAULT_READAHEAD = 16
+DEFAULT_PREFETCHTHREADS = 4
+DEFAULT_COMPRESS = "none"
+DEFAULT_COMPRESSLEVEL = 6
+DEFAULT_JOURNALINTERVAL = 5
+DEFAULT_BLOOMSIZE = 16 * 1024 * 1024
+DEFAULT_ATTRCACHE = 65536
+DEFAULT_ATTRTTL = 60
+DEFAULT_ATTRTIMEOUT = 1.0
+DEFAULT_ENTRYTIMEOUT = 1.0
+DEFAULT_SCRUBRATE = 1024 * 1024
+try:
+    DEFAULT_HASHTHREADS = multiprocessing.cpu_count()
+except NotImplementedError:
+    DEFAULT_HASHTHREADS = 1
 
 class PyDedupFS(fuse.Fuse):
     """Fuse Interface Class"""
@@ -55,8 +79,9 @@ class PyDedupFS(fuse.Fuse):
     def __init__(self, *args, **kw):
         logging.debug("PyDedupFS.__init__(%s, %s)", args, kw)
         # Set some fuse Options, regardless of command line options
-        # does not work with threads
-        self.multithreaded = False
+        # every open file has its own write buffer,
+        # and MetaStorage and BlockStorage lock their updates
+        self.multithreaded = True
         self.direct_io = False
         self.keep_cache = False
         self.fsname = "PyDedupFS"
@@ -74,6 +99,19 @@ class PyDedupFS(fuse.Fuse):
         self.blocksize = DEFAULT_BLOCKSIZE
         self.str_hashfunc = "sha1"
         self.hashfunc = hashlib.sha1
+        self.chunker = None
+        self.cachesize = DEFAULT_CACHESIZE
+        self.readahead = DEFAULT_READAHEAD
+        self.prefetchthreads = DEFAULT_PREFETCHTHREADS
+        self.storage = DEFAULT_STORAGE
+        self.compress = DEFAULT_COMPRESS
+        self.compresslevel = DEFAULT_COMPRESSLEVEL
+        self.hashthreads = DEFAULT_HASHTHREADS
+        self.journalinterval = DEFAULT_JOURNALINTERVAL
+        self.bloomsize = DEFAULT_BLOOMSIZE
+        self.attrcache = DEFAULT_ATTRCACHE
+        self.attrttl = DEFAULT_ATTRTTL
+        self.scrubrate = DEFAULT_SCRUBRATE
         # wrapper to own file class, to pass meta_storage object
         # has to be in __init__ to function properly
         class PyDedupFileWrapper(PyDedupFile):
@@ -82,6 +120,7 @@ class PyDedupFS(fuse.Fuse):
         # set own file class
         self.file_class = PyDedupFileWrapper
 
+    @timed("fs_getattr")
     def getattr(self, path):
         """
         return stat information
@@ -90,6 +129,7 @@ class PyDedupFS(fuse.Fuse):
         logging.debug("PyDedupFS.getattr(%s)", path)
         return(self.meta_storage.getattr(path))
 
+    @timed("fs_readlink")
     def readlink(self, path):
         """
         return path to which link is pointing to
@@ -98,31 +138,40 @@ class PyDedupFS(fuse.Fuse):
         logging.debug("PyDedupFS.readlink(%s)", path)
         return(None)
 
+    @timed("fs_readdir")
     def readdir(self, path, offset):
         """
-        yield fuse.Direntry(str(name of file), inode)
-        prepend . and .. entries
+        return list of fuse.Direntry(name, offset, type) of the next names
+        after offset, the kernel asks again with the offset of the
+        last name it took, until the list is empty, so a huge directory
+        is listed in batches, entries are cached for the following getattr
         """
         logging.debug("PyDedupFS.readdir(%s, offset=%s)", path, offset)
-        for entry in self.meta_storage.readdir(path):
-            yield fuse.Direntry(entry)
+        # a list, so the time of the whole batch is recorded
+        return([fuse.Direntry(name, offset=nextoffset, type=filetype >> 12) for (name, nextoffset, filetype) in self.meta_storage.readdir(path, offset)])
 
+    @timed("fs_unlink")
     def unlink(self, path):
         """unlink file"""
         logging.debug("PyDedupFS.unlink(%s)", path)
         self.meta_storage.unlink(path)
         return(0)
 
+    @timed("fs_rmdir")
     def rmdir(self, path):
         """remove directory"""
         logging.debug("PyDedupFS.rmdir(%s)", path)
         self.meta_storage.rmdir(path)
         return(0)
 
+    @timed("fs_truncate")
     def truncate(self, path, offset):
         """change the size of a file"""
         logging.debug("PyDedupFS.truncate(%s, offset=%s)", path, offset)
+        self.meta_storage.truncate(path, offset)
+        return(0)
 
+    @timed("fs_symlink")
     def symlink(self, path, symlink):
         """
         create symlink from path to path1
@@ -133,6 +182,7 @@ class PyDedupFS(fuse.Fuse):
         logging.debug("PyDedupFS.symlink(%s, %s)", path, symlink)
         return(None)
 
+    @timed("fs_rename")
     def rename(self, path, path1):
         """
         return 0 if all went ok
@@ -145,6 +195,7 @@ class PyDedupFS(fuse.Fuse):
         self.meta_storage.rename(path, path1)
         return(0)
 
+    @timed("fs_link")
     def link(self, path, path1):
         """
         return 0 if all went ok
@@ -159,6 +210,7 @@ class PyDedupFS(fuse.Fuse):
         # map link to copy
         self.meta_storage.copy(path, path1)
 
+    @timed("fs_chmod")
     def chmod(self, path, mode):
         """
         0 if success
@@ -168,6 +220,7 @@ class PyDedupFS(fuse.Fuse):
         self.meta_storage.chmod(path, mode)
         return(0)
 
+    @timed("fs_chown")
     def chown(self, path, user, group):
         """
         0 is success
@@ -177,6 +230,7 @@ class PyDedupFS(fuse.Fuse):
         self.meta_storage.chown(path, user, group)
         return(0)
 
+    @timed("fs_mknod")
     def mknod(self, path, mode, dev):
         """
         we dont want special Files
@@ -185,12 +239,14 @@ class PyDedupFS(fuse.Fuse):
         logging.debug("PyDedupFS.mknod(%s, mode=%s, dev=%s)", path, mode, dev)
         return(None)
 
+    @timed("fs_mkdir")
     def mkdir(self, path, mode):
         """create directory"""
         logging.debug("PyDedupFS.mkdir(%s, mode=%s)", path, mode)
         self.meta_storage.mkdir(path, mode)
         return(0)
 
+    @timed("fs_utime")
     def utime(self, path, times):
         """deprecated applications should use utimens"""
         logging.debug("PyDedupFS.utime(%s, times=%s)", path, times)
@@ -198,6 +254,7 @@ class PyDedupFS(fuse.Fuse):
         self.meta_storage.utime(path, atime, mtime)
         return(0)
 
+    @timed("fs_utimens")
     def utimens(self, path, ts_atime, ts_mtime):
         """sets mtime and atime of file"""
         logging.debug("PyDedupFS.utimens(%s, %s.%s, %s.%s)", path, ts_atime.tv_sec, ts_atime.tv_nsec, ts_mtime.tv_sec, ts_mtime.tv_nsec)
@@ -205,6 +262,7 @@ class PyDedupFS(fuse.Fuse):
         mtime = ts_mtime.tv_sec + (ts_mtime.tv_nsec / 1000000.0)
         self.meta_storage.utime(path, atime, mtime)
 
+    @timed("fs_access")
     def access(self, path, mode):
         """
         0 if file is accessible
@@ -213,6 +271,7 @@ class PyDedupFS(fuse.Fuse):
         """
         logging.debug("PyDedupFS.access(%s, mode=%s)", path, mode)
 
+    @timed("fs_statfs")
     def statfs(self):
         """
         Should return an object with statvfs attributes (f_bsize, f_frsize...).
@@ -233,22 +292,25 @@ class PyDedupFS(fuse.Fuse):
         """
         logging.debug("PyDedupFS.statfs()")
         # from https://github.com/xolox/dedupfs/blob/master/dedupfs.py
-        # TODO make this a parameter
+        # used space is the logical size of all files, as df of the
+        # original data would show it, free space is that of the host,
+        # totals come from usage counters, no scan of the filesystem
         host_fs = os.statvfs(self.base)
+        usage = self.meta_storage.report()
         return fuse.StatVfs(
-            f_bavail = (host_fs.f_bsize * host_fs.f_bavail) / self.blocksize, 
+            f_bavail = (host_fs.f_frsize * host_fs.f_bavail) / self.blocksize, 
             # The total number of free blocks available to a non privileged process.
             f_bfree = (host_fs.f_frsize * host_fs.f_bfree) / self.blocksize, 
             # The total number of free blocks in the file system.
-            f_blocks = (host_fs.f_frsize * host_fs.f_blocks) / self.blocksize, 
+            f_blocks = (usage["logical_bytes"] + host_fs.f_frsize * host_fs.f_bfree) / self.blocksize, 
             # The total number of blocks in the file system in terms of f_frsize.
             f_bsize = self.blocksize, 
             # The file system block size in bytes.
-            f_favail = 0, 
+            f_favail = host_fs.f_favail, 
             # The number of free file serial numbers available to a non privileged process.
-            f_ffree = 0, 
+            f_ffree = host_fs.f_ffree, 
             # The total number of free file serial numbers.
-            f_files = 0, 
+            f_files = usage["files"] + usage["directories"] + host_fs.f_ffree, 
             # The total number of file serial numbers.
             f_flag = 0, 
             # File system flags. Symbols are defined in the <sys/statvfs.h> header file to refer to bits in this field (see The f_flags field).
@@ -270,11 +332,52 @@ class PyDedupFS(fuse.Fuse):
             self.str_hasfunc = options.str_hashfunc
             logging.info("Hash Function  : hashlib.%s", self.hashfunc)
             self.hashfunc = getattr(hashlib, self.str_hashfunc)
+            if options.chunker == "cdc":
+                # content defined chunking, sizes default around blocksize
+                chunkavg = options.chunkavg or self.blocksize
+                chunkmin = options.chunkmin or chunkavg / 4
+                chunkmax = options.chunkmax or chunkavg * 4
+                self.chunker = ContentChunker(chunkmin, chunkavg, chunkmax)
+                logging.info("Chunker        : cdc min=%s avg=%s max=%s", chunkmin, chunkavg, chunkmax)
+            else:
+                self.chunker = FixedChunker(self.blocksize)
+                logging.info("Chunker        : fixed")
+            self.cachesize = options.cachesize
+            logging.info("Block Cache    : %s bytes", self.cachesize)
+            self.readahead = options.readahead
+            self.prefetchthreads = options.prefetchthreads
+            logging.info("Read Ahead     : %s blocks, %s threads", self.readahead, self.prefetchthreads)
+            self.storage = options.storage
+            logging.info("Block Storage  : %s", self.storage)
+            self.compress = options.compress
+            self.compresslevel = options.compresslevel
+            logging.info("Compression    : %s level %s", self.compress, self.compresslevel)
+            self.hashthreads = options.hashthreads
+            logging.info("Hash Threads   : %s", self.hashthreads)
+            self.journalinterval = options.journalinterval
+            logging.info("Journal        : every %s seconds", self.journalinterval)
+            self.bloomsize = options.bloomsize
+            logging.info("Bloom Filter   : %s bytes", self.bloomsize)
+            self.attrcache = options.attrcache
+            self.attrttl = options.attrttl
+            logging.info("Attr Cache     : %s entries, %s seconds", self.attrcache, self.attrttl)
+            self.scrubrate = options.scrubrate
+            logging.info("Scrubber       : %s bytes per second", self.scrubrate)
         except StandardError, exc:
             logging.exception(exc)
         # initialize meta_storage properly
         logging.info("Initialize MetaStorage")
-        self.meta_storage = MetaStorage(self.base, self.blocksize, self.hashfunc)
+        self.meta_storage = MetaStorage(self.base, self.blocksize, self.hashfunc, chunker=self.chunker,
+            cachesize=self.cachesize, readahead=self.readahead, prefetchthreads=self.prefetchthreads,
+            storage=self.storage, compress=self.compress, compresslevel=self.compresslevel,
+            hashthreads=self.hashthreads, journalinterval=self.journalinterval, bloomsize=self.bloomsize,
+            attrcache=self.attrcache, attrttl=self.attrttl, scrubrate=self.scrubrate)
+
+    def fsdestroy(self):
+        """called at unmount"""
+        logging.debug("PyDedupFS.fsdestroy()")
+        if self.meta_storage is not None:
+            self.meta_storage.close()
 
     def main(self, *a, **kw):
         # enter endless loop
@@ -297,8 +400,65 @@ def main():
     server.parser.add_option("--blocksize", dest="blocksize", 
         type="int", default=DEFAULT_BLOCKSIZE,
         help="Blocksize to use, default %default")
+    server.parser.add_option("--chunker", dest="chunker",
+        type="choice", choices=["fixed", "cdc"], default=DEFAULT_CHUNKER,
+        help="how to cut data into blocks, fixed blocksize or content defined <fixed, cdc>, default %default")
+    server.parser.add_option("--chunkmin", dest="chunkmin",
+        type="int", default=0,
+        help="minimum block length for cdc chunker, default blocksize / 4")
+    server.parser.add_option("--chunkavg", dest="chunkavg",
+        type="int", default=0,
+        help="average block length for cdc chunker, default blocksize")
+    server.parser.add_option("--chunkmax", dest="chunkmax",
+        type="int", default=0,
+        help="maximum block length for cdc chunker, default blocksize * 4")
+    server.parser.add_option("--cachesize", dest="cachesize",
+        type="int", default=DEFAULT_CACHESIZE,
+        help="bytes of recently read blocks to hold in memory, default %default")
+    server.parser.add_option("--readahead", dest="readahead",
+        type="int", default=DEFAULT_READAHEAD,
+        help="maximum number of blocks to prefetch for sequential reads, 0 to disable, default %default")
+    server.parser.add_option("--prefetchthreads", dest="prefetchthreads",
+        type="int", default=DEFAULT_PREFETCHTHREADS,
+        help="number of threads prefetching blocks, default %default")
+    server.parser.add_option("--storage", dest="storage",
+        type="choice", choices=sorted(BLOCK_STORAGES.keys()), default=DEFAULT_STORAGE,
+        help="how to store blocks <%s>, default %%default" % ", ".join(sorted(BLOCK_STORAGES.keys())))
+    server.parser.add_option("--compress", dest="compress",
+        type="choice", choices=sorted(CODEC_NAMES.keys()), default=DEFAULT_COMPRESS,
+        help="compression of new blocks <%s>, default %%default" % ", ".join(sorted(CODEC_NAMES.keys())))
+    server.parser.add_option("--compresslevel", dest="compresslevel",
+        type="int", default=DEFAULT_COMPRESSLEVEL,
+        help="compression level 1 (fast) to 9 (small), default %default")
+    server.parser.add_option("--hashthreads", dest="hashthreads",
+        type="int", default=DEFAULT_HASHTHREADS,
+        help="number of threads hashing and storing written blocks, 0 to do it in the writing thread, default number of cpus")
+    server.parser.add_option("--journalinterval", dest="journalinterval",
+        type="int", default=DEFAULT_JOURNALINTERVAL,
+        help="seconds between writes of collected reference counters, 0 to write every change at once, default %default")
+    server.parser.add_option("--bloomsize", dest="bloomsize",
+        type="int", default=DEFAULT_BLOOMSIZE,
+        help="bytes of bloom filter to detect new blocks without lookup, 0 to disable, default %default")
+    server.parser.add_option("--attrcache", dest="attrcache",
+        type="int", default=DEFAULT_ATTRCACHE,
+        help="number of file entries to hold in memory, 0 to disable, default %default")
+    server.parser.add_option("--attrttl", dest="attrttl",
+        type="int", default=DEFAULT_ATTRTTL,
+        help="seconds a file entry is held in memory, default %default")
+    server.parser.add_option("--attrtimeout", dest="attrtimeout",
+        type="float", default=DEFAULT_ATTRTIMEOUT,
+        help="seconds the kernel caches attributes, fuse option attr_timeout, default %default")
+    server.parser.add_option("--entrytimeout", dest="entrytimeout",
+        type="float", default=DEFAULT_ENTRYTIMEOUT,
+        help="seconds the kernel caches names, fuse option entry_timeout, default %default")
+    server.parser.add_option("--scrubrate", dest="scrubrate",
+        type="int", default=DEFAULT_SCRUBRATE,
+        help="bytes per second to verify stored blocks in background, 0 to disable, default %default")
    
     server.parse(values=server, errex=1)
+    # let the kernel cache too
+    server.fuse_args.add("attr_timeout", str(server.attrtimeout))
+    server.fuse_args.add("entry_timeout", str(server.entrytimeout))
     server.main()
 
 
@@ -23,18 +23,24 @@ __version__ = "$Revision$"
 __date__ = "$Date$"
 # $Id
 
+import os
+import errno
+import threading
 # Logging
 import logging
 
+from Stats import timed as timed
+
 
 class PyDedupFile(object):
     """Fuse File Interface"""
 
+    @timed("file_open")
     def __init__(self, meta_storage, path, flags, *mode):
         """called to open file"""
         # use explicit Logger Naming, because this class is wrapped
         # so __class__.__name__ would be not PyDedupFile
-        logging.info("PyDedupFile.__init__(%s, %s, %s)", path, flags, mode)
+        logging.debug("PyDedupFile.__init__(%s, %s, %s)", path, flags, mode)
         self.path = path
         self.mode = mode
         self.flags = flags
@@ -44,34 +50,70 @@ class PyDedupFile(object):
         self.keep_cache = False
         # dirty flag, used in release()
         self.isdirty = False
+        # Sequence of file, loaded at first read
+        self.sequence = None
+        # detects sequential reads, to prefetch following blocks
+        self.readahead = self.meta_storage.new_readahead()
+        # every open file has its own write buffer, created at first write
+        self.write_buffer = None
+        # with O_TRUNC old content is not used for the new file
+        self.truncate = bool(flags & os.O_TRUNC)
+        # fuse may call methods of one file from different threads
+        self.lock = threading.Lock()
+        # content of virtual statistics file, taken at open
+        self.virtual = None
+        if self.meta_storage.is_virtual(self.path):
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                raise IOError(errno.EACCES, "%s is read only" % path)
+            self.virtual = self.meta_storage.stats_text()
+            # content is longer than size in getattr, read to the end
+            self.direct_io = True
+            return
+        if self.meta_storage.is_snapshot(self.path) and (flags & (os.O_WRONLY | os.O_RDWR | os.O_TRUNC)):
+            raise IOError(errno.EROFS, "%s is read only" % path)
         # touch file, it has to exist after __init__
         self.meta_storage.create(self.path)
 
+    @timed("file_read")
     def read(self, length, offset):
         """
         return data on success
         return errno.EIO is something went wrong
         """
         logging.debug("PyDedupFile.read(%s, %s)", length, offset)
-        return(self.meta_storage.read(self.path, length, offset))
+        if self.virtual is not None:
+            return(self.virtual[offset:offset + length])
+        sequence = self.sequence
+        if (sequence is None) or (not self.meta_storage.is_current(self.path, sequence)):
+            sequence = self.meta_storage.open_sequence(self.path)
+            self.sequence = sequence
+        return(self.meta_storage.read(self.path, length, offset, self.readahead, sequence))
 
+    @timed("file_write")
     def write(self, buf, offset):
         """
         return len of written data
         return errno.EACCES is File is not writeable
         return errno.EIO if something went wrong
         """
-        logging.info("PyDedupFile.write(<buf>, %s)", offset)
-        self.isdirty = True
+        logging.debug("PyDedupFile.write(<buf>, %s)", offset)
         # write returns lenght of written data
         try:
-            len_buf = self.meta_storage.write(self.path, buf, offset)
+            # flush or ftruncate on another thread must not
+            # release or discard the buffer while data is added
+            with self.lock:
+                self.isdirty = True
+                self.sequence = None
+                if self.write_buffer is None:
+                    self.write_buffer = self.meta_storage.new_write_buffer(self.path, self.truncate)
+                len_buf = self.write_buffer.add(buf, offset)
             logging.debug("Wrote %d bytes", len_buf)
             return(len_buf)
         except StandardError, exc:
             logging.exception(exc)
             raise exc
 
+    @timed("file_release")
     def release(self, flags):
         """
         return 0 if all is OK
@@ -80,27 +122,55 @@ class PyDedupFile(object):
         for every open one release
         NOT IMPLEMETED stub
         """
-        logging.info("PyDedupFile.release(%s)", flags)
+        logging.debug("PyDedupFile.release(%s)", flags)
 
+    @timed("file_fsync")
     def fsync(self, isfsyncfile):
         """NOT Implemented stub, is it necessary"""
-        logging.info("PyDedupFile.fsync(%s)", isfsyncfile)
+        logging.debug("PyDedupFile.fsync(%s)", isfsyncfile)
 
+    @timed("file_flush")
     def flush(self):
         """close file, write remaining buffers if dirty"""
-        logging.info("PyDedupFile.flush()")
+        logging.debug("PyDedupFile.flush()")
         try:
-            if self.isdirty is True:
-                self.meta_storage.release(self.path)
-                self.isdirty = False
+            with self.lock:
+                if self.isdirty is True:
+                    self.meta_storage.release(self.path, self.write_buffer)
+                    self.isdirty = False
+                    # later writes start with the content just written
+                    self.write_buffer = None
+                    self.truncate = False
+                    self.sequence = None
         except StandardError, exc:
             logging.exception(exc)
 
+    @timed("file_fgetattr")
     def fgetattr(self):
         """return st struct for file"""
-        logging.info("PyDedupFile.fgetattr()")
+        logging.debug("PyDedupFile.fgetattr()")
         return(self.meta_storage.getattr(self.path))
 
+    @timed("file_ftruncate")
     def ftruncate(self, length):
-        """NOT Implemented stub"""
-        logging.info("PyDedupFile.ftruncate(%s)", length)
+        """
+        truncate file, only length 0 is implemented,
+        any other length than the size of the file fails with EOPNOTSUPP
+        """
+        logging.debug("PyDedupFile.ftruncate(%s)", length)
+        if self.virtual is not None:
+            raise IOError(errno.EACCES, "%s is read only" % self.path)
+        if length != 0:
+            with self.lock:
+                if self.isdirty:
+                    # size of data not yet released is unknown
+                    raise IOError(errno.EOPNOTSUPP, "ftruncate to length %s is not implemented" % length)
+            self.meta_storage.truncate(self.path, length)
+            return
+        with self.lock:
+            if self.write_buffer is not None:
+                self.write_buffer.discard()
+                self.write_buffer = None
+            self.isdirty = False
+            self.truncate = True
+            self.meta_storage.truncate(self.path, 0)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""Reclaimer Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import logging
+import tempfile
+import threading
+
+from Sequence import load_sequence as load_sequence
+
+# block references given back at once, the cursor is saved before each batch
+BATCH_SIZE = 1024
+# seconds to wait before sequences which failed are tried again
+RETRY_INTERVAL = 60
+
+
+class Reclaimer(object):
+    """
+    gives back the block references of deleted sequences in background,
+    so deleting a file only moves its sequence into queue_path
+
+    queued sequences get a serial number in front of their name, so
+    they are done in order, and a newer sequence of the same digest
+    never replaces one still queued, before every batch of blocks the
+    number of blocks done is saved in a .cursor file next to the
+    sequence, after a crash at most one batch of references is kept,
+    which garbagecollect.py gives back, but none is given back twice
+    """
+
+    def __init__(self, block_storage, queue_path):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("Reclaimer.__init__(%s, %s)", block_storage, queue_path)
+        self.block_storage = block_storage
+        self.queue_path = queue_path
+        self.lock = threading.Lock()
+        queued = self.__queued()
+        self.serial = max([int(name.split("-")[0], 16) for name in queued] + [0]) + 1
+        # number of sequences in queue
+        self.pending = len(queued)
+        # counters for report
+        self.num_sequences = 0
+        self.num_blocks = 0
+        self.num_failed = 0
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.__do_reclaim)
+        # set to daemon thread, so main thread can exit
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __queued(self):
+        """sorted names of sequences in queue"""
+        return(sorted(name for name in os.listdir(self.queue_path) if not (name.startswith("tmp") or name.endswith(".cursor"))))
+
+    def enqueue(self, filename):
+        """move sequence file filename into queue, its blocks are given back later"""
+        with self.lock:
+            name = "%016x-%s" % (self.serial, os.path.basename(filename))
+            self.serial += 1
+            os.rename(filename, os.path.join(self.queue_path, name))
+            self.pending += 1
+        self.wakeup.set()
+
+    def __save_cursor(self, filename, position):
+        """write number of blocks done"""
+        (fd, tmpname) = tempfile.mkstemp(dir=self.queue_path)
+        wfile = os.fdopen(fd, "wb")
+        wfile.write(str(position))
+        wfile.close()
+        os.rename(tmpname, filename)
+
+    def __reclaim(self, name, stoppable=True):
+        """give back references of queued sequence name, returns False if stopped"""
+        filename = os.path.join(self.queue_path, name)
+        cursor_filename = filename + ".cursor"
+        sequence = load_sequence(filename, 0)
+        if sequence.per_occurrence:
+            blocks = sequence
+        else:
+            # older sequences hold one reference per distinct block
+            blocks = sorted(set(sequence))
+        position = 0
+        if os.path.isfile(cursor_filename):
+            position = int(open(cursor_filename, "rb").read())
+        while position < len(blocks):
+            if stoppable and self.stopped:
+                return(False)
+            end = min(position + BATCH_SIZE, len(blocks))
+            self.__save_cursor(cursor_filename, end)
+            for index in xrange(position, end):
+                self.block_storage.delete(blocks[index])
+            self.num_blocks += end - position
+            position = end
+        os.unlink(filename)
+        if os.path.isfile(cursor_filename):
+            os.unlink(cursor_filename)
+        with self.lock:
+            self.pending -= 1
+        self.num_sequences += 1
+        return(True)
+
+    def __reclaim_all(self, stoppable=True):
+        """give back references of all queued sequences, returns False if one failed"""
+        ok = True
+        for name in self.__queued():
+            try:
+                if not self.__reclaim(name, stoppable):
+                    break
+            except StandardError, exc:
+                # stays in queue, tried again later
+                self.logger.error("reclaiming sequence %s failed: %s", name, exc)
+                self.num_failed += 1
+                ok = False
+        return(ok)
+
+    def __do_reclaim(self):
+        """thread, works on queue whenever sequences are added"""
+        while not self.stopped:
+            self.wakeup.clear()
+            if self.__reclaim_all():
+                self.wakeup.wait()
+            else:
+                self.wakeup.wait(RETRY_INTERVAL)
+
+    def close(self, drain=False):
+        """stop thread, with drain give back all references in queue first"""
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        if drain:
+            self.__reclaim_all(False)
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        outfunc("Sequences to reclaim    : %s" % self.pending)
+        outfunc("Sequences reclaimed     : %s, %s blocks" % (self.num_sequences, self.num_blocks))
+        outfunc("Reclaims failed         : %s" % self.num_failed)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""Scrubber Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import time
+import heapq
+import logging
+import tempfile
+import threading
+
+# digest verified last, in db_path
+CURSOR_FILENAME = "scrubber.cursor"
+# seconds between saves of cursor
+SAVE_INTERVAL = 60
+# seconds to wait after all blocks are verified
+PASS_INTERVAL = 60
+# seconds to wait while filesystem is busy, doubled up to MAX_BACKOFF
+MIN_BACKOFF = 1
+MAX_BACKOFF = 64
+# digests verified per scan of block storage, only these are held in memory
+BATCH_SIZE = 65536
+# seconds to wait before a mismatch is read again,
+# a block being stored right now may be incomplete
+RECHECK_DELAY = 1
+
+
+class Scrubber(object):
+    """
+    verifies stored blocks again in the background, in sorted order
+    of digests, corrupted blocks are quarantined
+
+    reading and hashing get rate bytes per second, the time it takes
+    counts against this budget, the scrubber waits while the filesystem
+    is busy, activity() returns a counter of operations and more than
+    busyops per second is busy, the digest verified last is saved in
+    db_path, so after the next mount scrubbing continues there
+
+    digests are not sorted at once, every batch is the next BATCH_SIZE
+    digests behind the cursor, taken by one scan of block storage
+    """
+
+    def __init__(self, block_storage, hashfunc, db_path, rate, activity, busyops=50):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("Scrubber.__init__(%s, %s, %s, %s, %s, %s)", block_storage, hashfunc, db_path, rate, activity, busyops)
+        self.block_storage = block_storage
+        self.hashfunc = hashfunc
+        self.db_path = db_path
+        self.filename = os.path.join(db_path, CURSOR_FILENAME)
+        self.rate = rate
+        self.activity = activity
+        self.busyops = busyops
+        # digests up to cursor are verified in this pass
+        self.cursor = ""
+        if os.path.isfile(self.filename):
+            self.cursor = open(self.filename, "rb").read().strip()
+        self.saved = time.time()
+        self.last_ops = activity()
+        self.last_time = time.time()
+        # counters for report
+        self.num_verified = 0
+        self.bytes_verified = 0
+        self.num_corrupted = 0
+        self.num_backoffs = 0
+        self.num_passes = 0
+        self.stopped = False
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.__do_scrub)
+        # set to daemon thread, so main thread can exit
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def __save(self):
+        """write cursor"""
+        (fd, tmpname) = tempfile.mkstemp(dir=self.db_path)
+        wfile = os.fdopen(fd, "wb")
+        wfile.write(self.cursor)
+        wfile.close()
+        os.rename(tmpname, self.filename)
+        self.saved = time.time()
+
+    def __idle(self):
+        """waits until filesystem is not busy, returns False if stopped"""
+        backoff = MIN_BACKOFF
+        while not self.stopped:
+            now = time.time()
+            if now - self.last_time < 1:
+                # too short to measure
+                return(True)
+            ops = self.activity()
+            busy = (ops - self.last_ops) > self.busyops * (now - self.last_time)
+            self.last_ops = ops
+            self.last_time = now
+            if not busy:
+                return(True)
+            self.num_backoffs += 1
+            self.wakeup.wait(backoff)
+            backoff = min(backoff * 2, MAX_BACKOFF)
+        return(False)
+
+    def __matches(self, digest):
+        """
+        returns (data matches digest, bytes read),
+        None instead of True or False if block is gone
+        """
+        try:
+            data = self.block_storage.get(digest)
+        except StandardError, exc:
+            # deleted meanwhile, or not readable at all
+            if self.block_storage.exists(digest):
+                return((False, 0))
+            return((None, 0))
+        return((self.hashfunc(data).hexdigest() == digest, len(data)))
+
+    def __verify(self, digest):
+        """verify one block, returns bytes read"""
+        if self.block_storage.is_quarantined(digest):
+            return(0)
+        (matches, nbytes) = self.__matches(digest)
+        if matches is False:
+            self.wakeup.wait(RECHECK_DELAY)
+            (matches, nbytes) = self.__matches(digest)
+            if matches is False:
+                self.num_corrupted += 1
+                self.block_storage.quarantine(digest)
+        self.num_verified += 1
+        self.bytes_verified += nbytes
+        return(nbytes)
+
+    def __batch(self):
+        """returns sorted list of the next BATCH_SIZE digests behind cursor"""
+        cursor = self.cursor
+        return(heapq.nsmallest(BATCH_SIZE, (digest for digest in self.block_storage.digests() if digest > cursor)))
+
+    def __do_scrub(self):
+        """thread, verifies all blocks again and again"""
+        while not self.stopped:
+            while self.__idle():
+                digests = self.__batch()
+                if len(digests) == 0:
+                    break
+                for digest in digests:
+                    if not self.__idle():
+                        break
+                    start = time.time()
+                    nbytes = self.__verify(digest)
+                    self.wakeup.wait(max(0, float(nbytes) / self.rate - (time.time() - start)))
+                    self.cursor = digest
+                    if time.time() - self.saved > SAVE_INTERVAL:
+                        self.__save()
+            if not self.stopped:
+                self.logger.info("scrubbed all blocks, %d corrupted", self.num_corrupted)
+                self.num_passes += 1
+                self.cursor = ""
+                self.__save()
+                self.wakeup.wait(PASS_INTERVAL)
+
+    def close(self):
+        """stop thread, save cursor"""
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join()
+        self.__save()
+
+    def report(self, outfunc):
+        """prints report with outfunc"""
+        outfunc("Blocks scrubbed         : %s, %s bytes" % (self.num_verified, self.bytes_verified))
+        outfunc("Blocks corrupted        : %s" % self.num_corrupted)
+        outfunc("Scrubber passes / waits : %s / %s" % (self.num_passes, self.num_backoffs))
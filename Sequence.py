@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""Sequence Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import mmap
+import array
+import bisect
+import binascii
+
+import BinaryFormat
+
+
+class Sequence(object):
+    """
+    list of blockdigests to assemble a file,
+    with an index of the offset every block starts at
+    """
+
+    def __init__(self, digests, lengths, blocksize, nref=1, per_occurrence=False):
+        """lengths is None for old sequences with fixed blocksize"""
+        self.digests = digests
+        self.nref = nref
+        # true if every block in sequence holds a reference,
+        # else only every distinct block
+        self.per_occurrence = per_occurrence
+        # offset of first byte of every block, native unsigned long
+        self.offsets = array.array("L")
+        offset = 0
+        for index in xrange(len(digests)):
+            self.offsets.append(offset)
+            if lengths is None:
+                offset += blocksize
+            else:
+                offset += lengths[index]
+        # set by MetaStorage, to detect changes of file
+        self.generation = None
+
+    def __len__(self):
+        return(len(self.digests))
+
+    def __getitem__(self, index):
+        return(self.digests[index])
+
+    def locate(self, offset):
+        """return (index of block, offset in block) of file offset"""
+        index = bisect.bisect_right(self.offsets, offset) - 1
+        if index < 0:
+            return((0, offset))
+        return((index, offset - self.offsets[index]))
+
+
+class MappedSequence(object):
+    """
+    Sequence of binary sequence file, mapped into memory,
+    digests and offsets are read from file when needed,
+    so memory use does not grow with length of file
+
+    a sequence file is replaced by rename, never changed,
+    but the reference counter, so the mapping stays valid
+    """
+
+    def __init__(self, filename, blocksize):
+        rfile = open(filename, "rb")
+        self.map = mmap.mmap(rfile.fileno(), 0, access=mmap.ACCESS_READ)
+        rfile.close()
+        (flags, self.nref, self.count, self.digest_len, self.digest_start, self.ends_start, stride) = BinaryFormat.sequence_layout(self.map[:64])
+        if stride is None:
+            # version 1
+            (self.digest_stride, self.ends_stride) = (self.digest_len, BinaryFormat.END_OFFSET.size)
+        else:
+            (self.digest_stride, self.ends_stride) = (stride, stride)
+        self.blocksize = blocksize
+        self.fixed = not flags & BinaryFormat.FLAG_LENGTHS
+        self.per_occurrence = bool(flags & BinaryFormat.FLAG_OCCURRENCE)
+        # set by MetaStorage, to detect changes of file
+        self.generation = None
+
+    def __len__(self):
+        return(self.count)
+
+    def __digest(self, index):
+        """hexdigest of block index"""
+        start = self.digest_start + index * self.digest_stride
+        return(binascii.hexlify(self.map[start:start + self.digest_len]))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return([self.__digest(i) for i in xrange(*index.indices(self.count))])
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("sequence index out of range")
+        return(self.__digest(index))
+
+    def __end(self, index):
+        """file offset behind block index"""
+        return(BinaryFormat.END_OFFSET.unpack_from(self.map, self.ends_start + index * self.ends_stride)[0])
+
+    def locate(self, offset):
+        """return (index of block, offset in block) of file offset"""
+        if self.fixed:
+            return((offset / self.blocksize, offset % self.blocksize))
+        # first block ending behind offset
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) / 2
+            if self.__end(middle) <= offset:
+                low = middle + 1
+            else:
+                high = middle
+        if low == 0:
+            return((0, offset))
+        return((low, offset - self.__end(low - 1)))
+
+
+def load_sequence(filename, blocksize):
+    """returns MappedSequence of binary sequence file, or Sequence of old cPickle file"""
+    rfile = open(filename, "rb")
+    header = rfile.read(64)
+    if BinaryFormat.sequence_layout(header) is not None:
+        rfile.close()
+        return(MappedSequence(filename, blocksize))
+    data = header + rfile.read()
+    rfile.close()
+    (nref, digests, lengths) = BinaryFormat.loads_sequence(data)
+    return(Sequence(digests, lengths, blocksize, nref))
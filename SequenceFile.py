@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""SequenceFile Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import logging
+import binascii
+import tempfile
+
+import BinaryFormat
+
+# records read at once while iterating
+READ_RECORDS = 4096
+
+
+class SequenceFile(object):
+    """
+    sequence of blocks of a file being written, blocks are appended
+    to a temporary binary sequence file, not held in memory,
+    finish() writes the header, then the file is renamed into place
+
+    every block in it holds a reference, see BinaryFormat.FLAG_OCCURRENCE
+    """
+
+    def __init__(self, tmp_path):
+        logging.debug("SequenceFile.__init__(%s)", tmp_path)
+        (fd, self.filename) = tempfile.mkstemp(dir=tmp_path)
+        self.rwfile = os.fdopen(fd, "w+b")
+        self.header_len = len(BinaryFormat.sequence_header(0, 0, 0, 0))
+        # header is written by finish
+        self.rwfile.write("\x00" * self.header_len)
+        self.count = 0
+        self.digest_len = 0
+        # end offset of last block
+        self.end = 0
+
+    def __len__(self):
+        return(self.count)
+
+    def __stride(self):
+        """length of one record"""
+        return(self.digest_len + BinaryFormat.END_OFFSET.size)
+
+    def append(self, digest, length):
+        """append block with hexdigest and length"""
+        self.digest_len = len(digest) / 2
+        self.end += length
+        # locate, replace and iteration move the file position
+        self.rwfile.seek(0, os.SEEK_END)
+        self.rwfile.write(BinaryFormat.sequence_record(digest, self.end))
+        self.count += 1
+
+    def __end(self, index):
+        """end offset of block index"""
+        self.rwfile.seek(self.header_len + index * self.__stride() + self.digest_len)
+        return(BinaryFormat.END_OFFSET.unpack(self.rwfile.read(BinaryFormat.END_OFFSET.size))[0])
+
+    def locate(self, offset):
+        """returns (index, offset of first byte, length, hexdigest) of block holding offset"""
+        # first block ending behind offset
+        low = 0
+        high = self.count
+        while low < high:
+            middle = (low + high) / 2
+            if self.__end(middle) <= offset:
+                low = middle + 1
+            else:
+                high = middle
+        start = 0
+        if low > 0:
+            start = self.__end(low - 1)
+        self.rwfile.seek(self.header_len + low * self.__stride())
+        record = self.rwfile.read(self.__stride())
+        end = BinaryFormat.END_OFFSET.unpack(record[self.digest_len:])[0]
+        return((low, start, end - start, binascii.hexlify(record[:self.digest_len])))
+
+    def replace(self, index, digest):
+        """replace hexdigest of block index, its length stays the same"""
+        self.rwfile.seek(self.header_len + index * self.__stride())
+        self.rwfile.write(binascii.unhexlify(digest))
+
+    def __iter__(self):
+        """yields hexdigests of all blocks"""
+        stride = self.__stride()
+        position = self.header_len
+        end = self.header_len + self.count * stride
+        while position < end:
+            self.rwfile.seek(position)
+            data = self.rwfile.read(min(READ_RECORDS * stride, end - position))
+            position += len(data)
+            for start in xrange(0, len(data), stride):
+                yield binascii.hexlify(data[start:start + self.digest_len])
+
+    def finish(self, nref):
+        """write header, returns name of complete sequence file"""
+        self.rwfile.seek(0)
+        self.rwfile.write(BinaryFormat.sequence_header(BinaryFormat.FLAG_LENGTHS | BinaryFormat.FLAG_OCCURRENCE, nref, self.count, self.digest_len))
+        self.rwfile.close()
+        return(self.filename)
+
+    def discard(self):
+        """delete temporary file"""
+        self.rwfile.close()
+        os.unlink(self.filename)
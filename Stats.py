@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""Stats Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import time
+import bisect
+import threading
+import functools
+
+# upper bounds of latency buckets in seconds, one more for anything above
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# positions in list of counters of one operation
+COUNT = 0
+ERRORS = 1
+SECONDS = 2
+FIRST_BUCKET = 3
+
+
+class Stats(object):
+    """
+    counters and latency histograms of operations, cheap enough to
+    be recorded for every call, text() returns them in the text format
+    of prometheus, so any scraper can read them
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> [count, errors, seconds, count of every bucket]
+        self.operations = {}
+        self.start = time.time()
+
+    def record(self, name, seconds, error=False):
+        """count one call of operation name, which took seconds"""
+        index = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            counters = self.operations.get(name)
+            if counters is None:
+                counters = [0, 0, 0.0] + [0] * (len(BUCKETS) + 1)
+                self.operations[name] = counters
+            counters[COUNT] += 1
+            if error:
+                counters[ERRORS] += 1
+            counters[SECONDS] += seconds
+            counters[FIRST_BUCKET + index] += 1
+
+    def text(self):
+        """returns all counters as text"""
+        with self.lock:
+            operations = dict((name, list(counters)) for (name, counters) in self.operations.items())
+        lines = [
+            "# TYPE pydedupfs_uptime_seconds gauge",
+            "pydedupfs_uptime_seconds %.3f" % (time.time() - self.start),
+            "# TYPE pydedupfs_operation_seconds histogram",
+        ]
+        for name in sorted(operations.keys()):
+            counters = operations[name]
+            cumulative = 0
+            for index in range(len(BUCKETS)):
+                cumulative += counters[FIRST_BUCKET + index]
+                lines.append("pydedupfs_operation_seconds_bucket{operation=\"%s\",le=\"%s\"} %d" % (name, BUCKETS[index], cumulative))
+            lines.append("pydedupfs_operation_seconds_bucket{operation=\"%s\",le=\"+Inf\"} %d" % (name, counters[COUNT]))
+            lines.append("pydedupfs_operation_seconds_sum{operation=\"%s\"} %.6f" % (name, counters[SECONDS]))
+            lines.append("pydedupfs_operation_seconds_count{operation=\"%s\"} %d" % (name, counters[COUNT]))
+        lines.append("# TYPE pydedupfs_operation_errors_total counter")
+        for name in sorted(operations.keys()):
+            lines.append("pydedupfs_operation_errors_total{operation=\"%s\"} %d" % (name, operations[name][ERRORS]))
+        return("\n".join(lines) + "\n")
+
+
+def timed(name):
+    """
+    decorator of methods of objects with attribute meta_storage,
+    records every call as operation name in meta_storage.stats
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kw):
+            start = time.time()
+            error = True
+            try:
+                result = method(self, *args, **kw)
+                error = False
+                return(result)
+            finally:
+                meta_storage = getattr(self, "meta_storage", None)
+                if meta_storage is not None:
+                    meta_storage.stats.record(name, time.time() - start, error)
+        return(wrapper)
+    return(decorator)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""Usage Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import time
+import logging
+import tempfile
+import threading
+
+# saved counters in db_path
+USAGE_FILENAME = "usage.counters"
+# counters kept
+NAMES = ("files", "directories", "logical_bytes", "blocks", "physical_bytes")
+# seconds between saves
+SAVE_INTERVAL = 5
+
+
+class Usage(object):
+    """
+    totals of the filesystem, changed with every operation, so
+    statfs and reports need no scan, saved in db_path every
+    SAVE_INTERVAL seconds and at close
+
+    after a crash the changes since the last save are lost,
+    garbagecollect.py counts everything again and saves exact totals
+    """
+
+    def __init__(self, db_path, new=False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.ERROR)
+        self.logger.debug("Usage.__init__(%s, %s)", db_path, new)
+        self.db_path = db_path
+        self.filename = os.path.join(db_path, USAGE_FILENAME)
+        self.lock = threading.Lock()
+        self.counters = dict((name, 0) for name in NAMES)
+        # false if totals may be wrong
+        self.exact = False
+        if new and not os.path.isfile(self.filename):
+            # nothing stored yet
+            self.exact = True
+        if os.path.isfile(self.filename):
+            for line in open(self.filename, "rb"):
+                (name, value) = line.split()
+                if name == "clean":
+                    self.exact = (value == "1")
+                elif name in self.counters:
+                    self.counters[name] = int(value)
+        if not self.exact:
+            self.logger.error("usage counters may be wrong, run garbagecollect.py to count again")
+        self.saved = time.time()
+        # not clean until close
+        with self.lock:
+            self.__save(False)
+
+    def __save(self, clean):
+        """write counters, lock is held"""
+        (fd, tmpname) = tempfile.mkstemp(dir=self.db_path)
+        wfile = os.fdopen(fd, "wb")
+        for name in NAMES:
+            wfile.write("%s %d\n" % (name, self.counters[name]))
+        wfile.write("clean %d\n" % int(clean and self.exact))
+        wfile.close()
+        os.rename(tmpname, self.filename)
+        self.saved = time.time()
+
+    def add(self, name, delta):
+        """change counter name by delta"""
+        with self.lock:
+            self.counters[name] += delta
+            if time.time() - self.saved > SAVE_INTERVAL:
+                self.__save(False)
+
+    def get(self, name):
+        """returns value of counter name"""
+        return(self.counters[name])
+
+    def report(self):
+        """returns dict of all counters and dedup_ratio, logical per physical bytes"""
+        with self.lock:
+            result = dict(self.counters)
+        result["dedup_ratio"] = 1.0
+        if result["physical_bytes"] > 0:
+            result["dedup_ratio"] = float(result["logical_bytes"]) / result["physical_bytes"]
+        result["exact"] = self.exact
+        return(result)
+
+    def close(self):
+        """save counters, they are exact at next start"""
+        with self.lock:
+            self.__save(True)
+
+    @staticmethod
+    def write(db_path, counters):
+        """save exact dict of counters, counted while not mounted"""
+        usage = Usage(db_path, True)
+        with usage.lock:
+            usage.counters.update(counters)
+            usage.exact = True
+        usage.close()
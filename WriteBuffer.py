@@ -23,96 +23,280 @@ __version__ = "$Revision$"
 __date__ = "$Date$"
 # $Id
 
+import heapq
 import logging
+import threading
+import collections
+
+from SequenceFile import SequenceFile as SequenceFile
+
+# maximum length of data to fill holes of sparse writes in one piece
+FILL_SIZE = 1024 * 1024
 
 
 class WriteBuffer(object):
-    """Object to hold data with maximum length blocksize, the flush"""
+    """
+    Object to hold data until the chunker cuts a block, then store it
 
-    def __init__(self, meta_storage, block_storage, blocksize, hashfunc):
+    every open file has its own WriteBuffer, writes may come at any offset,
+    data behind the end of the buffer is held back until the hole
+    before it is filled, data before the end of the buffer overwrites
+    buffered data, or is written into the stored blocks it falls in,
+    which are stored again with the same length
+    """
+
+    def __init__(self, meta_storage, block_storage, chunker, hashfunc, base=None, base_size=0, pipeline=None):
         logging.debug("WriteBuffer.__init__()")
-        self.blocksize = blocksize
+        # chunker decides where to cut blocks, see Chunker.py
+        self.chunker = chunker
         # hashfunc has to be use like hashlib.sha1
         self.hashfunc = hashfunc
         self.meta_storage = meta_storage
         self.block_storage = block_storage
+        # base(length, offset) returns old content of file,
+        # which is used for bytes not written, up to base_size
+        self.base = base
+        self.base_size = base_size
+        # WritePipeline to hash and store blocks in background,
+        # if None blocks are hashed and stored in calling thread
+        self.pipeline = pipeline
+        # fuse may call write on the same file from different threads
+        self.lock = threading.Lock()
+        # (WriteJob, length) of blocks not yet in sequence, oldest first
+        self.inflight = collections.deque()
         # initialize some variables, they are filled in __reinit
         # look in __reninit for comments
         self.buf = None
+        self.scanned = None
         self.bytecounter = None
         self.filehash = None
-        self.deduphash = None
         self.sequence = None
+        self.pending = None
         # set values to start first block
         self.__reinit()
 
     def flush(self):
         """
         write self.buf to block_storage,
-        maximum length is blocksize,
-        but block can already be smaller
+        called at the end of file,
+        block can be smaller than a chunker would cut
         """
         logging.debug("WriteBuffer.flush()")
-        # flush self.buf
-        # blocklevel hash
+        self.__store(str(self.buf))
+        del self.buf[:]
+        self.scanned = 0
+
+    def __store(self, block):
+        """hash block and put it into block_storage"""
+        # filelevel hash, runs through hole file, with update(),
+        # None after stored blocks were written again
+        if self.filehash is not None:
+            self.filehash.update(block)
+        self.bytecounter += len(block)
+        if self.pipeline is None:
+            self.__append(self.__hash_and_put(block), len(block))
+        else:
+            self.inflight.append((self.pipeline.submit(self.__hash_and_put, block), len(block)))
+            # limit memory used by blocks waiting for workers
+            while len(self.inflight) > self.pipeline.maxinflight:
+                self.__retire()
+
+    def __hash_and_put(self, block):
+        """
+        returns blocklevel hash of block, runs in worker thread of pipeline,
+        every block in sequence holds its own reference
+        """
         blockhash = self.hashfunc()
-        blockhash.update(self.buf)
+        blockhash.update(block)
         blockhexhash = blockhash.hexdigest()
-        # filelevel hash, runs through hole file, with update()
-        self.filehash.update(self.buf)
-        self.bytecounter += len(self.buf)
-        # put digest in dict
-        if self.deduphash.has_key(blockhexhash):
-            self.deduphash[blockhexhash] += 1
-        else:
-            self.deduphash[blockhexhash] = 1
-            # store block on disk
-            self.block_storage.put(self.buf, blockhexhash)
-        # add blockhexdigest to sequence of blocks of file
-        self.sequence.append(blockhexhash)
-
-    def add(self, data):
-        """adds data to buffer and flushes if length > blocksize"""
-        # logging.debug("WriteBuffer.add(<buf>)")
-        l_data = len(data)
-        l_buf = len(self.buf)
-        if (l_buf + l_data) >= self.blocksize:
-            # add only remaining bytes to internal buffer
-            self.buf += data[:self.blocksize-l_buf]
-            # logging.debug("Buffer flush")
-            # assert len(self.buf) == self.blocksize
-            self.flush()
-            # begin next block buffer
-            self.buf = data[self.blocksize:]
-        else:
-            # logging.debug("Adding buffer")
-            # assert len(self.buf) < self.blocksize
-            self.buf += data
-        return(l_data)
+        self.block_storage.put(block, blockhexhash)
+        return(blockhexhash)
+
+    def __append(self, blockhexhash, length):
+        """
+        add blockhexdigest to sequence of blocks of file
+        blocks may differ in length, so remember length too
+        """
+        if self.sequence is None:
+            self.sequence = SequenceFile(self.meta_storage.tmp_path)
+        self.sequence.append(blockhexhash, length)
+
+    def __retire(self):
+        """wait for oldest block in pipeline and add it to sequence"""
+        (job, length) = self.inflight.popleft()
+        self.__append(job.wait(), length)
+
+    def __retire_all(self):
+        """wait for all blocks in pipeline, afterwards sequence is complete"""
+        while len(self.inflight) > 0:
+            self.__retire()
+
+    def __position(self):
+        """offset of the first byte not yet in buffer"""
+        return(self.bytecounter + len(self.buf))
+
+    def add(self, data, offset=None):
+        """
+        adds data at offset to buffer and stores every block
+        the chunker cuts off, without offset data is appended
+        """
+        # logging.debug("WriteBuffer.add(<buf>, %s)", offset)
+        # writes count as activity of the filesystem
+        self.meta_storage.activity += 1
+        with self.lock:
+            if offset is None:
+                offset = self.__position()
+            # newer data wins over older held back data
+            self.__supersede(offset, offset + len(data))
+            if offset > self.__position():
+                # there is a hole before data, hold it back
+                heapq.heappush(self.pending, (offset, data))
+            else:
+                self.__write(data, offset)
+            self.__drain()
+        return(len(data))
+
+    def __write(self, data, offset):
+        """write data at offset, offset must not be behind buffer"""
+        if offset < self.bytecounter:
+            # overwrites already stored blocks, only these are stored again
+            data = self.__patch(data, offset)
+            if len(data) == 0:
+                return
+            offset = self.bytecounter
+        start = offset - self.bytecounter
+        # in place, appending does not copy the buffer
+        self.buf[start:start + len(data)] = data
+        # boundaries from start on may have changed
+        self.scanned = min(self.scanned, start)
+        while True:
+            cut = self.chunker.cut(self.buf, self.scanned)
+            if cut == 0:
+                # no boundary yet, remember how far we searched
+                self.scanned = len(self.buf)
+                break
+            self.__store(str(self.buf[:cut]))
+            del self.buf[:cut]
+            self.scanned = 0
+
+    def __supersede(self, start, end):
+        """cut range start to end out of held back data"""
+        if len(self.pending) == 0:
+            return
+        pending = []
+        for (offset, data) in self.pending:
+            if (offset + len(data) <= start) or (offset >= end):
+                pending.append((offset, data))
+                continue
+            if offset < start:
+                pending.append((offset, data[:start - offset]))
+            if offset + len(data) > end:
+                pending.append((end, data[end - offset:]))
+        heapq.heapify(pending)
+        self.pending = pending
+
+    def __drain(self):
+        """write held back data, which has no hole before it anymore"""
+        while (len(self.pending) > 0) and (self.pending[0][0] <= self.__position()):
+            (offset, data) = heapq.heappop(self.pending)
+            self.__write(data, offset)
+
+    def __patch(self, data, offset):
+        """
+        write data at offset into the stored blocks it falls in,
+        every changed block is stored again with the same length,
+        and replaces the old one in sequence,
+        returns the rest of data, which belongs into buffer
+        """
+        logging.debug("WriteBuffer.__patch(<data>, %s)", offset)
+        self.__retire_all()
+        while (len(data) > 0) and (offset < self.bytecounter):
+            (index, start, length, blockhexhash) = self.sequence.locate(offset)
+            block = self.block_storage.get(blockhexhash)
+            inner = offset - start
+            count = min(len(data), length - inner)
+            block = block[:inner] + data[:count] + block[inner + count:]
+            self.sequence.replace(index, self.__hash_and_put(block))
+            # give reference of old block back
+            self.block_storage.delete(blockhexhash)
+            data = data[count:]
+            offset += count
+        # filehash could not be rewound, it is computed again by release
+        self.filehash = None
+        return(data)
+
+    def __fill(self, end):
+        """fill buffer up to end with old content of file or zeros"""
+        while self.__position() < end:
+            position = self.__position()
+            length = min(end - position, FILL_SIZE)
+            data = ""
+            if (self.base is not None) and (position < self.base_size):
+                data = self.base(min(length, self.base_size - position), position)
+            data += "\x00" * (length - len(data))
+            self.__write(data, position)
 
     def __reinit(self):
         """set some counters to initial values"""
         logging.debug("WriteBuffer.__reinit()")
-        self.buf = ""
+        # data not yet cut into blocks, changed in place
+        self.buf = bytearray()
+        # bytes of buf already searched for a boundary
+        self.scanned = 0
         # counting bytes = len
         self.bytecounter = 0
         # hash for whole file
         self.filehash = self.hashfunc()
-        # deduphash
-        self.deduphash = {}
-        # sequence of blocks
-        self.sequence = []
+        # SequenceFile of stored blocks, created with first block
+        self.sequence = None
+        # heap of (offset, data) written behind a hole
+        self.pending = []
+        # nothing in flight after __retire_all
+        self.inflight.clear()
+
+    def discard(self):
+        """forget all written data, and give back references of stored blocks"""
+        logging.debug("WriteBuffer.discard()")
+        with self.lock:
+            # workers may still put blocks, wait for them
+            for (job, length) in self.inflight:
+                job.done.wait()
+                if job.exc_info is None:
+                    self.block_storage.delete(job.result)
+            if self.sequence is not None:
+                for blockhexhash in self.sequence:
+                    self.block_storage.delete(blockhexhash)
+                self.sequence.discard()
+            self.base = None
+            self.base_size = 0
+            self.__reinit()
 
     def release(self):
         """write remaining data, and closes file"""
         logging.debug("WriteBuffer.release()")
-        if len(self.buf) != 0:
-            self.flush()
-        # write meta information
-        # save informations for return
-        filehash = self.filehash.hexdigest()
-        sequence = self.sequence
-        size = self.bytecounter
-        # reinitialize counters for next file
-        self.__reinit()
+        with self.lock:
+            # fill holes left by sparse writes
+            while len(self.pending) > 0:
+                self.__fill(self.pending[0][0])
+                self.__drain()
+            # keep old content behind the last write
+            self.__fill(self.base_size)
+            if len(self.buf) != 0:
+                self.flush()
+            self.__retire_all()
+            if self.sequence is None:
+                # empty file
+                self.sequence = SequenceFile(self.meta_storage.tmp_path)
+            if self.filehash is None:
+                # stored blocks were written again, hash final sequence once
+                self.filehash = self.hashfunc()
+                for blockhexhash in self.sequence:
+                    self.filehash.update(self.block_storage.get(blockhexhash))
+            # write meta information
+            # save informations for return
+            filehash = self.filehash.hexdigest()
+            sequence = self.sequence
+            size = self.bytecounter
+            # reinitialize counters for next file
+            self.__reinit()
         return(filehash, sequence, size)
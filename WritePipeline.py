@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""WritePipeline Object"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import sys
+import Queue
+import logging
+import threading
+
+
+class WriteJob(object):
+    """one call to run in a worker thread, wait() returns its result"""
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def run(self):
+        """called by worker thread"""
+        try:
+            self.result = self.func(*self.args)
+        except StandardError:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def wait(self):
+        """wait until job is done, returns result or raises its exception"""
+        self.done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return(self.result)
+
+
+class WritePipeline(object):
+    """
+    worker threads to hash and store blocks, shared by all WriteBuffers
+
+    hashlib releases the GIL while hashing big buffers, so hashing
+    runs on several cores, and storing blocks overlaps with hashing,
+    the queue is bounded, so a fast writer waits for the workers
+    and only a limited number of blocks is held in memory
+    """
+
+    def __init__(self, threads, maxqueue=None):
+        logging.debug("WritePipeline.__init__(%s, %s)", threads, maxqueue)
+        if maxqueue is None:
+            maxqueue = 2 * threads
+        self.queue = Queue.Queue(maxqueue)
+        # a WriteBuffer should not hold more blocks than that in flight
+        self.maxinflight = 2 * threads
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self.__worker)
+            # set to daemon thread, so main thread can exit
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def __worker(self):
+        """run jobs from queue"""
+        while True:
+            self.queue.get().run()
+
+    def submit(self, func, *args):
+        """queue func(*args), returns WriteJob, waits while queue is full"""
+        job = WriteJob(func, args)
+        self.queue.put(job)
+        return(job)
@@ -1,57 +1,254 @@
 #!/usr/bin/python
 """
-Benchmark Program to see preformance differnece between 
-dbm based persistent key store or cPickled key in Files
+Benchmark of MetaStorage with every block storage, without fuse
+
+a synthetic dataset with given duplicate ratio, file sizes and
+blocksize is written, read sequential and at random offsets, then
+getattr and unlink are timed, results are written as JSON,
+with --compare the results of an earlier run are shown side by side
 """
 
-import random
-import string
+import os
+import sys
+import json
 import time
-import cPickle
-
-def create_sample(blocksize=128*1024):
-    block=[]
-    for x in xrange(blocksize):
-        block.append(random.choice(string.hexdigits))
-    return("".join(block))
-    
-block = create_sample(128 * 1024)
-blocklen = len(block)
-
-start = time.time()
-for x in xrange(1000):
-    wfile = open("testfile.dmp", "wb")
-    wfile.write(block)
-    wfile.close()
-    rfile = open("testfile.dmp", "rb")
-    block = rfile.read(128*1024)
-    assert len(block) == blocklen
-    rfile.close
-    block = block[::-1]
-print "Duration : %s" % (time.time()-start)
-
-start = time.time()
-nref = 1
-for x in xrange(1000):
-    wfile = open("testfile.dmp", "wb")
-    cPickle.dump((nref, block), wfile)
-    wfile.close()
-    rfile = open("testfile.dmp", "rb")
-    nref, block = cPickle.load(rfile)
-    assert len(block) == blocklen
-    rfile.close()
-    block = block[::-1]
-print "Duration with cPickle: %s" % (time.time()-start)
-
-start = time.time()
-nref = 1
-for x in xrange(1000):
-    open("testfile.dmp", "wb").write(block)
-    open("testfile.ifo", "wb").write(str(nref))
-    block = open("testfile.dmp", "rb").read()
-    nref = int(open("testfile.ifo", "rb").read())
-    assert len(block) == blocklen
-    block = block[::-1]
-print "Duration with two line solution: %s" % (time.time()-start)
-
-    
+import math
+import random
+import shutil
+import hashlib
+from optparse import OptionParser
+
+from MetaStorage import MetaStorage as MetaStorage
+from MetaStorage import BLOCK_STORAGES as BLOCK_STORAGES
+from Chunker import FixedChunker as FixedChunker
+from Chunker import ContentChunker as ContentChunker
+
+# number of earlier blocks kept to be written again as duplicate
+POOL_SIZE = 256
+
+
+class Dataset(object):
+    """
+    yields (path, data) of synthetic files, the same for every seed,
+    file sizes are spread evenly over orders of magnitude between
+    minsize and maxsize, dupratio of all pieces of blocksize repeat
+    a piece written before
+    """
+
+    def __init__(self, seed, files, minsize, maxsize, blocksize, dupratio):
+        self.seed = seed
+        self.files = files
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.blocksize = blocksize
+        self.dupratio = dupratio
+
+    def __random_piece(self, rnd, length):
+        """returns length random bytes"""
+        if length == 0:
+            return("")
+        return(("%0*x" % (length * 2, rnd.getrandbits(length * 8))).decode("hex"))
+
+    def __iter__(self):
+        rnd = random.Random(self.seed)
+        pool = []
+        for index in xrange(self.files):
+            size = int(math.exp(rnd.uniform(math.log(self.minsize), math.log(self.maxsize))))
+            pieces = []
+            length = 0
+            while length < size:
+                if (len(pool) > 0) and (rnd.random() < self.dupratio):
+                    piece = rnd.choice(pool)
+                else:
+                    piece = self.__random_piece(rnd, self.blocksize)
+                    if len(pool) < POOL_SIZE:
+                        pool.append(piece)
+                    else:
+                        pool[rnd.randrange(POOL_SIZE)] = piece
+                pieces.append(piece)
+                length += len(piece)
+            yield(("/file%06d" % index, "".join(pieces)[:size]))
+
+
+def percentile(values, percent):
+    """returns percent percentile of list of values"""
+    if len(values) == 0:
+        return(0.0)
+    values = sorted(values)
+    return(values[int(round(percent / 100.0 * (len(values) - 1)))])
+
+def summary(latencies, nbytes=None):
+    """returns dict of throughput and latencies in milliseconds"""
+    total = max(sum(latencies), 0.000001)
+    result = {
+        "count" : len(latencies),
+        "seconds" : total,
+        "ops_s" : len(latencies) / total,
+        "p50_ms" : percentile(latencies, 50) * 1000,
+        "p99_ms" : percentile(latencies, 99) * 1000,
+    }
+    if nbytes is not None:
+        result["bytes"] = nbytes
+        result["mb_s"] = nbytes / total / 1024 / 1024
+    return(result)
+
+def disk_usage(path):
+    """bytes of all files below path"""
+    nbytes = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            nbytes += os.path.getsize(os.path.join(dirpath, filename))
+    return(nbytes)
+
+def new_chunker(name, blocksize):
+    """returns chunker like PyDedupFS does with default sizes"""
+    if name == "cdc":
+        return(ContentChunker(blocksize / 4, blocksize, blocksize * 4))
+    return(FixedChunker(blocksize))
+
+def run(storage, base, dataset, options):
+    """returns dict of results of all phases with storage"""
+    shutil.rmtree(base, True)
+    meta_storage = MetaStorage(base, options.blocksize, hashlib.sha1,
+        chunker=new_chunker(options.chunker, options.blocksize), cachesize=options.cachesize,
+        storage=storage, compress=options.compress, hashthreads=options.hashthreads,
+        scrubrate=0)
+    results = {}
+    # ingest, like fuse writes of writesize
+    sizes = {}
+    latencies = []
+    nbytes = 0
+    for (path, data) in dataset:
+        start = time.time()
+        meta_storage.create(path)
+        write_buffer = meta_storage.new_write_buffer(path)
+        for offset in xrange(0, len(data), options.writesize):
+            write_buffer.add(data[offset:offset + options.writesize], offset)
+        meta_storage.release(path, write_buffer)
+        latencies.append(time.time() - start)
+        sizes[path] = len(data)
+        nbytes += len(data)
+    results["ingest"] = summary(latencies, nbytes)
+    paths = sorted(sizes.keys())
+    # sequential read of every file
+    latencies = []
+    nbytes = 0
+    for path in paths:
+        readahead = meta_storage.new_readahead()
+        sequence = meta_storage.open_sequence(path)
+        for offset in xrange(0, sizes[path], options.readsize):
+            start = time.time()
+            nbytes += len(meta_storage.read(path, options.readsize, offset, readahead, sequence))
+            latencies.append(time.time() - start)
+    results["seqread"] = summary(latencies, nbytes)
+    # reads at random offsets of random files
+    rnd = random.Random(options.seed)
+    latencies = []
+    nbytes = 0
+    for index in xrange(options.randreads):
+        path = rnd.choice(paths)
+        offset = rnd.randrange(max(1, sizes[path] - options.readsize))
+        start = time.time()
+        nbytes += len(meta_storage.read(path, options.readsize, offset))
+        latencies.append(time.time() - start)
+    results["randread"] = summary(latencies, nbytes)
+    # getattr of every file
+    latencies = []
+    for path in paths:
+        start = time.time()
+        meta_storage.getattr(path)
+        latencies.append(time.time() - start)
+    results["getattr"] = summary(latencies)
+    results["stored_bytes"] = disk_usage(base)
+    # unlink of every file
+    latencies = []
+    for path in paths:
+        start = time.time()
+        meta_storage.unlink(path)
+        latencies.append(time.time() - start)
+    results["unlink"] = summary(latencies)
+    meta_storage.close()
+    shutil.rmtree(base, True)
+    return(results)
+
+def report(results, old_results=None):
+    """prints table of results to stderr, with ratio to old_results"""
+    for storage in sorted(results.keys()):
+        if "error" in results[storage]:
+            sys.stderr.write("%-5s : %s\n" % (storage, results[storage]["error"]))
+            continue
+        sys.stderr.write("%-5s : stored %d bytes\n" % (storage, results[storage]["stored_bytes"]))
+        for phase in ("ingest", "seqread", "randread", "getattr", "unlink"):
+            result = results[storage][phase]
+            if "mb_s" in result:
+                line = "  %-8s : %9.2f MB/s   p50 %8.3f ms   p99 %8.3f ms" % (phase, result["mb_s"], result["p50_ms"], result["p99_ms"])
+                key = "mb_s"
+            else:
+                line = "  %-8s : %9.0f ops/s  p50 %8.3f ms   p99 %8.3f ms" % (phase, result["ops_s"], result["p50_ms"], result["p99_ms"])
+                key = "ops_s"
+            try:
+                old = old_results[storage][phase][key]
+                line += "   %+.1f%%" % ((result[key] - old) / old * 100)
+            except (KeyError, TypeError, ZeroDivisionError):
+                pass
+            sys.stderr.write(line + "\n")
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options] <work directory>")
+    parser.add_option("--storages", dest="storages", type="str", default=",".join(sorted(BLOCK_STORAGES.keys())),
+        help="comma separated block storages to test, default %default")
+    parser.add_option("--files", dest="files", type="int", default=100,
+        help="number of files, default %default")
+    parser.add_option("--minsize", dest="minsize", type="int", default=4 * 1024,
+        help="smallest file size, default %default")
+    parser.add_option("--maxsize", dest="maxsize", type="int", default=16 * 1024 * 1024,
+        help="largest file size, sizes are spread evenly over orders of magnitude, default %default")
+    parser.add_option("--dupratio", dest="dupratio", type="float", default=0.3,
+        help="part of data written before, 0.0 to 1.0, default %default")
+    parser.add_option("--blocksize", dest="blocksize", type="int", default=128 * 1024,
+        help="blocksize, default %default")
+    parser.add_option("--chunker", dest="chunker", type="str", default="fixed",
+        help="how to cut data into blocks <fixed, cdc>, default %default")
+    parser.add_option("--compress", dest="compress", type="str", default="none",
+        help="compression of blocks, default %default")
+    parser.add_option("--hashthreads", dest="hashthreads", type="int", default=0,
+        help="number of threads hashing written blocks, default %default")
+    parser.add_option("--cachesize", dest="cachesize", type="int", default=32 * 1024 * 1024,
+        help="bytes of block cache, default %default")
+    parser.add_option("--writesize", dest="writesize", type="int", default=64 * 1024,
+        help="bytes of every write, default %default")
+    parser.add_option("--readsize", dest="readsize", type="int", default=128 * 1024,
+        help="bytes of every read, default %default")
+    parser.add_option("--randreads", dest="randreads", type="int", default=1000,
+        help="number of reads at random offsets, default %default")
+    parser.add_option("--seed", dest="seed", type="int", default=1,
+        help="seed of random data, default %default")
+    parser.add_option("--output", dest="output", type="str", default="-",
+        help="file to write JSON results to, default stdout")
+    parser.add_option("--compare", dest="compare", type="str", default=None,
+        help="JSON results of an earlier run, to show changes")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    if not os.path.isdir(args[0]):
+        os.makedirs(args[0])
+    dataset = Dataset(options.seed, options.files, options.minsize, options.maxsize, options.blocksize, options.dupratio)
+    results = {}
+    for storage in options.storages.split(","):
+        sys.stderr.write("running %s\n" % storage)
+        try:
+            results[storage] = run(storage, os.path.join(args[0], storage), dataset, options)
+        except ImportError, exc:
+            # database module of storage is not installed
+            results[storage] = {"error" : str(exc)}
+    old_results = None
+    if options.compare is not None:
+        old_results = json.load(open(options.compare, "rb"))["results"]
+    report(results, old_results)
+    document = {"options" : options.__dict__, "time" : time.time(), "results" : results}
+    if options.output == "-":
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        json.dump(document, open(options.output, "wb"), indent=2, sort_keys=True)
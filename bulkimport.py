@@ -0,0 +1,351 @@
+#!/usr/bin/python
+"""
+import a local directory tree into pydedup data, while not mounted
+
+files are written through MetaStorage without fuse, in a pipeline of
+stages, each with its own threads: the walker creates directories and
+queues files, reader threads read files in big pieces into their
+WriteBuffer, which cuts blocks, and the hash threads of MetaStorage
+hash them, look them up and store the new ones
+
+files are numbered in the sorted order of the walk, the checkpoint in
+base/meta holds the number of files before which all are imported,
+an interrupted import skips them at the next run, files which fail
+are logged and the import goes on
+"""
+
+import os
+import sys
+import stat
+import time
+import Queue
+import hashlib
+import logging
+import tempfile
+import threading
+import multiprocessing
+from optparse import OptionParser
+
+from MetaStorage import MetaStorage as MetaStorage
+from MetaStorage import BLOCK_STORAGES as BLOCK_STORAGES
+from MetaStorage import DEFAULT_STORAGE as DEFAULT_STORAGE
+from BlockStorageCompress import CODEC_NAMES as CODEC_NAMES
+from StatDefaultFile import StatDefaultFile as StatDefaultFile
+from Chunker import FixedChunker as FixedChunker
+from Chunker import ContentChunker as ContentChunker
+
+# bytes read from a file at once
+READ_SIZE = 4 * 1024 * 1024
+# progress of import, in base/meta
+CHECKPOINT_FILENAME = "import.checkpoint"
+# seconds between saves of checkpoint
+SAVE_INTERVAL = 10
+
+
+class Checkpoint(object):
+    """
+    number of files, in order of the walk, before which all files
+    are imported, and the path of the last of them, to notice a
+    changed source tree at resume
+    """
+
+    def __init__(self, filename, source, target, restart=False):
+        self.filename = filename
+        self.source = source
+        self.target = target
+        self.position = 0
+        self.path = None
+        if restart and os.path.isfile(filename):
+            os.unlink(filename)
+        if os.path.isfile(filename):
+            values = {}
+            for line in open(filename, "rb"):
+                (name, value) = line.rstrip("\n").split(" ", 1)
+                values[name] = value.decode("string_escape")
+            if (values["source"] != source) or (values["target"] != target):
+                raise ValueError("checkpoint is of import of %s to %s, use --restart" % (values["source"], values["target"]))
+            self.position = int(values["position"])
+            if self.position > 0:
+                self.path = values["path"]
+        # first position of this run, files before are skipped
+        self.start = self.position
+        # position -> path of files imported behind position
+        self.finished = {}
+        self.lock = threading.Lock()
+        self.saved = time.time()
+
+    def is_done(self, position, path):
+        """true if file at position was imported before"""
+        if (position == self.start - 1) and (path != self.path):
+            raise ValueError("source has changed since last import, %s expected, use --restart" % self.path)
+        return(position < self.start)
+
+    def finish(self, position, path):
+        """file at position is imported"""
+        with self.lock:
+            self.finished[position] = path
+            while self.position in self.finished:
+                self.path = self.finished.pop(self.position)
+                self.position += 1
+            if time.time() - self.saved > SAVE_INTERVAL:
+                self.__save()
+
+    def __save(self):
+        """write checkpoint, lock is held"""
+        (fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(self.filename))
+        wfile = os.fdopen(fd, "wb")
+        wfile.write("source %s\n" % self.source.encode("string_escape"))
+        wfile.write("target %s\n" % self.target.encode("string_escape"))
+        wfile.write("position %d\n" % self.position)
+        if self.path is not None:
+            wfile.write("path %s\n" % self.path.encode("string_escape"))
+        wfile.flush()
+        os.fsync(wfile.fileno())
+        wfile.close()
+        os.rename(tmpname, self.filename)
+        self.saved = time.time()
+
+    def save(self):
+        """write checkpoint"""
+        with self.lock:
+            self.__save()
+
+    def remove(self):
+        """import is complete"""
+        if os.path.isfile(self.filename):
+            os.unlink(self.filename)
+
+
+class Progress(object):
+    """prints files and bytes imported, throughput and estimated time left to stderr"""
+
+    def __init__(self, files, nbytes):
+        self.files = files
+        self.nbytes = nbytes
+        self.done_files = 0
+        self.done_bytes = 0
+        self.skipped = 0
+        self.failed = 0
+        self.start = time.time()
+        self.last = 0
+        self.lock = threading.Lock()
+
+    def skip(self, nbytes):
+        """file of nbytes was imported before"""
+        with self.lock:
+            self.files -= 1
+            self.nbytes -= nbytes
+            self.skipped += 1
+
+    def add(self, nbytes, failed=False):
+        """one more file of nbytes is done"""
+        with self.lock:
+            self.done_files += 1
+            self.done_bytes += nbytes
+            if failed:
+                self.failed += 1
+            now = time.time()
+            if (now - self.last < 1) and (self.done_files < self.files):
+                return
+            self.last = now
+            elapsed = max(now - self.start, 0.001)
+            eta = 0
+            if self.done_bytes > 0:
+                eta = elapsed * (self.nbytes - self.done_bytes) / self.done_bytes
+            sys.stderr.write("\rfiles : %d of %d, %.1f MB of %.1f MB, %.1f MB/s, eta %s " % (self.done_files, self.files,
+                self.done_bytes / 1024.0 / 1024, self.nbytes / 1024.0 / 1024, self.done_bytes / elapsed / 1024 / 1024,
+                time.strftime("%H:%M:%S", time.gmtime(eta))))
+            if self.done_files >= self.files:
+                sys.stderr.write("\n")
+            sys.stderr.flush()
+
+
+def walk(source, warn=True):
+    """
+    yields (dirpath, dirnames, filenames) below source, sorted, so the
+    order is the same at every run, symlinks to directories are skipped
+    """
+    for (dirpath, dirnames, filenames) in os.walk(source):
+        for dirname in [dirname for dirname in dirnames if os.path.islink(os.path.join(dirpath, dirname))]:
+            if warn:
+                logging.warning("%s is no directory, skipped", os.path.join(dirpath, dirname))
+            dirnames.remove(dirname)
+        dirnames.sort()
+        yield((dirpath, dirnames, sorted(filenames)))
+
+def regular_files(dirpath, filenames, warn=True):
+    """yields (filename, stat) of regular files, fuse has no other kinds"""
+    for filename in filenames:
+        realname = os.path.join(dirpath, filename)
+        st = os.lstat(realname)
+        if stat.S_ISREG(st.st_mode):
+            yield((realname, st))
+        elif warn:
+            logging.warning("%s is no regular file, skipped", realname)
+
+def count(source):
+    """returns (number, bytes) of regular files below source"""
+    (files, nbytes) = (0, 0)
+    for (dirpath, dirnames, filenames) in walk(source, False):
+        for (realname, st) in regular_files(dirpath, filenames, False):
+            files += 1
+            nbytes += st.st_size
+    return((files, nbytes))
+
+def to_abspath(target, source, realname):
+    """path in filesystem of realname below source"""
+    relpath = os.path.relpath(realname, source)
+    if relpath == ".":
+        return(target)
+    return(os.path.join(target, relpath))
+
+def entry_stat(st):
+    """stat of entry with mode, owner and times of source file"""
+    entry_st = StatDefaultFile()
+    entry_st.st_mode = st.st_mode
+    entry_st.st_uid = st.st_uid
+    entry_st.st_gid = st.st_gid
+    entry_st.st_atime = int(st.st_atime)
+    entry_st.st_mtime = int(st.st_mtime)
+    entry_st.st_ctime = int(st.st_ctime)
+    return(entry_st)
+
+def import_file(meta_storage, realname, abspath, st):
+    """
+    write file realname as abspath, returns bytes read,
+    the entry is written by release, so a failed read leaves none
+    """
+    write_buffer = meta_storage.new_write_buffer(abspath, True)
+    nbytes = 0
+    try:
+        rfile = open(realname, "rb")
+        try:
+            while True:
+                data = rfile.read(READ_SIZE)
+                if len(data) == 0:
+                    break
+                write_buffer.add(data)
+                nbytes += len(data)
+        finally:
+            rfile.close()
+    except StandardError:
+        write_buffer.discard()
+        raise
+    meta_storage.release(abspath, write_buffer, entry_stat(st))
+    return(nbytes)
+
+def reader(meta_storage, tasks, checkpoint, progress):
+    """reader thread, imports files from tasks until None"""
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        (position, realname, abspath, st) = task
+        try:
+            nbytes = import_file(meta_storage, realname, abspath, st)
+            progress.add(nbytes)
+        except StandardError, exc:
+            # file vanished or is not readable, the import goes on
+            logging.error("import of %s failed: %s", realname, exc)
+            progress.add(st.st_size, failed=True)
+        checkpoint.finish(position, realname)
+
+def bulk_import(meta_storage, source, target, checkpoint, readers):
+    """import all below directory source to directory target, returns Progress"""
+    (files, nbytes) = count(source)
+    progress = Progress(files, nbytes)
+    # bounded, the walker waits for the readers
+    tasks = Queue.Queue(2 * readers)
+    threads = []
+    for _ in range(readers):
+        thread = threading.Thread(target=reader, args=(meta_storage, tasks, checkpoint, progress))
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    position = 0
+    try:
+        for (dirpath, dirnames, filenames) in walk(source):
+            for dirname in dirnames:
+                abspath = to_abspath(target, source, os.path.join(dirpath, dirname))
+                try:
+                    meta_storage.getattr(abspath)
+                except OSError:
+                    meta_storage.mkdir(abspath, stat.S_IMODE(os.lstat(os.path.join(dirpath, dirname)).st_mode))
+            for (realname, st) in regular_files(dirpath, filenames):
+                if checkpoint.is_done(position, realname):
+                    progress.skip(st.st_size)
+                else:
+                    tasks.put((position, realname, to_abspath(target, source, realname), st))
+                position += 1
+    finally:
+        for thread in threads:
+            tasks.put(None)
+        for thread in threads:
+            thread.join()
+        checkpoint.save()
+    return(progress)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%%prog [options] <base path to pydedup data> <source directory> [target directory in filesystem]")
+    parser.add_option("--hashfunc", dest="str_hashfunc", type="str", default="sha1",
+        help="hashing function of hashlib, as the filesystem uses, default %default")
+    parser.add_option("--blocksize", dest="blocksize", type="int", default=128 * 1024,
+        help="blocksize, as the filesystem uses, default %default")
+    parser.add_option("--chunker", dest="chunker", type="choice", choices=["fixed", "cdc"], default="fixed",
+        help="how to cut data into blocks <fixed, cdc>, default %default")
+    parser.add_option("--chunkmin", dest="chunkmin", type="int", default=0,
+        help="minimum block length of cdc chunker, default blocksize / 4")
+    parser.add_option("--chunkavg", dest="chunkavg", type="int", default=0,
+        help="average block length of cdc chunker, default blocksize")
+    parser.add_option("--chunkmax", dest="chunkmax", type="int", default=0,
+        help="maximum block length of cdc chunker, default blocksize * 4")
+    parser.add_option("--storage", dest="storage", type="choice", choices=sorted(BLOCK_STORAGES.keys()), default=DEFAULT_STORAGE,
+        help="block storage, as the filesystem uses, default %default")
+    parser.add_option("--compress", dest="compress", type="choice", choices=sorted(CODEC_NAMES.keys()), default="none",
+        help="compression of new blocks, default %default")
+    parser.add_option("--compresslevel", dest="compresslevel", type="int", default=6,
+        help="compression level 1 (fast) to 9 (small), default %default")
+    parser.add_option("--readers", dest="readers", type="int", default=4,
+        help="number of threads reading files, default %default")
+    parser.add_option("--hashthreads", dest="hashthreads", type="int", default=multiprocessing.cpu_count(),
+        help="number of threads hashing and storing blocks, default number of cpus")
+    parser.add_option("--bloomsize", dest="bloomsize", type="int", default=16 * 1024 * 1024,
+        help="bytes of bloom filter of all digests, default %default")
+    parser.add_option("--restart", dest="restart", action="store_true", default=False,
+        help="import everything again, not only files after the checkpoint")
+    (options, args) = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s %(message)s")
+    if len(args) not in (2, 3):
+        parser.print_help()
+        sys.exit(1)
+    if not os.path.isdir(args[1]):
+        print "path %s does not exist or is not accessible" % args[1]
+        sys.exit(2)
+    source = os.path.abspath(args[1])
+    target = "/"
+    if len(args) == 3:
+        target = "/" + args[2].strip("/")
+    if options.chunker == "cdc":
+        chunkavg = options.chunkavg or options.blocksize
+        chunker = ContentChunker(options.chunkmin or chunkavg / 4, chunkavg, options.chunkmax or chunkavg * 4)
+    else:
+        chunker = FixedChunker(options.blocksize)
+    meta_storage = MetaStorage(args[0], options.blocksize, getattr(hashlib, options.str_hashfunc), chunker=chunker,
+        storage=options.storage, compress=options.compress, compresslevel=options.compresslevel,
+        hashthreads=options.hashthreads, bloomsize=options.bloomsize, scrubrate=0)
+    try:
+        try:
+            meta_storage.getattr(target)
+        except OSError:
+            meta_storage.mkdir(target, 0755)
+        checkpoint = Checkpoint(os.path.join(args[0], "meta", CHECKPOINT_FILENAME), source, target, options.restart)
+        progress = bulk_import(meta_storage, source, target, checkpoint, options.readers)
+        # complete, failed files are logged
+        checkpoint.remove()
+        print "%d files with %d bytes imported, %d failed, %d imported before" % (progress.done_files, progress.done_bytes, progress.failed, progress.skipped)
+    except ValueError, exc:
+        print exc
+        sys.exit(3)
+    finally:
+        meta_storage.close()
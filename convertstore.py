@@ -0,0 +1,53 @@
+#!/usr/bin/python
+"""convert entries and sequences written with cPickle to BinaryFormat, while not mounted"""
+
+import os
+import sys
+import tempfile
+
+import BinaryFormat
+
+def __rewrite(filename, data, tmp_path):
+    """replace content of filename, readers never see half written files"""
+    (fd, tmpname) = tempfile.mkstemp(dir=tmp_path)
+    wfile = os.fdopen(fd, "wb")
+    wfile.write(data)
+    wfile.close()
+    os.rename(tmpname, filename)
+
+def convert(filename, magics, loads, dumps, tmp_path):
+    """convert filename if it is not binary, returns (old size, new size)"""
+    data = open(filename, "rb").read()
+    if data.startswith(magics):
+        return((len(data), len(data)))
+    new_data = dumps(*loads(data))
+    __rewrite(filename, new_data, tmp_path)
+    return((len(data), len(new_data)))
+
+def convert_tree(path, magics, loads, dumps, tmp_path):
+    """convert all files below path, prints summary"""
+    counter = 0
+    old_size = 0
+    new_size = 0
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for filename in filenames:
+            (old, new) = convert(os.path.join(dirpath, filename), magics, loads, dumps, tmp_path)
+            counter += 1
+            old_size += old
+            new_size += new
+    print "%s : %d files, %d bytes before, %d bytes after" % (path, counter, old_size, new_size)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "usage %s <base path to pydedup data>" % sys.argv[0]
+        sys.exit(1)
+    if not os.path.isdir(sys.argv[1]):
+        print "path %s does not exist or is not accessible" % sys.argv[1]
+        sys.exit(2)
+    tmp_path = os.path.join(sys.argv[1], "tmp")
+    if not os.path.isdir(tmp_path):
+        os.mkdir(tmp_path)
+    convert_tree(os.path.join(sys.argv[1], "files"), (BinaryFormat.ENTRY_MAGIC, ),
+        BinaryFormat.loads_entry, BinaryFormat.dumps_entry, tmp_path)
+    convert_tree(os.path.join(sys.argv[1], "filedigest"), (BinaryFormat.SEQUENCE_MAGIC, BinaryFormat.SEQUENCE_MAGIC2),
+        BinaryFormat.loads_sequence, BinaryFormat.dumps_sequence, tmp_path)
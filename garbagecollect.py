@@ -0,0 +1,360 @@
+#!/usr/bin/python
+"""
+offline garbage collector, while not mounted
+
+computes the true reference counters of sequences and blocks by
+walking files/ and filedigest/ (mark), then corrects the counters in
+sequences and in the block storage, and deletes sequences and blocks
+nothing refers to (sweep), at last the usage counters shown by statfs
+are saved with the totals counted
+
+digests are written to sorted runs on disk and merged, so the number
+of entries and blocks is not limited by memory
+"""
+
+import os
+import sys
+import heapq
+import tempfile
+import itertools
+import multiprocessing
+from optparse import OptionParser
+
+import BinaryFormat
+from Sequence import load_sequence as load_sequence
+from MetaStorage import get_block_storage as get_block_storage
+from MetaStorage import BLOCK_STORAGES as BLOCK_STORAGES
+from BlockStorageJournal import BlockStorageJournal as BlockStorageJournal
+from Usage import Usage as Usage
+
+# digests held in memory before a sorted run is written
+RUN_SIZE = 1000000
+# runs merged at once, limits open files
+MERGE_FANIN = 128
+# files given to a worker at once
+TASK_SIZE = 1000
+# counters given to block_storage.update at once
+UPDATE_SIZE = 65536
+
+
+def write_run(digests, tmp_path):
+    """sort digests and write them to a new run file, returns filename"""
+    digests.sort()
+    (fd, filename) = tempfile.mkstemp(dir=tmp_path, prefix="gc-")
+    wfile = os.fdopen(fd, "wb")
+    for digest in digests:
+        wfile.write(digest + "\n")
+    wfile.close()
+    return(filename)
+
+def read_run(filename):
+    """yields digests of run file"""
+    for line in open(filename, "rb"):
+        yield line[:-1]
+
+def merge_runs(runs, tmp_path):
+    """yields digests of all runs in sorted order, run files are deleted"""
+    while len(runs) > MERGE_FANIN:
+        (fd, filename) = tempfile.mkstemp(dir=tmp_path, prefix="gc-")
+        wfile = os.fdopen(fd, "wb")
+        for digest in heapq.merge(*[read_run(run) for run in runs[:MERGE_FANIN]]):
+            wfile.write(digest + "\n")
+        wfile.close()
+        for run in runs[:MERGE_FANIN]:
+            os.unlink(run)
+        runs = runs[MERGE_FANIN:] + [filename]
+    for digest in heapq.merge(*[read_run(run) for run in runs]):
+        yield digest
+    for run in runs:
+        os.unlink(run)
+
+def count_sorted(digests):
+    """yields (digest, number of occurrences) of sorted digests"""
+    for (digest, group) in itertools.groupby(digests):
+        yield((digest, sum(1 for item in group)))
+
+def outer_join(counts, keys):
+    """
+    yields (digest, count, found) of sorted (digest, count) and sorted keys,
+    count is 0 for keys without count, found is False for counts without key
+    """
+    counts = iter(counts)
+    keys = iter(keys)
+    count = next(counts, None)
+    key = next(keys, None)
+    while (count is not None) or (key is not None):
+        if (key is None) or ((count is not None) and (count[0] < key)):
+            yield((count[0], count[1], False))
+            count = next(counts, None)
+        elif (count is None) or (key < count[0]):
+            yield((key, 0, True))
+            key = next(keys, None)
+        else:
+            yield((key, count[1], True))
+            count = next(counts, None)
+            key = next(keys, None)
+
+
+class RunWriter(object):
+    """collects digests in memory, and in sorted runs on disk"""
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.digests = []
+        self.runs = []
+
+    def add(self, digests):
+        """add list of digests"""
+        self.digests.extend(digests)
+        if len(self.digests) >= RUN_SIZE:
+            self.flush()
+
+    def add_runs(self, runs):
+        """add runs already written"""
+        self.runs.extend(runs)
+
+    def flush(self):
+        """write digests in memory to run"""
+        if len(self.digests) > 0:
+            self.runs.append(write_run(self.digests, self.tmp_path))
+            self.digests = []
+
+    def sorted(self):
+        """yields all digests in sorted order"""
+        self.flush()
+        (runs, self.runs) = (self.runs, [])
+        return(merge_runs(runs, self.tmp_path))
+
+
+def entry_digests(filenames):
+    """worker, returns (list of sequence digests, number, bytes) of entry files"""
+    digests = []
+    nbytes = 0
+    for filename in filenames:
+        (digest, st) = BinaryFormat.loads_entry(open(filename, "rb").read())
+        nbytes += st.st_size
+        if digest != 0:
+            digests.append(digest)
+    return((digests, len(filenames), nbytes))
+
+def set_nref(filename, nref, tmp_path):
+    """change reference counter of sequence file"""
+    if not BinaryFormat.update_sequence_nref(filename, nref):
+        # old cPickle file, write it again
+        (old_nref, sequence, lengths) = BinaryFormat.loads_sequence(open(filename, "rb").read())
+        (fd, tmpname) = tempfile.mkstemp(dir=tmp_path)
+        wfile = os.fdopen(fd, "wb")
+        wfile.write(BinaryFormat.dumps_sequence(nref, sequence, lengths))
+        wfile.close()
+        os.rename(tmpname, filename)
+
+def block_digests(args):
+    """
+    worker, corrects reference counters of sequences,
+    writes their block references to sorted runs,
+    returns (list of runs, number of sequences corrected)
+    """
+    (items, tmp_path, dry_run) = args
+    digests = []
+    runs = []
+    fixed = 0
+    for (filename, nref) in items:
+        sequence = load_sequence(filename, 0)
+        if sequence.nref != nref:
+            fixed += 1
+            if not dry_run:
+                set_nref(filename, nref, tmp_path)
+        if sequence.per_occurrence:
+            digests.extend(sequence)
+        else:
+            # older sequences hold one reference per distinct block
+            digests.extend(set(sequence))
+        if len(digests) >= RUN_SIZE:
+            runs.append(write_run(digests, tmp_path))
+            digests = []
+    if len(digests) > 0:
+        runs.append(write_run(digests, tmp_path))
+    return((runs, fixed))
+
+
+class GarbageCollector(object):
+    """mark and sweep of one pydedup data directory"""
+
+    def __init__(self, base_path, storage, processes, dry_run=False):
+        self.file_path = os.path.join(base_path, "files")
+        self.filedigest_path = os.path.join(base_path, "filedigest")
+        self.db_path = os.path.join(base_path, "meta")
+        self.block_path = os.path.join(base_path, "blocks")
+        self.tmp_path = os.path.join(base_path, "tmp")
+        self.reclaim_path = os.path.join(base_path, "reclaim")
+        if not os.path.isdir(self.tmp_path):
+            os.mkdir(self.tmp_path)
+        self.storage = storage
+        self.pool = multiprocessing.Pool(processes)
+        self.dry_run = dry_run
+        # counters for report
+        self.num_entries = 0
+        self.num_files = 0
+        self.num_directories = 0
+        self.logical_bytes = 0
+        self.num_sequences = 0
+        self.sequences_fixed = 0
+        self.sequences_removed = 0
+        self.sequences_missing = 0
+        self.sequences_queued = 0
+        self.sequence_bytes = 0
+        self.num_blocks = 0
+        self.blocks_fixed = 0
+        self.blocks_removed = 0
+        self.blocks_missing = 0
+        self.block_bytes = 0
+        self.physical_bytes = 0
+
+    def __entry_tasks(self):
+        """yields lists of up to TASK_SIZE entry files, counts directories"""
+        task = []
+        for (dirpath, dirnames, filenames) in os.walk(self.file_path):
+            self.num_directories += len(dirnames)
+            for filename in filenames:
+                fullname = os.path.join(dirpath, filename)
+                if os.path.islink(fullname):
+                    continue
+                task.append(fullname)
+                if len(task) == TASK_SIZE:
+                    yield task
+                    task = []
+        if len(task) > 0:
+            yield task
+
+    def __sequence_tasks(self, sequence_counts):
+        """
+        yields worker tasks of sequences still in use,
+        deletes sequences no entry refers to
+        """
+        items = []
+        names = sorted(os.listdir(self.filedigest_path))
+        for (digest, nref, found) in outer_join(sequence_counts, names):
+            filename = os.path.join(self.filedigest_path, digest)
+            if not found:
+                print "sequence %s of %d entries is missing" % (digest, nref)
+                self.sequences_missing += 1
+            elif nref == 0:
+                self.sequences_removed += 1
+                self.sequence_bytes += os.path.getsize(filename)
+                if not self.dry_run:
+                    os.unlink(filename)
+            else:
+                self.num_sequences += 1
+                items.append((filename, nref))
+                if len(items) == TASK_SIZE:
+                    yield((items, self.tmp_path, self.dry_run))
+                    items = []
+        if len(items) > 0:
+            yield((items, self.tmp_path, self.dry_run))
+
+    def mark(self):
+        """returns sorted (digest, nref) of true block reference counters"""
+        entries = RunWriter(self.tmp_path)
+        for (digests, nfiles, nbytes) in self.pool.imap_unordered(entry_digests, self.__entry_tasks()):
+            self.num_entries += len(digests)
+            self.num_files += nfiles
+            self.logical_bytes += nbytes
+            entries.add(digests)
+        blocks = RunWriter(self.tmp_path)
+        sequence_counts = count_sorted(entries.sorted())
+        for (runs, fixed) in self.pool.imap_unordered(block_digests, self.__sequence_tasks(sequence_counts)):
+            blocks.add_runs(runs)
+            self.sequences_fixed += fixed
+        self.pool.close()
+        self.pool.join()
+        return(count_sorted(blocks.sorted()))
+
+    def __update(self, block_storage, counters):
+        """write counters to block_storage"""
+        if (len(counters) > 0) and (not self.dry_run):
+            block_storage.update(counters)
+
+    def __size(self, block_storage, digest):
+        """returns stored bytes of block, 0 if only its counter is left"""
+        try:
+            return(block_storage.size(digest))
+        except (KeyError, OSError, IOError), exc:
+            return(0)
+
+    def sweep(self, block_counts):
+        """correct block reference counters, delete unused blocks"""
+        # in a dry run blocks, counters and packs are only read
+        block_storage = get_block_storage(self.storage)(self.db_path, self.block_path, readonly=self.dry_run)
+        # changes not yet written by the last mount are applied first,
+        # in a dry run they are only read
+        block_storage = BlockStorageJournal(block_storage, self.db_path, readonly=self.dry_run)
+        stored = RunWriter(self.tmp_path)
+        for digest in block_storage.digests():
+            stored.add([digest])
+        counters = []
+        for (digest, nref, found) in outer_join(block_counts, stored.sorted()):
+            if not found:
+                print "block %s of %d references is missing" % (digest, nref)
+                self.blocks_missing += 1
+                continue
+            if nref == 0:
+                # also blocks stored without counter, left by a crash
+                self.blocks_removed += 1
+                self.block_bytes += self.__size(block_storage, digest)
+            else:
+                self.num_blocks += 1
+                self.physical_bytes += self.__size(block_storage, digest)
+                if block_storage.nref(digest) == nref:
+                    continue
+                self.blocks_fixed += 1
+            counters.append((digest, nref))
+            if len(counters) == UPDATE_SIZE:
+                self.__update(block_storage, counters)
+                counters = []
+        self.__update(block_storage, counters)
+        block_storage.close()
+        # references of sequences queued for the reclaimer are not
+        # counted above, so they are given back already
+        if os.path.isdir(self.reclaim_path):
+            for name in os.listdir(self.reclaim_path):
+                if not name.endswith(".cursor"):
+                    self.sequences_queued += 1
+                if not self.dry_run:
+                    os.unlink(os.path.join(self.reclaim_path, name))
+        if not self.dry_run:
+            Usage.write(self.db_path, {
+                "files" : self.num_files,
+                "directories" : self.num_directories,
+                "logical_bytes" : self.logical_bytes,
+                "blocks" : self.num_blocks,
+                "physical_bytes" : self.physical_bytes,
+            })
+
+    def report(self):
+        """prints summary"""
+        print "%d entries refer to %d sequences" % (self.num_entries, self.num_sequences)
+        print "sequences : %d counters corrected, %d removed with %d bytes, %d missing, %d queued to reclaim" % (self.sequences_fixed, self.sequences_removed, self.sequence_bytes, self.sequences_missing, self.sequences_queued)
+        print "usage     : %d files, %d directories, %d bytes in %d blocks of %d bytes" % (self.num_files, self.num_directories, self.logical_bytes, self.num_blocks, self.physical_bytes)
+        print "blocks    : %d kept, %d counters corrected, %d removed with %d bytes, %d missing" % (self.num_blocks, self.blocks_fixed, self.blocks_removed, self.block_bytes, self.blocks_missing)
+        if self.dry_run:
+            print "dry run, nothing was changed"
+        elif self.storage == "pack":
+            print "space of removed blocks is counted as dead in pack files"
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%%prog [options] <base path to pydedup data> <%s>" % "|".join(sorted(BLOCK_STORAGES.keys())))
+    parser.add_option("-n", "--dry-run", dest="dry_run", action="store_true", default=False,
+        help="only report what would be changed")
+    parser.add_option("-p", "--processes", dest="processes", type="int", default=multiprocessing.cpu_count(),
+        help="number of worker processes, default number of cpus")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_help()
+        sys.exit(1)
+    if not os.path.isdir(args[0]):
+        print "path %s does not exist or is not accessible" % args[0]
+        sys.exit(2)
+    collector = GarbageCollector(args[0], args[1], options.processes, options.dry_run)
+    collector.sweep(collector.mark())
+    collector.report()
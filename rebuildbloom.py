@@ -0,0 +1,31 @@
+#!/usr/bin/python
+"""build bloom filter of all stored digests again, while not mounted"""
+
+import os
+import sys
+
+from MetaStorage import get_block_storage as get_block_storage
+from MetaStorage import BLOCK_STORAGES as BLOCK_STORAGES
+from BlockStorageBloom import BLOOM_FILENAME as BLOOM_FILENAME
+from BlockStorageBloom import build as build
+from BlockStorageJournal import BlockStorageJournal as BlockStorageJournal
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print "usage %s <base path to pydedup data> <%s> [bytes]" % (sys.argv[0], "|".join(sorted(BLOCK_STORAGES.keys())))
+        sys.exit(1)
+    if not os.path.isdir(sys.argv[1]):
+        print "path %s does not exist or is not accessible" % sys.argv[1]
+        sys.exit(2)
+    db_path = os.path.join(sys.argv[1], "meta")
+    block_path = os.path.join(sys.argv[1], "blocks")
+    nbytes = 16 * 1024 * 1024
+    if len(sys.argv) == 4:
+        nbytes = int(sys.argv[3])
+    block_storage = get_block_storage(sys.argv[2])(db_path, block_path, readonly=True)
+    # digests only in journal logs not yet applied are added too
+    block_storage = BlockStorageJournal(block_storage, db_path, readonly=True)
+    bloom_filter = build(block_storage, nbytes)
+    block_storage.close()
+    bloom_filter.save(os.path.join(db_path, BLOOM_FILENAME))
+    print "%d digests in bloom filter of %d bytes" % (bloom_filter.count, nbytes)
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+"""
+create, delete and list snapshots, while not mounted
+
+a snapshot is a read only copy of a directory tree in /.snapshots,
+only entries are copied and sequences get one more reference, so it
+costs no block data, while mounted mkdir and rmdir in /.snapshots
+take and delete snapshots of the whole filesystem
+"""
+
+import os
+import sys
+import hashlib
+from optparse import OptionParser
+
+from MetaStorage import MetaStorage as MetaStorage
+from MetaStorage import BLOCK_STORAGES as BLOCK_STORAGES
+from MetaStorage import SNAPSHOT_DIR as SNAPSHOT_DIR
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%%prog [options] <base path to pydedup data> <%s> <create name [path]|delete name|list>" % "|".join(sorted(BLOCK_STORAGES.keys())))
+    (options, args) = parser.parse_args()
+    if (len(args) < 3) or (args[2] not in ("create", "delete", "list")):
+        parser.print_help()
+        sys.exit(1)
+    if not os.path.isdir(args[0]):
+        print "path %s does not exist or is not accessible" % args[0]
+        sys.exit(2)
+    # blocks are neither read nor written, blocksize and hashfunc do not matter
+    meta_storage = MetaStorage(args[0], 128 * 1024, hashlib.sha1, storage=args[1], scrubrate=0)
+    try:
+        if (args[2] == "create") and (len(args) in (4, 5)):
+            path = "/"
+            if len(args) == 5:
+                path = "/" + args[4].strip("/")
+            meta_storage.snapshot(path, args[3])
+            print "snapshot of %s in %s/%s" % (path, SNAPSHOT_DIR, args[3])
+        elif (args[2] == "delete") and (len(args) == 4):
+            meta_storage.delete_snapshot(args[3])
+            print "snapshot %s deleted" % args[3]
+        elif (args[2] == "list") and (len(args) == 3):
+            for name in meta_storage.snapshots():
+                print name
+        else:
+            parser.print_help()
+            sys.exit(1)
+    except OSError, exc:
+        print exc
+        sys.exit(3)
+    finally:
+        # blocks of a deleted snapshot are deleted before exit
+        meta_storage.close(reclaim=True)
@@ -1,25 +1,39 @@
 #!/usr/bin/python
 
+"""
+statistics and integrity verification of pydedup data, while not mounted
+
+every stored block is read once through the configured block storage
+and hashed by a pool of processes, files are verified by checking that
+all blocks of their sequences exist and were verified, so blocks shared
+by many files are not read again for every file,
+progress is checkpointed after every shard of digests, an interrupted
+run resumes where it stopped
+"""
+
 import os
-import cPickle
-import hashlib
 import sys
+import time
+import hashlib
+import multiprocessing
+from optparse import OptionParser
 
-def __blockverify(checksum):
-    hashfunc = hashlib.sha1()
-    hashfunc.update(open(os.path.join(block_basedir, "%s.dmp" % checksum), "rb").read())
-    assert hashfunc.hexdigest() == checksum
-    return(True)
-
-def blockverify():
-    for blockdigest in os.listdir(block_basedir):
-        if blockdigest[-3:] == "dmp":
-            filename = os.path.join(block_basedir, blockdigest)
-            if __blockverify(blockdigest[:-4]) is False:
-                print "block checksum is incorrect"
-    return(True)
-
-def blockdedup():
+import BinaryFormat
+from Sequence import load_sequence as load_sequence
+from MetaStorage import get_block_storage as get_block_storage
+from MetaStorage import BLOCK_STORAGES as BLOCK_STORAGES
+from BlockStorageCompress import BlockStorageCompress as BlockStorageCompress
+
+# digests are verified in shards, by their first two hex digits
+SHARDS = ["%02x" % index for index in range(256)]
+# digests of blocks given to a worker at once
+TASK_BLOCKS = 256
+# digests of files given to a worker at once
+TASK_FILES = 16
+# progress of verification, in base/meta
+CHECKPOINT_FILENAME = "verify.checkpoint"
+
+def blockdedup(block_basedir):
     ifos = os.listdir(block_basedir)
     counter = 0
     blockcounter = 0
@@ -44,52 +58,249 @@ def blockdedup():
     print "%d bytes saved with deduplication" % saved
     assert (totalsize - saved) == size_stored
 
-def __fileverify(filedigest):
-    filename = os.path.join(filedigest_basedir, filedigest)
-    try:
-        refcounter, sequence = cPickle.load(open(filename, "rb"))
-        digest = hashlib.sha1()
-        for checksum in sequence:
-            block_filename = os.path.join(block_basedir, "%s.dmp" % checksum)
-            block_data = open(block_filename, "rb").read()
-            digest.update(block_data)
-        assert filedigest == digest.hexdigest()
-    except EOFError, exc:
-        print "EOFError at file %s" % filename
-    return(True)
-
-def fileverify():
-    for filedigest in os.listdir(filedigest_basedir):
-        try:
-            __fileverify(filedigest)
-        except AssertionError:
-            print "file checksum %s is incorrect" % filedigest
-
-def filededup():
+def filededup(filedigest_basedir):
     dedupcounter = 0
     filecounter = 0
     for filedigest in os.listdir(filedigest_basedir):
         filename = os.path.join(filedigest_basedir, filedigest)
         try:
-            refcounter, sequence = cPickle.load(open(filename, "rb"))
+            refcounter, sequence = BinaryFormat.loads_sequence(open(filename, "rb").read())[:2]
         except EOFError, exc:
             print "EOFError at file %s" % filename
+            continue
         if refcounter > 1:
             dedupcounter += refcounter - 1
         filecounter += 1
     print "found %d unique files in total" % filecounter
     print "found %d duplicate files" % dedupcounter 
 
+
+
+class Checkpoint(object):
+    """
+    shards done and bad digests found, appended to a file,
+    so an interrupted verification resumes with the next shard
+    """
+
+    def __init__(self, filename, restart=False):
+        self.filename = filename
+        # (kind, shard) done
+        self.done = set()
+        # kind -> set of bad digests
+        self.bad = {"block" : set(), "file" : set()}
+        if restart and os.path.isfile(filename):
+            os.unlink(filename)
+        if os.path.isfile(filename):
+            for line in open(filename, "rb"):
+                if not line.endswith("\n"):
+                    # incomplete last line, written while interrupted
+                    break
+                (state, kind, value) = line.split()
+                if state == "done":
+                    self.done.add((kind, value))
+                else:
+                    self.bad[kind].add(value)
+        self.wfile = open(filename, "ab")
+
+    def is_done(self, kind, shard):
+        """true if shard of kind was verified before"""
+        return((kind, shard) in self.done)
+
+    def mark(self, kind, shard, bad):
+        """shard of kind is verified, with list of bad digests"""
+        for digest in bad:
+            self.wfile.write("bad %s %s\n" % (kind, digest))
+            self.bad[kind].add(digest)
+        self.wfile.write("done %s %s\n" % (kind, shard))
+        self.wfile.flush()
+        os.fsync(self.wfile.fileno())
+        self.done.add((kind, shard))
+
+    def remove(self):
+        """verification is complete"""
+        self.wfile.close()
+        os.unlink(self.filename)
+
+
+class Progress(object):
+    """prints throughput and estimated time left to stderr"""
+
+    def __init__(self, kind, total):
+        self.kind = kind
+        self.total = total
+        self.count = 0
+        self.nbytes = 0
+        self.start = time.time()
+        self.last = 0
+
+    def add(self, count, nbytes=0):
+        """count items with nbytes more are done"""
+        self.count += count
+        self.nbytes += nbytes
+        now = time.time()
+        if (now - self.last < 1) and (self.count < self.total):
+            return
+        self.last = now
+        elapsed = max(now - self.start, 0.001)
+        eta = 0
+        if self.count > 0:
+            eta = elapsed * (self.total - self.count) / self.count
+        line = "\r%s : %d of %d, %.1f/s" % (self.kind, self.count, self.total, self.count / elapsed)
+        if self.nbytes > 0:
+            line += ", %.1f MB/s" % (self.nbytes / elapsed / 1024 / 1024)
+        sys.stderr.write(line + ", eta %s " % time.strftime("%H:%M:%S", time.gmtime(eta)))
+        if self.count >= self.total:
+            sys.stderr.write("\n")
+        sys.stderr.flush()
+
+
+# block storage of a worker process, opened by open_worker
+worker_storage = None
+
+def open_worker(storage, db_path, block_path):
+    """pool initializer, every worker reads blocks itself, from its own read only block storage"""
+    global worker_storage
+    worker_storage = get_block_storage(storage)(db_path, block_path, readonly=True)
+
+def verify_blocks(args):
+    """worker, returns (list of digests of blocks not matching their data, number of blocks, bytes read)"""
+    (str_hashfunc, digests) = args
+    # only decode is used, codec does not matter
+    codec = BlockStorageCompress(None, "none")
+    bad = []
+    nbytes = 0
+    for digest in digests:
+        hashfunc = getattr(hashlib, str_hashfunc)()
+        try:
+            data = worker_storage.get(digest)
+            nbytes += len(data)
+            hashfunc.update(codec.decode(data))
+        except StandardError, exc:
+            bad.append(digest)
+            continue
+        if hashfunc.hexdigest() != digest:
+            bad.append(digest)
+    return((bad, len(digests), nbytes))
+
+def verify_files(args):
+    """
+    worker, returns (list of digests of files not matching the data
+    of their blocks in order, number of files, bytes read)
+    """
+    (str_hashfunc, filedigest_basedir, filedigests) = args
+    codec = BlockStorageCompress(None, "none")
+    bad = []
+    nbytes = 0
+    for filedigest in filedigests:
+        hashfunc = getattr(hashlib, str_hashfunc)()
+        try:
+            for digest in load_sequence(os.path.join(filedigest_basedir, filedigest), 0):
+                data = codec.decode(worker_storage.get(digest))
+                nbytes += len(data)
+                hashfunc.update(data)
+        except StandardError, exc:
+            bad.append(filedigest)
+            continue
+        if hashfunc.hexdigest() != filedigest:
+            bad.append(filedigest)
+    return((bad, len(filedigests), nbytes))
+
+def __tasks(digests, size, *args):
+    """yields worker tasks, args and a list of up to size digests"""
+    for start in xrange(0, len(digests), size):
+        yield(args + (digests[start:start + size], ))
+
+def blockverify(block_storage, str_hashfunc, pool, checkpoint):
+    """hash every stored block once, shard by shard"""
+    shards = {}
+    for digest in block_storage.digests():
+        if not checkpoint.is_done("block", digest[:2]):
+            shards.setdefault(digest[:2], []).append(digest)
+    for shard in SHARDS:
+        if shard not in shards:
+            # nothing stored or verified before
+            checkpoint.mark("block", shard, [])
+    progress = Progress("blocks", sum(len(digests) for digests in shards.values()))
+    for shard in sorted(shards.keys()):
+        bad = []
+        for (result, count, nbytes) in pool.imap_unordered(verify_blocks, __tasks(shards[shard], TASK_BLOCKS, str_hashfunc)):
+            bad.extend(result)
+            progress.add(count, nbytes)
+        checkpoint.mark("block", shard, bad)
+    for digest in sorted(checkpoint.bad["block"]):
+        print "block checksum %s is incorrect" % digest
+
+def fileverify(block_storage, filedigest_basedir, checkpoint, pool, str_hashfunc=None):
+    """
+    check all blocks of every sequence exist and are not bad,
+    shared blocks are checked once per sequence, with str_hashfunc
+    the data of every file is hashed by the pool and compared to its
+    digest, which finds blocks in wrong order too
+    """
+    shards = {}
+    for filedigest in os.listdir(filedigest_basedir):
+        if not checkpoint.is_done("file", filedigest[:2]):
+            shards.setdefault(filedigest[:2], []).append(filedigest)
+    for shard in SHARDS:
+        if shard not in shards:
+            checkpoint.mark("file", shard, [])
+    progress = Progress("files", sum(len(filedigests) for filedigests in shards.values()))
+    for shard in sorted(shards.keys()):
+        bad = []
+        if str_hashfunc is not None:
+            for (result, count, nbytes) in pool.imap_unordered(verify_files, __tasks(shards[shard], TASK_FILES, str_hashfunc, filedigest_basedir)):
+                bad.extend(result)
+                progress.add(count, nbytes)
+            checkpoint.mark("file", shard, bad)
+            continue
+        for filedigest in shards[shard]:
+            try:
+                sequence = load_sequence(os.path.join(filedigest_basedir, filedigest), 0)
+                for digest in set(sequence):
+                    if (digest in checkpoint.bad["block"]) or (not block_storage.exists(digest)):
+                        bad.append(filedigest)
+                        break
+            except StandardError, exc:
+                bad.append(filedigest)
+            progress.add(1)
+        checkpoint.mark("file", shard, bad)
+    for filedigest in sorted(checkpoint.bad["file"]):
+        print "file %s has missing or incorrect blocks" % filedigest
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print "usage %s <base path to pydedup data>" % sys.argv[0]
+    parser = OptionParser(usage="%%prog [options] <base path to pydedup data> <%s>" % "|".join(sorted(BLOCK_STORAGES.keys())))
+    parser.add_option("--hashfunc", dest="str_hashfunc", type="str", default="sha1",
+        help="hash function the data was stored with <sha1, md5, sha256>, default %default")
+    parser.add_option("-p", "--processes", dest="processes", type="int", default=multiprocessing.cpu_count(),
+        help="number of processes hashing blocks, default number of cpus")
+    parser.add_option("--restart", dest="restart", action="store_true", default=False,
+        help="start verification again, instead of resuming")
+    parser.add_option("--filedigests", dest="filedigests", action="store_true", default=False,
+        help="verify every file by the digest of all its data, reads every block of every file")
+    (options, args) = parser.parse_args()
+    if len(args) != 2:
+        parser.print_help()
         sys.exit(1)
-    if not os.path.isdir(sys.argv[1]):
-        print "path %s does not exist or is not accessible" % sys.argv[1]
+    if not os.path.isdir(args[0]):
+        print "path %s does not exist or is not accessible" % args[0]
         sys.exit(2)
-    block_basedir = os.path.join(sys.argv[1], "blocks")
-    filedigest_basedir = os.path.join(sys.argv[1], "filedigest")
-    blockdedup()
-    filededup()
-    blockverify()
-    fileverify()
+    block_basedir = os.path.join(args[0], "blocks")
+    filedigest_basedir = os.path.join(args[0], "filedigest")
+    db_path = os.path.join(args[0], "meta")
+    # every worker opens the block storage read only, and reads blocks itself
+    pool = multiprocessing.Pool(options.processes, open_worker, (args[1], db_path, block_basedir))
+    block_storage = get_block_storage(args[1])(db_path, block_basedir, readonly=True)
+    if args[1] == "file":
+        # counts from .ifo files
+        blockdedup(block_basedir)
+    filededup(filedigest_basedir)
+    checkpoint = Checkpoint(os.path.join(db_path, CHECKPOINT_FILENAME), options.restart)
+    blockverify(block_storage, options.str_hashfunc, pool, checkpoint)
+    str_hashfunc = None
+    if options.filedigests:
+        str_hashfunc = options.str_hashfunc
+    fileverify(block_storage, filedigest_basedir, checkpoint, pool, str_hashfunc)
+    checkpoint.remove()
+    pool.close()
+    pool.join()
+    block_storage.close()
@@ -0,0 +1,233 @@
+#!/usr/bin/python
+"""
+export a directory of pydedup data as tar stream, without fuse
+
+entries, sequences and blocks are read directly from base, files are
+written in the order their sequences were created, which is about the
+order their blocks were stored, so blocks are read mostly in place,
+prefetch threads load the next blocks into a cache meanwhile
+
+best run while not mounted, or nothing is changed while it runs
+"""
+
+import os
+import sys
+import stat
+import hashlib
+import logging
+import tarfile
+from optparse import OptionParser
+
+import BinaryFormat
+from Sequence import load_sequence as load_sequence
+from MetaStorage import get_block_storage as get_block_storage
+from MetaStorage import BLOCK_STORAGES as BLOCK_STORAGES
+from MetaStorage import SNAPSHOT_DIR as SNAPSHOT_DIR
+from BlockStorageCompress import BlockStorageCompress as BlockStorageCompress
+from BlockCache import BlockCache as BlockCache
+from Prefetcher import Prefetcher as Prefetcher
+
+
+class TarExport(object):
+    """writes tar stream of directory path of one pydedup data directory"""
+
+    def __init__(self, base_path, storage, path, out, cachesize=64 * 1024 * 1024, threads=4, window=64, snapshots=False, hashfunc=None):
+        self.file_path = os.path.join(base_path, "files")
+        self.filedigest_path = os.path.join(base_path, "filedigest")
+        self.root = os.path.join(self.file_path, path.strip("/"))
+        if not os.path.isdir(self.root):
+            raise OSError(2, "%s is no directory" % path)
+        # blocks are only read, a mounted filesystem may write meanwhile
+        block_storage = get_block_storage(storage)(os.path.join(base_path, "meta"), os.path.join(base_path, "blocks"), readonly=True)
+        # only decode is used, codec of new blocks does not matter
+        self.block_storage = BlockStorageCompress(block_storage, "none")
+        self.out = out
+        self.snapshots = snapshots
+        # verify data of every block with hashfunc, if not None
+        self.hashfunc = hashfunc
+        self.block_cache = BlockCache(cachesize)
+        # number of blocks read ahead of the block written
+        self.window = window
+        self.prefetcher = Prefetcher(self.block_cache, self.__load, threads, maxqueue=window)
+        # counters for report
+        self.num_files = 0
+        self.num_directories = 0
+        self.num_bytes = 0
+        self.errors = []
+
+    def __load(self, digest):
+        """returns data of block, verified if hashfunc is set"""
+        data = self.block_storage.get(digest)
+        if (self.hashfunc is not None) and (self.hashfunc(data).hexdigest() != digest):
+            raise IOError("data of block %s does not match its digest" % digest)
+        return(data)
+
+    def __scan(self):
+        """returns (list of directories, list of files), files in order of creation of their sequences"""
+        directories = []
+        files = []
+        snapshot_path = os.path.join(self.file_path, SNAPSHOT_DIR.strip("/"))
+        for (dirpath, dirnames, filenames) in os.walk(self.root):
+            if not self.snapshots:
+                dirnames[:] = [dirname for dirname in dirnames if os.path.join(dirpath, dirname) != snapshot_path]
+            dirnames.sort()
+            for dirname in dirnames:
+                directories.append(os.path.join(dirpath, dirname))
+            for filename in filenames:
+                realname = os.path.join(dirpath, filename)
+                if os.path.islink(realname):
+                    continue
+                (digest, st) = BinaryFormat.loads_entry(open(realname, "rb").read())
+                inode = 0
+                if digest != 0:
+                    try:
+                        inode = os.stat(os.path.join(self.filedigest_path, digest)).st_ino
+                    except OSError:
+                        # reported when the file is written
+                        pass
+                files.append((inode, realname, digest, st))
+        # inodes of sequences are about in order of creation
+        files.sort()
+        return((directories, files))
+
+    def __name(self, realname):
+        """name in tar of realname"""
+        return(os.path.relpath(realname, self.root))
+
+    def __write_header(self, tarinfo):
+        """write tar header"""
+        self.out.write(tarinfo.tobuf(tarfile.PAX_FORMAT))
+
+    def __sequence(self, realname, digest, report=True):
+        """returns digests of blocks of file, empty list if sequence is missing"""
+        if digest == 0:
+            return([])
+        try:
+            return(load_sequence(os.path.join(self.filedigest_path, digest), 0))
+        except (IOError, OSError), exc:
+            if report:
+                self.errors.append("%s : sequence %s : %s" % (realname, digest, exc))
+            return([])
+
+    def __plan(self, files):
+        """yields digests of all blocks in order they are written"""
+        for (inode, realname, digest, st) in files:
+            for blockdigest in self.__sequence(realname, digest, False):
+                yield blockdigest
+
+    def export(self):
+        """write whole tar stream"""
+        (directories, files) = self.__scan()
+        for realname in directories:
+            st = os.stat(realname)
+            tarinfo = tarfile.TarInfo(self.__name(realname))
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = stat.S_IMODE(st.st_mode)
+            tarinfo.uid = st.st_uid
+            tarinfo.gid = st.st_gid
+            tarinfo.mtime = st.st_mtime
+            self.__write_header(tarinfo)
+            self.num_directories += 1
+        plan = self.__plan(files)
+        # index in plan of the block written, and of nextdigest
+        position = 0
+        planned = 0
+        nextdigest = next(plan, None)
+        for (inode, realname, digest, st) in files:
+            tarinfo = tarfile.TarInfo(self.__name(realname))
+            tarinfo.mode = stat.S_IMODE(st.st_mode)
+            tarinfo.uid = st.st_uid
+            tarinfo.gid = st.st_gid
+            tarinfo.mtime = st.st_mtime
+            tarinfo.size = st.st_size
+            self.__write_header(tarinfo)
+            remaining = st.st_size
+            for blockdigest in self.__sequence(realname, digest):
+                # blocks up to the block written are not prefetched any more
+                while (nextdigest is not None) and (planned <= position):
+                    nextdigest = next(plan, None)
+                    planned += 1
+                while (nextdigest is not None) and (planned <= position + self.window):
+                    if self.prefetcher.prefetch([nextdigest]) == 0:
+                        # queue is full, try again before the next block
+                        break
+                    nextdigest = next(plan, None)
+                    planned += 1
+                position += 1
+                if remaining <= 0:
+                    continue
+                try:
+                    data = self.block_cache.get(blockdigest, self.__load)
+                except StandardError, exc:
+                    # size in header is fixed, the rest of the file is written as zeros
+                    self.errors.append("%s : block %s : %s" % (realname, blockdigest, exc))
+                    self.out.write("\0" * remaining)
+                    remaining = 0
+                    continue
+                if len(data) > remaining:
+                    data = data[:remaining]
+                self.out.write(data)
+                remaining -= len(data)
+            if remaining > 0:
+                # sequence is missing or shorter than file
+                self.errors.append("%s : %d bytes missing" % (realname, remaining))
+                self.out.write("\0" * remaining)
+            if st.st_size % tarfile.BLOCKSIZE > 0:
+                self.out.write("\0" * (tarfile.BLOCKSIZE - st.st_size % tarfile.BLOCKSIZE))
+            self.num_files += 1
+            self.num_bytes += st.st_size
+        # end of archive, two empty blocks
+        self.out.write("\0" * (2 * tarfile.BLOCKSIZE))
+        self.out.flush()
+
+    def close(self):
+        """wait for prefetch threads, close block_storage"""
+        self.prefetcher.join()
+        self.block_storage.close()
+
+    def report(self):
+        """prints summary and errors to stderr"""
+        for error in self.errors:
+            sys.stderr.write("%s\n" % error)
+        sys.stderr.write("%d directories, %d files with %d bytes exported, %d errors\n" % (self.num_directories, self.num_files, self.num_bytes, len(self.errors)))
+        self.block_cache.report(lambda line: sys.stderr.write(line + "\n"))
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%%prog [options] <base path to pydedup data> <%s> [directory in filesystem]" % "|".join(sorted(BLOCK_STORAGES.keys())))
+    parser.add_option("-o", "--output", dest="output", type="str", default="-",
+        help="file to write tar to, default stdout")
+    parser.add_option("--threads", dest="threads", type="int", default=4,
+        help="number of threads prefetching blocks, default %default")
+    parser.add_option("--window", dest="window", type="int", default=64,
+        help="number of blocks read ahead, default %default")
+    parser.add_option("--cachesize", dest="cachesize", type="int", default=64 * 1024 * 1024,
+        help="bytes of blocks held in memory, must hold window blocks, default %default")
+    parser.add_option("--snapshots", dest="snapshots", action="store_true", default=False,
+        help="export snapshots too")
+    parser.add_option("--verify", dest="str_hashfunc", type="str", default=None,
+        help="verify every block with this hashing function of hashlib, as the filesystem uses")
+    (options, args) = parser.parse_args()
+    logging.basicConfig(format="%(levelname)s %(message)s")
+    if len(args) not in (2, 3):
+        parser.print_help()
+        sys.exit(1)
+    if not os.path.isdir(args[0]):
+        sys.stderr.write("path %s does not exist or is not accessible\n" % args[0])
+        sys.exit(2)
+    path = "/"
+    if len(args) == 3:
+        path = args[2]
+    hashfunc = None
+    if options.str_hashfunc is not None:
+        hashfunc = getattr(hashlib, options.str_hashfunc)
+    if options.output == "-":
+        out = os.fdopen(sys.stdout.fileno(), "wb", 1024 * 1024)
+    else:
+        out = open(options.output, "wb", 1024 * 1024)
+    exporter = TarExport(args[0], args[1], path, out, options.cachesize, options.threads, options.window, options.snapshots, hashfunc)
+    exporter.export()
+    exporter.close()
+    exporter.report()
+    if len(exporter.errors) > 0:
+        sys.exit(3)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""round trips of entries and sequences through BinaryFormat"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import shutil
+import hashlib
+import cPickle
+import tempfile
+import unittest
+
+import BinaryFormat
+from Sequence import load_sequence as load_sequence
+from StatDefaultFile import StatDefaultFile as StatDefaultFile
+
+STAT_FIELDS = ("st_mode", "st_ino", "st_dev", "st_nlink", "st_uid", "st_gid", "st_size", "st_atime", "st_mtime", "st_ctime")
+
+
+def digests(count):
+    """list of count different hexdigests"""
+    return([hashlib.sha1(str(index)).hexdigest() for index in range(count)])
+
+
+class TestEntry(unittest.TestCase):
+
+    def stat(self):
+        st = StatDefaultFile()
+        st.st_mode = 0100640
+        st.st_ino = 12345678901
+        st.st_nlink = 2
+        st.st_uid = 1000
+        st.st_gid = 100
+        st.st_size = 5 * 1024 ** 3 + 7
+        st.st_atime = 1380000000
+        st.st_mtime = 1380000000.25
+        return(st)
+
+    def assertStatEqual(self, st, other):
+        for name in STAT_FIELDS:
+            self.assertEqual(getattr(st, name), getattr(other, name), name)
+
+    def test_roundtrip(self):
+        st = self.stat()
+        digest = digests(1)[0]
+        (loaded_digest, loaded_st) = BinaryFormat.loads_entry(BinaryFormat.dumps_entry(digest, st))
+        self.assertEqual(loaded_digest, digest)
+        self.assertStatEqual(loaded_st, st)
+        # whole seconds are given back as int
+        self.assertTrue(isinstance(loaded_st.st_atime, int))
+        self.assertTrue(isinstance(loaded_st.st_mtime, float))
+
+    def test_empty_file(self):
+        st = self.stat()
+        st.st_size = 0
+        (loaded_digest, loaded_st) = BinaryFormat.loads_entry(BinaryFormat.dumps_entry(0, st))
+        self.assertEqual(loaded_digest, 0)
+        self.assertStatEqual(loaded_st, st)
+
+    def test_cpickle(self):
+        st = self.stat()
+        digest = digests(1)[0]
+        (loaded_digest, loaded_st) = BinaryFormat.loads_entry(cPickle.dumps((digest, st)))
+        self.assertEqual(loaded_digest, digest)
+        self.assertStatEqual(loaded_st, st)
+
+
+class TestSequence(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_roundtrip_lengths(self):
+        sequence = digests(100)
+        lengths = [1000 + index for index in range(100)]
+        data = BinaryFormat.dumps_sequence(3, sequence, lengths)
+        self.assertEqual(BinaryFormat.loads_sequence(data), (3, sequence, lengths))
+
+    def test_roundtrip_fixed(self):
+        sequence = digests(10)
+        data = BinaryFormat.dumps_sequence(1, sequence, None)
+        self.assertEqual(BinaryFormat.loads_sequence(data), (1, sequence, None))
+
+    def test_roundtrip_empty(self):
+        data = BinaryFormat.dumps_sequence(1, [], [])
+        self.assertEqual(BinaryFormat.loads_sequence(data), (1, [], []))
+
+    def test_cpickle(self):
+        sequence = digests(5)
+        self.assertEqual(BinaryFormat.loads_sequence(cPickle.dumps((2, sequence))), (2, sequence, None))
+        lengths = [10, 20, 30, 40, 50]
+        self.assertEqual(BinaryFormat.loads_sequence(cPickle.dumps((2, sequence, lengths))), (2, sequence, lengths))
+
+    def test_mapped(self):
+        sequence = digests(50)
+        lengths = [100 * (index % 7 + 1) for index in range(50)]
+        filename = os.path.join(self.tmp_path, "sequence")
+        open(filename, "wb").write(BinaryFormat.dumps_sequence(4, sequence, lengths, BinaryFormat.FLAG_OCCURRENCE))
+        mapped = load_sequence(filename, 0)
+        self.assertEqual(len(mapped), 50)
+        self.assertEqual(mapped.nref, 4)
+        self.assertTrue(mapped.per_occurrence)
+        self.assertEqual(mapped[:], sequence)
+        self.assertEqual(mapped[-1], sequence[-1])
+        start = 0
+        for (index, length) in enumerate(lengths):
+            self.assertEqual(mapped.locate(start), (index, 0))
+            self.assertEqual(mapped.locate(start + length - 1), (index, length - 1))
+            start += length
+
+    def test_update_nref(self):
+        sequence = digests(3)
+        filename = os.path.join(self.tmp_path, "sequence")
+        open(filename, "wb").write(BinaryFormat.dumps_sequence(1, sequence, [1, 2, 3]))
+        self.assertTrue(BinaryFormat.update_sequence_nref(filename, 9))
+        self.assertEqual(BinaryFormat.loads_sequence(open(filename, "rb").read()), (9, sequence, [1, 2, 3]))
+        open(filename, "wb").write(cPickle.dumps((1, sequence)))
+        self.assertFalse(BinaryFormat.update_sequence_nref(filename, 9))
+
+
+if __name__ == "__main__":
+    unittest.main()
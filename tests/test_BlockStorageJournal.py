@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""BlockStorageJournal, recovery of logs and batches left by a crash"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from BlockStorageFile import BlockStorageFile as BlockStorageFile
+from BlockStorageJournal import BlockStorageJournal as BlockStorageJournal
+
+
+def block(value):
+    """returns (data, hexdigest) of a block"""
+    data = "block %s" % value
+    return((data, hashlib.sha1(data).hexdigest()))
+
+
+class TestBlockStorageJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.db_path = tempfile.mkdtemp()
+        self.block_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.db_path)
+        shutil.rmtree(self.block_path)
+
+    def open(self, readonly=False):
+        """journal over file block storage, commits only when asked"""
+        return(BlockStorageJournal(BlockStorageFile(self.db_path, self.block_path), self.db_path, interval=3600, readonly=readonly))
+
+    def crash(self, journal):
+        """stop journal without commit, the log stays as written"""
+        journal.stopped = True
+        journal.wakeup.set()
+        journal.thread.join()
+
+    def journal_files(self):
+        return(sorted(name for name in os.listdir(self.db_path) if name.startswith("refjournal-")))
+
+    def files(self):
+        """names and content of all files"""
+        result = {}
+        for path in (self.db_path, self.block_path):
+            for name in os.listdir(path):
+                result[name] = open(os.path.join(path, name), "rb").read()
+        return(result)
+
+    def put_blocks(self, journal):
+        """a twice, b once, c stored and deleted again"""
+        for value in ("a", "a", "b", "c"):
+            journal.put(*block(value))
+        journal.delete(block("c")[1])
+
+    def assertBlocks(self, storage):
+        (data, digest) = block("a")
+        self.assertEqual(storage.nref(digest), 2)
+        self.assertEqual(storage.get(digest), data)
+        self.assertEqual(storage.nref(block("b")[1]), 1)
+        self.assertEqual(storage.nref(block("c")[1]), 0)
+
+    def assertCommitted(self, storage):
+        """counters are in backend, the deleted block is gone"""
+        self.assertBlocks(storage)
+        self.assertFalse(storage.exists(block("c")[1]))
+
+    def test_close(self):
+        journal = self.open()
+        self.put_blocks(journal)
+        self.assertBlocks(journal)
+        journal.close()
+        self.assertEqual(self.journal_files(), [])
+        self.assertCommitted(BlockStorageFile(self.db_path, self.block_path))
+
+    def test_replay_log(self):
+        journal = self.open()
+        self.put_blocks(journal)
+        self.crash(journal)
+        # blocks are stored, counters only in the log
+        self.assertEqual(BlockStorageFile(self.db_path, self.block_path).nref(block("a")[1]), 0)
+        journal = self.open()
+        self.assertCommitted(journal.block_storage)
+        journal.close()
+        self.assertEqual(self.journal_files(), [])
+
+    def test_incomplete_line(self):
+        journal = self.open()
+        self.put_blocks(journal)
+        self.crash(journal)
+        # last change was written only partly
+        log = os.path.join(self.db_path, self.journal_files()[0])
+        open(log, "ab").write(block("b")[1][:10])
+        journal = self.open()
+        self.assertCommitted(journal.block_storage)
+        journal.close()
+
+    def test_batch_left(self):
+        # crash after the batch was written, before it was applied
+        storage = BlockStorageFile(self.db_path, self.block_path)
+        (data, digest) = block("a")
+        storage.store(data, digest)
+        storage.update([(digest, 1)])
+        batch = os.path.join(self.db_path, "refjournal-00000007.batch")
+        open(batch, "wb").write("%s 2\n" % digest)
+        journal = self.open()
+        self.assertEqual(journal.nref(digest), 2)
+        # the next log comes after the batch
+        journal.put(data, digest)
+        self.assertEqual(self.journal_files(), ["refjournal-00000008.log"])
+        journal.close()
+        self.assertEqual(storage.nref(digest), 3)
+
+    def test_batch_applied_twice(self):
+        storage = BlockStorageFile(self.db_path, self.block_path)
+        (data, digest) = block("a")
+        storage.store(data, digest)
+        # batches hold absolute counters, applied once or twice is the same
+        for _ in range(2):
+            open(os.path.join(self.db_path, "refjournal-00000001.batch"), "wb").write("%s 4\n" % digest)
+            self.open().close()
+            self.assertEqual(storage.nref(digest), 4)
+
+    def test_readonly(self):
+        journal = self.open()
+        self.put_blocks(journal)
+        self.crash(journal)
+        before = self.files()
+        journal = self.open(readonly=True)
+        self.assertBlocks(journal)
+        self.assertTrue(block("a")[1] in set(journal.digests()))
+        journal.close()
+        # logs are only read
+        self.assertEqual(self.files(), before)
+        journal = self.open()
+        self.assertCommitted(journal.block_storage)
+        journal.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""Reclaimer, block references return to zero after unlink and reclaim"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import random
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from MetaStorage import MetaStorage as MetaStorage
+from Chunker import FixedChunker as FixedChunker
+
+BLOCKSIZE = 4096
+
+
+class TestReclaimer(unittest.TestCase):
+
+    journalinterval = 0
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.open()
+        rand = random.Random(1)
+        self.blocks = [str(bytearray(rand.getrandbits(8) for _ in xrange(BLOCKSIZE))) for _ in range(8)]
+
+    def open(self):
+        """open MetaStorage of base"""
+        self.meta_storage = MetaStorage(self.base, BLOCKSIZE, hashlib.sha1, chunker=FixedChunker(BLOCKSIZE),
+            cachesize=0, storage="file", hashthreads=0, journalinterval=self.journalinterval,
+            bloomsize=4096, scrubrate=0)
+
+    def reopen(self):
+        """give back all queued references and open again"""
+        self.meta_storage.close(reclaim=True)
+        self.open()
+
+    def tearDown(self):
+        self.meta_storage.close(reclaim=True)
+        shutil.rmtree(self.base)
+
+    def write(self, abspath, indices):
+        """write file of blocks at indices"""
+        self.meta_storage.create(abspath)
+        write_buffer = self.meta_storage.new_write_buffer(abspath)
+        for (number, index) in enumerate(indices):
+            write_buffer.add(self.blocks[index], number * BLOCKSIZE)
+        self.meta_storage.release(abspath, write_buffer)
+
+    def assertRefs(self, counts):
+        """block storage holds exactly counts, dict of block index to references"""
+        block_storage = self.meta_storage.block_storage
+        expected = dict((hashlib.sha1(self.blocks[index]).hexdigest(), count) for (index, count) in counts.items())
+        self.assertEqual(sorted(block_storage.digests()), sorted(expected.keys()))
+        for (digest, count) in expected.items():
+            self.assertEqual(block_storage.nref(digest), count)
+        self.assertEqual(self.meta_storage.reclaimer.pending, 0)
+        self.assertEqual(os.listdir(os.path.join(self.base, "reclaim")), [])
+
+    def test_unlink_all(self):
+        # block 0 repeated in one file, block 1 shared between files
+        self.write("/a", [0, 0, 1, 2])
+        self.write("/b", [1, 3])
+        self.write("/c", [1, 3])
+        self.reopen()
+        # /b and /c share one sequence
+        self.assertRefs({0: 2, 1: 2, 2: 1, 3: 1})
+        for abspath in ("/a", "/b", "/c"):
+            self.meta_storage.unlink(abspath)
+        self.reopen()
+        self.assertRefs({})
+        self.assertEqual(os.listdir(os.path.join(self.base, "filedigest")), [])
+
+    def test_unlink_some(self):
+        self.write("/a", [0, 0, 1, 2])
+        self.write("/b", [1, 3])
+        self.write("/c", [1, 3])
+        self.meta_storage.unlink("/a")
+        self.meta_storage.unlink("/b")
+        self.reopen()
+        self.assertRefs({1: 1, 3: 1})
+        self.assertEqual(self.meta_storage.read("/c", 2 * BLOCKSIZE, 0), self.blocks[1] + self.blocks[3])
+
+    def test_overwrite(self):
+        self.write("/a", [0, 1])
+        self.write("/a", [1, 2])
+        self.reopen()
+        self.assertRefs({1: 1, 2: 1})
+        self.meta_storage.unlink("/a")
+        self.reopen()
+        self.assertRefs({})
+
+    def test_rename_over(self):
+        self.write("/a", [0, 1])
+        self.write("/b", [2])
+        self.meta_storage.rename("/b", "/a")
+        self.reopen()
+        self.assertRefs({2: 1})
+
+
+class TestReclaimerJournal(TestReclaimer):
+
+    journalinterval = 5
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""SequenceFile, records written, located and replaced in place"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from SequenceFile import SequenceFile as SequenceFile
+from Sequence import load_sequence as load_sequence
+
+
+def digest(value):
+    """hexdigest of value"""
+    return(hashlib.sha1(str(value)).hexdigest())
+
+
+class TestSequenceFile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.lengths = [100, 1, 250, 4096, 7, 999]
+        self.sequence = SequenceFile(self.tmp_path)
+        for (index, length) in enumerate(self.lengths):
+            self.sequence.append(digest(index), length)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_iter(self):
+        self.assertEqual(len(self.sequence), len(self.lengths))
+        self.assertEqual(list(self.sequence), [digest(index) for index in range(len(self.lengths))])
+
+    def test_locate(self):
+        start = 0
+        for (index, length) in enumerate(self.lengths):
+            for offset in (start, start + length / 2, start + length - 1):
+                self.assertEqual(self.sequence.locate(offset), (index, start, length, digest(index)))
+            start += length
+
+    def test_replace(self):
+        self.sequence.replace(2, digest("new"))
+        self.sequence.replace(0, digest("first"))
+        self.assertEqual(self.sequence.locate(100), (1, 100, 1, digest(1)))
+        self.assertEqual(self.sequence.locate(101), (2, 101, 250, digest("new")))
+        self.assertEqual(self.sequence.locate(0), (0, 0, 100, digest("first")))
+        # append after replace goes to the end
+        self.sequence.append(digest("last"), 3)
+        self.assertEqual(self.sequence.locate(sum(self.lengths) + 2), (6, sum(self.lengths), 3, digest("last")))
+        expected = [digest("first"), digest(1), digest("new")] + [digest(index) for index in range(3, 6)] + [digest("last")]
+        self.assertEqual(list(self.sequence), expected)
+        # lengths are kept in the finished file
+        mapped = load_sequence(self.sequence.finish(1), 0)
+        self.assertEqual(mapped[:], expected)
+        self.assertTrue(mapped.per_occurrence)
+        self.assertEqual(mapped.locate(101), (2, 0))
+        self.assertEqual(mapped.locate(350), (2, 249))
+        self.assertEqual(mapped.locate(351), (3, 0))
+
+    def test_discard(self):
+        self.sequence.discard()
+        self.assertEqual(os.listdir(self.tmp_path), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
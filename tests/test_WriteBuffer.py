@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+"""WriteBuffer, writes in any order and overwrites of stored blocks"""
+__author__ = "Arthur Messner <arthur.messner@gmail.com>"
+__copyright__ = "Copyright (c) 2013 Arthur Messner"
+__license__ = "GPL"
+__version__ = "$Revision$"
+__date__ = "$Date$"
+# $Id
+
+import os
+import random
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from MetaStorage import MetaStorage as MetaStorage
+from Chunker import FixedChunker as FixedChunker
+from Chunker import ContentChunker as ContentChunker
+from Sequence import load_sequence as load_sequence
+
+BLOCKSIZE = 4096
+
+
+class TestWriteBuffer(unittest.TestCase):
+
+    chunker = FixedChunker(BLOCKSIZE)
+    hashthreads = 0
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.open()
+        self.random = random.Random(1)
+        self.data = bytearray(self.random.getrandbits(8) for _ in xrange(40 * BLOCKSIZE + 123))
+
+    def open(self):
+        """open MetaStorage of base"""
+        self.meta_storage = MetaStorage(self.base, BLOCKSIZE, hashlib.sha1, chunker=self.chunker,
+            cachesize=0, storage="file", hashthreads=self.hashthreads, journalinterval=0,
+            bloomsize=4096, scrubrate=0)
+
+    def tearDown(self):
+        self.meta_storage.close(reclaim=True)
+        shutil.rmtree(self.base)
+
+    def write(self, pieces):
+        """write list of (offset, data) to /file, and release it"""
+        self.meta_storage.create("/file")
+        write_buffer = self.meta_storage.new_write_buffer("/file")
+        for (offset, data) in pieces:
+            write_buffer.add(str(data), offset)
+        self.meta_storage.release("/file", write_buffer)
+
+    def pieces(self, size):
+        """data in pieces of size"""
+        return([(offset, self.data[offset:offset + size]) for offset in range(0, len(self.data), size)])
+
+    def overwrite(self, offset, length):
+        """new random data for range, returns (offset, data)"""
+        data = bytearray(self.random.getrandbits(8) for _ in xrange(length))
+        self.data[offset:offset + length] = data
+        return((offset, data))
+
+    def assertStored(self):
+        """content, file digest and block references match data"""
+        # blocks of overwritten files are released by the reclaimer
+        self.meta_storage.close(reclaim=True)
+        self.open()
+        self.assertEqual(self.meta_storage.read("/file", len(self.data) + 1, 0), str(self.data))
+        self.assertEqual(self.meta_storage.getattr("/file").st_size, len(self.data))
+        filedigest = hashlib.sha1(str(self.data)).hexdigest()
+        filedigest_path = os.path.join(self.base, "filedigest")
+        self.assertEqual(os.listdir(filedigest_path), [filedigest])
+        sequence = load_sequence(os.path.join(filedigest_path, filedigest), BLOCKSIZE)
+        counts = {}
+        for digest in sequence:
+            counts[digest] = counts.get(digest, 0) + 1
+        block_storage = self.meta_storage.block_storage
+        self.assertEqual(sorted(block_storage.digests()), sorted(counts.keys()))
+        for (digest, count) in counts.items():
+            self.assertEqual(block_storage.nref(digest), count)
+
+    def test_sequential(self):
+        self.write(self.pieces(3000))
+        self.assertStored()
+
+    def test_out_of_order(self):
+        pieces = self.pieces(3000)
+        self.random.shuffle(pieces)
+        self.write(pieces)
+        self.assertStored()
+
+    def test_overwrite_stored_blocks(self):
+        pieces = self.pieces(5000)
+        # inside one block, across blocks and at the start of the file
+        pieces.append(self.overwrite(10 * BLOCKSIZE + 100, 10))
+        pieces.append(self.overwrite(20 * BLOCKSIZE - 50, 3 * BLOCKSIZE))
+        pieces.append(self.overwrite(0, 1))
+        self.write(pieces)
+        self.assertStored()
+
+    def test_overwrite_into_buffer(self):
+        pieces = self.pieces(5000)
+        # starts in stored blocks, ends behind the data written
+        pieces.insert(5, self.overwrite(4000, 25000 - 4000))
+        self.data = self.data[:25000]
+        pieces[6:] = [(offset, data) for (offset, data) in pieces[6:] if offset < 25000]
+        pieces = [(offset, data[:25000 - offset]) for (offset, data) in pieces]
+        self.write(pieces)
+        self.assertStored()
+
+    def test_overwrite_existing_file(self):
+        self.write(self.pieces(BLOCKSIZE))
+        # a second open writes only some ranges, the rest is kept
+        self.write([self.overwrite(7 * BLOCKSIZE + 7, 100), self.overwrite(3, 2)])
+        self.assertStored()
+
+    def test_random_writes(self):
+        pieces = self.pieces(4096)
+        for _ in range(100):
+            offset = self.random.randrange(len(self.data) - 1)
+            pieces.append(self.overwrite(offset, min(self.random.randrange(1, 3 * BLOCKSIZE), len(self.data) - offset)))
+        self.write(pieces)
+        self.assertStored()
+
+
+class TestWriteBufferContent(TestWriteBuffer):
+
+    chunker = ContentChunker(BLOCKSIZE / 4, BLOCKSIZE, BLOCKSIZE * 4)
+
+
+class TestWriteBufferPipeline(TestWriteBuffer):
+
+    hashthreads = 2
+
+
+if __name__ == "__main__":
+    unittest.main()